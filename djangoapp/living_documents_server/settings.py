@@ -19,6 +19,31 @@ NLP_SERVER_URL = 'http://130.203.136.198:9000/'
 # NLP_SERVER_URL = 'http://living-documents.ist.psu.edu:4200/'
 # NLP_SERVER_URL = 'http://130.203.136.198:4200'
 # NLP_SERVER_URL = 'http://0.0.0.0:4200'
+# How many sentences go to the NLP server in one openie request when triples are built in bulk
+NLP_ANNOTATE_BATCH_SIZE = 50
+# How many nlp server annotations are cached in the database and how many of those are also kept in memory
+ANNOTATION_CACHE_SIZE = 200000
+ANNOTATION_CACHE_MEMORY_SIZE = 5000
+# How many annotations a process caches between trimming the table back to ANNOTATION_CACHE_SIZE, counting the table
+# on every put is a full scan
+ANNOTATION_CACHE_PRUNE_EVERY = 1000
+# How many sets of tf-idf scores (one per set of document or section sentences) are saved in the database and how many
+# of those are also kept in memory
+TF_IDF_CACHE_SIZE = 2000
+TF_IDF_CACHE_MEMORY_SIZE = 64
+# How many sets of tf-idf scores a process saves between trimming the table back to TF_IDF_CACHE_SIZE, and how many
+# seconds apart the scores used from memory get their last use saved in the table
+TF_IDF_CACHE_PRUNE_EVERY = 100
+TF_IDF_CACHE_TOUCH_SECONDS = 300
+# How many words keep their stem in memory, and how many (word, stop words filtered or not) keep their processed token
+TEXT_STEM_CACHE_SIZE = 100000
+TEXT_TOKEN_CACHE_SIZE = 200000
+# Shared nlp server client: how many annotations run at once (and connections are pooled), how many more can wait
+# before callers block, and how long to wait (seconds) for a connection and for an annotation
+NLP_CLIENT_MAX_CONCURRENCY = 8
+NLP_CLIENT_MAX_QUEUE = 64
+NLP_CLIENT_CONNECT_TIMEOUT = 5
+NLP_CLIENT_READ_TIMEOUT = 120
 
 # Constant value used for pre-processing word to index
 FAST_ABS_RL_SUMMARIZER_PAD = 0
@@ -34,12 +59,90 @@ FAST_ABS_RL_SUMMARIZER_DIV = 1.0
 FAST_ABS_RL_SUMMARIZER_MAX_LEN = 30
 FAST_ABS_RL_SUMMARIZER_CUDA = False
 
+# Summarizer models (see summarizers/model_registry.py) to load when the app starts, e.g. ['bart', 't5',
+# 'presumm_abs', 'presumm_ext', 'fast_abs_rl-beam5'], and how much memory (MB) the loaded ones can take before the
+# least recently used get dropped
+SUMMARIZER_WARM_MODELS = []
+SUMMARIZER_MODEL_MEMORY_MB = 6144
+# Most tokens (padding included) in one batch of article chunks when BART and T5 summarize several articles together
+SUMMARIZER_BATCH_TOKENS = 8192
+
 # Define the output length of query_expansion function in article_extractor
 ARTICLE_EXTRACTOR_QUERY_EXPANSION_SIZE = 10
+# How a term's tf-idf scores in the search results add up to its expansion score, sum or max
+ARTICLE_EXTRACTOR_QUERY_EXPANSION_AGGREGATE = 'sum'
+# How many articles get fetched at once by the extractors (shared by the whole process), how many of those can be
+# from the same host, and how long (seconds) one fetch can wait on the connection or between bytes before it gives up
+ARTICLE_FETCH_WORKERS = 20
+ARTICLE_FETCH_PER_HOST = 4
+ARTICLE_FETCH_TIMEOUT = 20
+# How many processes the downloaded pages get parsed in (so parsing doesn't hold up the server's threads), how many
+# cpu seconds parsing the pages of one document (one extract_articles) can take before the rest of them are skipped,
+# and how many pages of a pdf get read. Every server worker process has a parse pool of its own, so the machine runs
+# (server workers) x ARTICLE_PARSE_PROCESSES parsing processes, each with newspaper loaded: keep
+# ARTICLE_PARSE_PROCESSES at about the number of cores divided by the number of server workers
+ARTICLE_PARSE_PROCESSES = 2
+ARTICLE_PARSE_CPU_SECONDS = 30
+ARTICLE_PARSE_MAX_PDF_PAGES = 50
+# The biggest pdf (MB) that gets downloaded, and how much of its text (characters) gets read before the rest of the
+# pages are skipped, the summarizers only use the start of a long article anyway
+ARTICLE_PDF_MAX_MB = 20
+ARTICLE_PDF_MAX_CHARS = 100000
+# How hard the extractors can hit the sites they fetch from: requests a second to one host (and how many can go at
+# once after it's been idle), requests a second to all of them together, slower rates for the hosts that block us
+# quickly, and how many times a 429 or 503 gets retried, backing off ARTICLE_FETCH_BACKOFF seconds (doubling each time)
+ARTICLE_FETCH_HOST_RATE = 2
+ARTICLE_FETCH_HOST_BURST = 4
+ARTICLE_FETCH_GLOBAL_RATE = 50
+ARTICLE_FETCH_HOST_RATES = {'www.google.com': 0.5}
+ARTICLE_FETCH_RETRIES = 3
+ARTICLE_FETCH_BACKOFF = 1
+# How similar (0 to 1) two extracted articles have to be to count as the same story, only the first one is kept, and
+# how many words are in the shingles they're compared by. The similarity is the share of their 64 bit SimHash
+# fingerprints that agree, not the share of shingles they have in common: at 0.85 up to 10 bits can differ. Copies of a
+# story with their own boilerplate around it (over 90% of the shingles shared) come out 1 to 8 bits apart and different
+# stories 22 to 40 bits apart, texts sharing about 80% of their shingles land on either side
+ARTICLE_DEDUP_SIMILARITY = 0.85
+ARTICLE_DEDUP_SHINGLE_SIZE = 3
+
+# How many built triple graphs (document or section) are kept in memory and updated as sentences and triples change,
+# and how many seconds after a sentence gets added to one without any triples it's sent to the nlp server for them (in
+# the background, the code that adds sentences usually builds their triples itself right away)
+TRIPLE_GRAPH_CACHE_SIZE = 16
+TRIPLE_GRAPH_SETTLE_SECONDS = 5
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# On-disk cache of the pages the extractors download (search results and articles): where it is, how long (seconds) a
+# page is used before checking back with the server, how big (MB) it can get, and whether to only use what is cached
+HTTP_CACHE_DIR = os.path.join(BASE_DIR, 'http_cache')
+HTTP_CACHE_TTL = 24 * 60 * 60
+HTTP_CACHE_MAX_MB = 1024
+HTTP_CACHE_OFFLINE = False
+
+# Record/replay of everything the pipeline gets from outside (pages, CoreNLP and OpenAI), for tests and benchmarks that
+# can't go to the network: off, record (go to the network and save what comes back) or replay (only use what was
+# saved), where the fixtures are kept, and how long (seconds) a replayed call of each kind takes
+REPLAY_MODE = 'off'
+REPLAY_DIR = os.path.join(BASE_DIR, 'replay_fixtures')
+REPLAY_LATENCY = {'http': 0, 'nlp': 0, 'completion': 0}
+
+# Corpus-wide idf built up from every article that gets extracted and memory mapped by all of the worker processes:
+# whether articles get added to it, where it is kept, and how many articles it needs before the tf-idf scores and the
+# query expansion use it instead of the idf of their own few texts. It's off by default, turning it on changes the
+# tf-idf scores (so the triple graphs) and the expanded terms once there are enough articles
+CORPUS_IDF_ENABLED = False
+CORPUS_IDF_DIR = os.path.join(BASE_DIR, 'corpus_idf')
+CORPUS_IDF_MIN_DOCUMENTS = 100
+# Longer tokens (urls, base64 and the like) aren't counted, they'd make every entry of the vocabulary that long
+CORPUS_IDF_MAX_TOKEN_BYTES = 32
+# How much the number of articles grows before scores cached with the corpus idf get calculated again
+CORPUS_IDF_VERSION_GROWTH = 0.1
+# How many batches of articles get written as small deltas before they're merged into new arrays, a merge writes out
+# the whole corpus
+CORPUS_IDF_MERGE_EVERY = 20
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.11/howto/deployment/checklist/
 
@@ -1,5 +1,6 @@
-from pycorenlp import StanfordCoreNLP
 import unittest
+from text_generation.annotators import annotation_cache
+from text_generation.annotators.nlp_client import get_client
 from typing import Dict
 import pprint
 '''
@@ -16,16 +17,17 @@ KeyError: string indices cannot be integers
 
 
 class Resolver:
-    nlp_server = StanfordCoreNLP('http://localhost:9000')
+    nlp_server = get_client('http://localhost:9000')
 
     def __init__(self, origin_text):
         """
         :param origin_text: the original text that we want to work with
         """
         self.text = origin_text
-        self.nlp_dict = self.nlp_server.annotate(
+        self.nlp_dict = annotation_cache.annotate(
+            self.nlp_server,
             self.text,
-            properties={
+            {
                 'annotators': 'coref',
                 'outputFormat': 'json'
             })
@@ -0,0 +1,162 @@
+"""Cache for nlp server annotations, so the same text with the same annotators and properties only gets annotated once.
+Annotations are kept in memory (the ANNOTATION_CACHE_MEMORY_SIZE most recently used) and in the CachedAnnotation
+table (the ANNOTATION_CACHE_SIZE most recently used, trimmed every ANNOTATION_CACHE_PRUNE_EVERY puts), so they outlive
+the process."""
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List
+
+from django.utils import timezone
+
+from living_documents_server.settings import (ANNOTATION_CACHE_MEMORY_SIZE, ANNOTATION_CACHE_PRUNE_EVERY,
+                                              ANNOTATION_CACHE_SIZE)
+from text_generation.annotators.nlp_client import NLPClient
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+# key -> annotation, least recently used first
+_memory = OrderedDict()
+_counts = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'evictions': 0}
+# annotations put since the table was last trimmed
+_unpruned = 0
+
+
+def cache_key(text: str, properties: Dict) -> str:
+    """The hash of the text, the annotators and the rest of the properties. The annotators are compared as a list, so
+    'tokenize, ssplit' and 'tokenize,ssplit' are the same.
+
+    :param str text: the text that gets annotated
+    :param Dict properties: the properties sent to the nlp server
+    :return str: hex digest
+    """
+    properties = dict(properties)
+    annotators = [annotator.strip() for annotator in properties.pop('annotators', '').split(',')]
+    return hashlib.sha256(json.dumps([text, annotators, properties], sort_keys=True).encode()).hexdigest()
+
+
+def annotate(nlp_server: NLPClient, text: str, properties: Dict):
+    """nlp_server.annotate, but it only goes to the server when the annotation isn't cached. Only annotations that
+    came back as json get cached, errors from the server are handed back as they are.
+
+    :param NLPClient nlp_server: the server to use on a miss
+    :param str text: the text to annotate
+    :param Dict properties: the properties to send
+    :return: the annotation, a dict unless the server sent back an error
+    """
+    key = cache_key(text, properties)
+    annotation = get_many([key]).get(key)
+    if annotation is not None:
+        return annotation
+    annotation = nlp_server.annotate(text, properties=properties)
+    if isinstance(annotation, str):
+        try:
+            annotation = json.loads(annotation)
+        except ValueError:
+            return annotation
+    put_many({key: annotation})
+    return annotation
+
+
+def get_many(keys: List[str]) -> Dict[str, Dict]:
+    """The cached annotations for the keys, the ones that aren't cached are left out and count as misses
+
+    :param List[str] keys: from cache_key
+    :return Dict[str, Dict]: key -> annotation
+    """
+    from text_generation.models.cached_annotation import CachedAnnotation
+
+    found = {}
+    with _lock:
+        for key in keys:
+            if key in _memory:
+                _memory.move_to_end(key)
+                found[key] = _memory[key]
+                _counts['memory_hits'] += 1
+    missing = [key for key in keys if key not in found]
+    if missing:
+        from_db = {cached.key: cached.load() for cached in CachedAnnotation.objects.filter(key__in=missing)}
+        if from_db:
+            CachedAnnotation.objects.filter(key__in=list(from_db)).update(last_used=timezone.now())
+        with _lock:
+            for key, annotation in from_db.items():
+                _remember(key, annotation)
+            _counts['db_hits'] += len(from_db)
+            _counts['misses'] += len(missing) - len(from_db)
+        found.update(from_db)
+    return found
+
+
+def put_many(annotations: Dict[str, Dict]):
+    """Caches the annotations, and every ANNOTATION_CACHE_PRUNE_EVERY of them evicts the least recently used ones
+    past ANNOTATION_CACHE_SIZE, so the table can be a little over it in between
+
+    :param Dict[str, Dict] annotations: key (from cache_key) -> annotation
+    """
+    from text_generation.models.cached_annotation import CachedAnnotation
+
+    global _unpruned
+    if not annotations:
+        return
+    with _lock:
+        for key, annotation in annotations.items():
+            _remember(key, annotation)
+    now = timezone.now()
+    # the same key always gets the same annotation, so one that someone else just cached can stay
+    CachedAnnotation.objects.bulk_create([
+        CachedAnnotation(key=key, data=CachedAnnotation.pack(annotation), last_used=now)
+        for key, annotation in annotations.items()], ignore_conflicts=True)
+    with _lock:
+        _unpruned += len(annotations)
+        if _unpruned < ANNOTATION_CACHE_PRUNE_EVERY:
+            return
+        _unpruned = 0
+    prune()
+
+
+def prune():
+    """Evicts the least recently used annotations past ANNOTATION_CACHE_SIZE from the table"""
+    from text_generation.models.cached_annotation import CachedAnnotation
+
+    extra = CachedAnnotation.objects.count() - ANNOTATION_CACHE_SIZE
+    if extra > 0:
+        evicted = list(CachedAnnotation.objects.order_by('last_used', 'id').values_list('id', flat=True)[:extra])
+        CachedAnnotation.objects.filter(id__in=evicted).delete()
+        with _lock:
+            _counts['evictions'] += len(evicted)
+
+
+def stats() -> Dict[str, int]:
+    """Hit, miss and eviction counts since the process started (or since clear)"""
+    with _lock:
+        counts = dict(_counts)
+        counts['hits'] = counts['memory_hits'] + counts['db_hits']
+        counts['in_memory'] = len(_memory)
+        return counts
+
+
+def clear(persistent: bool = False):
+    """Empties the in memory cache and zeroes the counts
+
+    :param bool persistent: also empty the CachedAnnotation table
+    """
+    from text_generation.models.cached_annotation import CachedAnnotation
+
+    global _unpruned
+    with _lock:
+        _memory.clear()
+        for name in _counts:
+            _counts[name] = 0
+        _unpruned = 0
+    if persistent:
+        CachedAnnotation.objects.all().delete()
+
+
+def _remember(key: str, annotation: Dict):
+    _memory[key] = annotation
+    _memory.move_to_end(key)
+    while len(_memory) > ANNOTATION_CACHE_MEMORY_SIZE:
+        _memory.popitem(last=False)
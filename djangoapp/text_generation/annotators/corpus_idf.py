@@ -0,0 +1,334 @@
+"""Inverse document frequencies over every article that has been extracted, instead of over the 20 to 100 sentences of
+one document (or the handful of articles in one fetch). Articles get added as they come in (see ingest), and the tf-idf
+scores, the triple graph filtering (through those scores) and the query expansion use the corpus idf once it has
+CORPUS_IDF_MIN_DOCUMENTS articles. Articles get counted on a thread of their own, so the request that extracted them
+doesn't wait for the stemming and the write.
+
+A store is a sorted vocabulary (utf-8 encoded, tokens longer than CORPUS_IDF_MAX_TOKEN_BYTES aren't counted) and the
+document frequency of each of its tokens, saved as numpy arrays that are memory mapped, so the worker processes share
+one copy through the page cache instead of loading their own. Each batch of articles gets written next to them as a
+delta with only the batch's tokens (under a file lock, then CURRENT is pointed at it so readers never see half of one),
+and every process merges the deltas into a small copy of its own. Every CORPUS_IDF_MERGE_EVERY batches the deltas get
+merged into a new generation of the arrays, that write is as big as the whole corpus."""
+import atexit
+import fcntl
+import hashlib
+import logging
+import math
+import os
+import queue
+import shutil
+import threading
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+from scipy.sparse import diags, spmatrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from living_documents_server import settings
+
+logger = logging.getLogger(__name__)
+
+# stemmed tokens, the same as the tf-idf scores of the sentences are calculated on
+STEMMED = 'stemmed'
+# words with the english stop words left out, the same as the query expansion picks from
+WORDS = 'words'
+
+
+class CorpusIdf:
+    """
+    The document frequencies of one kind of token over the articles. Every
+    process can have its own CorpusIdf for the same directory, they all see
+    what the others add.
+    """
+
+    def __init__(self, directory: str, analyzer: Callable[[str], List[str]]):
+        """
+        :param str directory: where the arrays are kept
+        :param Callable analyzer: splits a text into the tokens that get counted
+        """
+        self.directory = directory
+        self.analyzer = analyzer
+        self._lock = threading.RLock()
+        # the generation that is mapped, and how many of its deltas are in _recent
+        self._loaded = None
+        self._deltas = 0
+        self._vocabulary = np.array([], dtype='S1')
+        self._document_frequencies = np.array([], dtype=np.uint32)
+        self._seen = np.array([], dtype=np.uint64)
+        # the deltas merged together, the same arrays for only the articles added since the generation
+        self._recent = _EMPTY
+
+    @property
+    def documents(self) -> int:
+        """How many articles the frequencies are over"""
+        (_, _, seen), (_, _, recent_seen) = self._current()
+        return len(seen) + len(recent_seen)
+
+    @property
+    def version(self) -> int:
+        """For the caches of anything calculated with the idf, it only changes once the number of articles grew by
+        CORPUS_IDF_VERSION_GROWTH since it last did, a few more articles hardly change the idf"""
+        documents = self.documents
+        return int(math.log(documents) / math.log1p(settings.CORPUS_IDF_VERSION_GROWTH)) if documents else 0
+
+    def __len__(self) -> int:
+        (vocabulary, _, _), (recent_vocabulary, _, _) = self._current()
+        return len(vocabulary) + len(recent_vocabulary) - int(np.count_nonzero(np.isin(recent_vocabulary, vocabulary)))
+
+    def add(self, texts: Iterable[str]) -> int:
+        """Counts the texts' tokens, texts that were added before (by any process) don't count again
+
+        :param Iterable[str] texts: the texts of the articles
+        :return int: how many of them were new
+        """
+        texts = list(texts)
+        keys = np.array([_key(text) for text in texts], dtype=np.uint64)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'lock'), 'w') as lock_file, self._lock:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            (vocabulary, document_frequencies, seen), (recent_vocabulary, recent_frequencies, recent_seen) = \
+                self._current()
+            known = np.isin(keys, seen) | np.isin(keys, recent_seen)
+            counts = Counter()
+            new_keys = set()
+            for text, key, is_known in zip(texts, keys.tolist(), known.tolist()):
+                if is_known or key in new_keys:
+                    continue
+                new_keys.add(key)
+                counts.update({token for token in (token.encode() for token in self.analyzer(text))
+                               if len(token) <= settings.CORPUS_IDF_MAX_TOKEN_BYTES})
+            if not new_keys:
+                return 0
+
+            tokens = np.array(sorted(counts), dtype=bytes)
+            frequencies = np.array([counts[token] for token in tokens.tolist()], dtype=np.uint32)
+            new_seen = np.array(sorted(new_keys), dtype=np.uint64)
+            if self._loaded is not None and self._deltas + 1 < settings.CORPUS_IDF_MERGE_EVERY:
+                self._write_delta(tokens, frequencies, new_seen)
+            else:
+                merged, merged_frequencies = _merge(recent_vocabulary, recent_frequencies, tokens, frequencies)
+                self._write(*_merge(vocabulary, document_frequencies, merged, merged_frequencies),
+                            np.union1d(np.union1d(seen, recent_seen), new_seen))
+            return len(new_keys)
+
+    def idf(self, tokens) -> np.ndarray:
+        """The smoothed idf of the tokens (the one TfidfVectorizer uses), a token no article has gets the highest
+
+        :param tokens: the tokens
+        :return np.ndarray: the idf of each of them
+        """
+        (vocabulary, document_frequencies, seen), (recent_vocabulary, recent_frequencies, recent_seen) = \
+            self._current()
+        tokens = np.array([token.encode() for token in tokens], dtype=bytes)
+        frequencies = (_frequencies(vocabulary, document_frequencies, tokens)
+                       + _frequencies(recent_vocabulary, recent_frequencies, tokens))
+        return np.log((1 + len(seen) + len(recent_seen)) / (1 + frequencies)) + 1
+
+    def tfidf(self, counts: spmatrix, feature_names) -> spmatrix:
+        """Weights term counts by the corpus idf and normalizes each row, what TfidfVectorizer.fit_transform gives
+        with the corpus' idf instead of the idf of the texts it's fitted on
+
+        :param spmatrix counts: texts x terms, e.g. from CountVectorizer.fit_transform
+        :param feature_names: the term of each column
+        :return spmatrix: texts x terms
+        """
+        return normalize(counts @ diags(self.idf(feature_names)), norm='l2', copy=False).tocsr()
+
+    def _current(self):
+        """The arrays of the latest generation and the merged deltas written since, the arrays only get mapped again
+        when the generation changes and only the deltas that are new get read"""
+        try:
+            with open(os.path.join(self.directory, 'CURRENT')) as current_file:
+                current = current_file.read().split()
+        except OSError:
+            current = []
+        # the generation, and how many deltas it has (none if it's not there, it was written before the deltas)
+        generation = current[0] if current else None
+        deltas = int(current[1]) if len(current) > 1 else 0
+        with self._lock:
+            if generation is not None and generation != self._loaded:
+                path = os.path.join(self.directory, generation)
+                try:
+                    arrays = [_map(os.path.join(path, name))
+                              for name in ('vocabulary.npy', 'document_frequencies.npy', 'seen.npy')]
+                except OSError:
+                    # another process moved on and cleaned it up in between, the next call gets the newer one
+                    logger.warning(f'Corpus idf {generation} went away while it was being loaded')
+                else:
+                    if arrays[0].dtype.kind == 'U':
+                        # written before the vocabulary was utf-8, sorting the encoded tokens keeps their order
+                        arrays[0] = np.char.encode(arrays[0], 'utf-8')
+                    self._vocabulary, self._document_frequencies, self._seen = arrays
+                    self._loaded = generation
+                    self._deltas = 0
+                    self._recent = _EMPTY
+            if generation == self._loaded and deltas > self._deltas:
+                try:
+                    for number in range(self._deltas + 1, deltas + 1):
+                        with np.load(os.path.join(self.directory, generation, f'delta-{number}.npz')) as delta:
+                            tokens, frequencies, seen = delta['tokens'], delta['frequencies'], delta['seen']
+                        recent_vocabulary, recent_frequencies, recent_seen = self._recent
+                        self._recent = (*_merge(recent_vocabulary, recent_frequencies, tokens, frequencies),
+                                        np.union1d(recent_seen, seen))
+                        self._deltas = number
+                except OSError:
+                    logger.warning(f'Corpus idf {generation} went away while its deltas were being loaded')
+            return (self._vocabulary, self._document_frequencies, self._seen), self._recent
+
+    def _write(self, vocabulary: np.ndarray, document_frequencies: np.ndarray, seen: np.ndarray):
+        number = int(self._loaded.rsplit('-', 1)[1]) + 1 if self._loaded else 1
+        generation = f'generation-{number}'
+        path = os.path.join(self.directory, generation)
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'vocabulary.npy'), vocabulary)
+        np.save(os.path.join(path, 'document_frequencies.npy'), document_frequencies)
+        np.save(os.path.join(path, 'seen.npy'), seen)
+        self._point_at(generation)
+        # the one before stays, a process can be loading it right now, the processes that have an older one mapped
+        # keep reading it until they notice CURRENT changed
+        shutil.rmtree(os.path.join(self.directory, f'generation-{number - 2}'), ignore_errors=True)
+        logger.warning(f'Corpus idf {os.path.basename(self.directory)}: {len(seen)} articles, '
+                       f'{len(vocabulary)} tokens')
+
+    def _write_delta(self, tokens: np.ndarray, frequencies: np.ndarray, seen: np.ndarray):
+        number = self._deltas + 1
+        path = os.path.join(self.directory, self._loaded, f'delta-{number}.npz')
+        # savez adds .npz to names that don't end with it
+        temporary = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(temporary, tokens=tokens, frequencies=frequencies, seen=seen)
+        os.replace(temporary, path)
+        self._point_at(f'{self._loaded} {number}')
+
+    def _point_at(self, current: str):
+        temporary = os.path.join(self.directory, f'CURRENT.{os.getpid()}.tmp')
+        with open(temporary, 'w') as current_file:
+            current_file.write(current)
+        os.replace(temporary, os.path.join(self.directory, 'CURRENT'))
+        self._current()
+
+
+_EMPTY = (np.array([], dtype='S1'), np.array([], dtype=np.uint32), np.array([], dtype=np.uint64))
+
+
+def _merge(vocabulary: np.ndarray, document_frequencies: np.ndarray, tokens: np.ndarray,
+           frequencies: np.ndarray) -> (np.ndarray, np.ndarray):
+    """Adds the frequencies of the tokens (sorted, each once) to the document frequencies of the vocabulary"""
+    if not len(vocabulary):
+        return tokens, frequencies
+    merged = np.union1d(vocabulary, tokens)
+    merged_frequencies = np.zeros(len(merged), dtype=np.uint32)
+    merged_frequencies[np.searchsorted(merged, vocabulary)] = document_frequencies
+    merged_frequencies[np.searchsorted(merged, tokens)] += frequencies
+    return merged, merged_frequencies
+
+
+def _frequencies(vocabulary: np.ndarray, document_frequencies: np.ndarray, tokens: np.ndarray) -> np.ndarray:
+    """The document frequency of each of the tokens, 0 for the ones that aren't in the vocabulary"""
+    frequencies = np.zeros(len(tokens))
+    if len(vocabulary) and len(tokens):
+        at = np.minimum(np.searchsorted(vocabulary, tokens), len(vocabulary) - 1)
+        found = vocabulary[at] == tokens
+        frequencies[found] = document_frequencies[at[found]]
+    return frequencies
+
+
+def _map(path: str) -> np.ndarray:
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        # an empty array can't be mapped
+        return np.load(path)
+
+
+def _key(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(' '.join(text.lower().split()).encode(), digest_size=8).digest(), 'big')
+
+
+def _stemmed_analyzer() -> Callable[[str], List[str]]:
+    from text_generation.utilities import stemmed_text
+
+    analyze = TfidfVectorizer().build_analyzer()
+    return lambda text: analyze(stemmed_text(text))
+
+
+_ANALYZERS = {
+    STEMMED: _stemmed_analyzer,
+    WORDS: lambda: TfidfVectorizer(stop_words='english').build_analyzer(),
+}
+
+_stores_lock = threading.Lock()
+# kind -> CorpusIdf
+_stores: Dict[str, CorpusIdf] = {}
+
+
+def get_store(kind: str) -> CorpusIdf:
+    """The process' store for the kind of token, STEMMED or WORDS, it's made the first time it's asked for"""
+    with _stores_lock:
+        if kind not in _stores:
+            _stores[kind] = CorpusIdf(os.path.join(settings.CORPUS_IDF_DIR, kind), _ANALYZERS[kind]())
+        return _stores[kind]
+
+
+# article texts waiting to be counted, see ingest
+_queue = queue.Queue()
+_worker_lock = threading.Lock()
+_worker: Optional[threading.Thread] = None
+
+
+def ingest(texts: Iterable[str]):
+    """Queues the article texts to be added to the stores, unless CORPUS_IDF_ENABLED is off. They get added on the
+    ingest thread, together with whatever else got queued in the meantime, see flush
+
+    :param Iterable[str] texts: the texts of the extracted articles
+    """
+    global _worker
+    if not settings.CORPUS_IDF_ENABLED:
+        return
+    texts = [text for text in texts if text]
+    if not texts:
+        return
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_ingest_queued, name='corpus-idf-ingest', daemon=True)
+            _worker.start()
+    _queue.put(texts)
+
+
+@atexit.register
+def flush():
+    """Waits until every text that was queued by ingest is in the stores"""
+    _queue.join()
+
+
+def _ingest_queued():
+    while True:
+        batches = [_queue.get()]
+        while True:
+            try:
+                batches.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            texts = [text for batch in batches for text in batch]
+            for kind in (STEMMED, WORDS):
+                get_store(kind).add(texts)
+        except Exception:
+            logger.exception(f'Adding {len(batches)} batches of articles to the corpus idf failed')
+        finally:
+            for _ in batches:
+                _queue.task_done()
+
+
+def usable(kind: str) -> Optional[CorpusIdf]:
+    """The store for the kind of token if it has enough articles to be used (CORPUS_IDF_MIN_DOCUMENTS), else None
+
+    :param str kind: STEMMED or WORDS
+    :return CorpusIdf:
+    """
+    if not settings.CORPUS_IDF_ENABLED:
+        return None
+    store = get_store(kind)
+    return store if store.documents >= settings.CORPUS_IDF_MIN_DOCUMENTS else None
@@ -0,0 +1,157 @@
+"""Keeps the content hash (see ContentHash) of what each document's graphs get built from saved in GraphContent, so
+loading a graph can tell whether its snapshot (or the graph kept in memory) is current without reading and hashing all
+of its sentences and triples. What a save or delete changes gets worked out when it happens, while the sentence's
+document and section can still be looked up, and it's added to the saved hashes once the transaction commits. The
+changes come in through the receivers in signals.py (and Sentence.build_triples_bulk), so ones that don't send signals
+(queryset update()) aren't seen, the next rebuild of the graph puts the hash right again."""
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from django.db import transaction
+
+from text_generation.models.triple_graph_snapshot import ContentHash, GraphContent, TripleGraphSnapshot
+
+# what a sentence or triple is in the hashes as before it gets saved, set by remember
+_PREVIOUS = '_graph_content_previous'
+
+
+def content_hash(document_id: int, all_sentences: bool, sentences: Callable[[], List]) -> str:
+    """The saved hash of the sentences and triples the graph gets built from, they're only hashed in full (and the
+    hash saved) when there isn't one yet
+
+    :param int document_id: the document the graph is for
+    :param bool all_sentences: whether the graph is built from all of the sentences or only the intro
+    :param Callable[[], List[Sentence]] sentences: gets the sentences the graph is built from, if they need hashing
+    :return str: hex digest
+    """
+    saved = GraphContent.objects.filter(document_id=document_id, all_sentences=all_sentences).values_list(
+        'content_hash', flat=True).first()
+    if saved is not None:
+        return saved
+    return reset(document_id, all_sentences, sentences())
+
+
+def reset(document_id: int, all_sentences: bool, sentences: List) -> str:
+    """Hashes the sentences and their triples in full, it's saved as the document's hash when the transaction commits
+    (after the changes made in it so far, e.g. by the build that just ran, have gone into the old one)
+
+    :param int document_id: the document the graph is for
+    :param bool all_sentences: whether the graph is built from all of the sentences or only the intro
+    :param List[Sentence] sentences: the sentences the graph is built from
+    :return str: hex digest
+    """
+    value = TripleGraphSnapshot.content_hash_for(sentences)
+    transaction.on_commit(lambda: _save(document_id, all_sentences, value), robust=True)
+    return value
+
+
+def remember(instance):
+    """Before a sentence or triple is saved, keeps what the hashes have for it so saved can take it out
+
+    :param instance: the Sentence or Triple about to be saved
+    """
+    previous = []
+    if instance.pk is not None:
+        old = type(instance).objects.filter(pk=instance.pk).first()
+        if old is not None:
+            previous = _entries([old])
+    setattr(instance, _PREVIOUS, previous)
+
+
+def saved(instance):
+    """
+    :param instance: the Sentence or Triple that was saved
+    """
+    previous = getattr(instance, _PREVIOUS, [])
+    if hasattr(instance, _PREVIOUS):
+        delattr(instance, _PREVIOUS)
+    _change(previous, _entries([instance]))
+
+
+def created(instances: Iterable):
+    """For sentences or triples made with bulk_create, which doesn't send post_save
+
+    :param Iterable instances: the saved sentences or triples
+    """
+    _change([], _entries([instance for instance in instances if instance.pk is not None]))
+
+
+def deleted(instance):
+    """
+    :param instance: the Sentence or Triple that was deleted
+    """
+    _change(_entries([instance]), [])
+
+
+def _entries(instances: List) -> List[Tuple[Tuple[int, bool], tuple]]:
+    """The (document id, all sentences) scopes that each of the sentences or triples is hashed into, with its record,
+    the same sentences as Document._graph_sentences gives"""
+    from text_generation.models.section import Section
+    from text_generation.models.sentence import Sentence
+
+    # sentence id -> document id and section id
+    places = {instance.id: (instance.document_id, instance.section_id)
+              for instance in instances if isinstance(instance, Sentence)}
+    sentence_ids = {instance.sentence_id for instance in instances if not isinstance(instance, Sentence)}
+    sentence_ids.difference_update(places)
+    if sentence_ids:
+        places.update((sentence_id, (document_id, section_id)) for sentence_id, document_id, section_id in
+                      Sentence.objects.filter(pk__in=sentence_ids).values_list('id', 'document_id', 'section_id'))
+    section_ids = {section_id for _, section_id in places.values() if section_id is not None}
+    section_documents = dict(Section.objects.filter(pk__in=section_ids).values_list('id', 'document_id')) \
+        if section_ids else {}
+
+    entries = []
+    for instance in instances:
+        if isinstance(instance, Sentence):
+            place, record = places[instance.id], ContentHash.sentence_record(instance)
+        else:
+            place, record = places.get(instance.sentence_id), ContentHash.triple_record(instance)
+        if place is None:
+            continue
+        document_id, section_id = place
+        scopes = set()
+        if document_id is not None:
+            scopes.add((document_id, True))
+            if section_id is None:
+                scopes.add((document_id, False))
+        if section_documents.get(section_id) is not None:
+            scopes.add((section_documents[section_id], True))
+        entries.extend((scope, record) for scope in scopes)
+    return entries
+
+
+def _change(removed: List[Tuple[Tuple[int, bool], tuple]], added: List[Tuple[Tuple[int, bool], tuple]]):
+    """Adds what changed to the saved hashes once the transaction commits"""
+    changes: Dict[Tuple[int, bool], ContentHash] = defaultdict(ContentHash)
+    for scope, record in removed:
+        changes[scope].remove(record)
+    for scope, record in added:
+        changes[scope].add(record)
+    # e.g. a sentence saved without any change to what the graph uses
+    changes = {scope: change for scope, change in changes.items() if change.value}
+    if changes:
+        transaction.on_commit(lambda: _apply(changes), robust=True)
+
+
+def _apply(changes: Dict[Tuple[int, bool], ContentHash]):
+    for (document_id, all_sentences), change in changes.items():
+        with transaction.atomic():
+            # other processes apply their changes to the same row
+            saved = GraphContent.objects.select_for_update().filter(
+                document_id=document_id, all_sentences=all_sentences).first()
+            if saved is None:
+                # not worked out yet, it gets hashed in full the first time it's needed
+                continue
+            content_hash = ContentHash.from_hexdigest(saved.content_hash)
+            content_hash.merge(change)
+            GraphContent.objects.filter(id=saved.id).update(content_hash=content_hash.hexdigest())
+
+
+def _save(document_id: int, all_sentences: bool, value: str):
+    from text_generation.models.document import Document
+
+    # it could have been deleted since
+    if Document.objects.filter(pk=document_id).exists():
+        GraphContent.objects.update_or_create(document_id=document_id, all_sentences=all_sentences,
+                                              defaults={'content_hash': value})
@@ -0,0 +1,395 @@
+"""Keeps the triple graphs that have been built up to date as their sentences and triples get saved and deleted, so
+an edit only costs the work for the sentences it touched instead of rebuilding the whole graph. The graphs come in
+from Document/Section.build_triple_graph and the changes come in through the receivers in signals.py, once they're
+committed. Sentences that get added without triples get them on the settle thread, not when the graph is read."""
+import copy
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Dict, Optional, Tuple
+
+from django.db import connection
+
+from living_documents_server.settings import TRIPLE_GRAPH_CACHE_SIZE, TRIPLE_GRAPH_SETTLE_SECONDS
+from text_generation.annotators import corpus_idf
+from text_generation.annotators.term_stats import TermStats
+from text_generation.models.triple_graph_snapshot import ContentHash
+from text_generation.utilities import stemmed_text
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT = 'document'
+SECTION = 'section'
+
+
+def document_scope(document_id: int, all_sentences: bool = False) -> tuple:
+    """The scope of a document graph, built from the intro sentences or from all of them (sections included)"""
+    return DOCUMENT, document_id, all_sentences
+
+
+def section_scope(section_id: int) -> tuple:
+    """The scope of a section graph"""
+    return SECTION, section_id, False
+
+
+class TrackedGraph:
+    """A built graph along with what it was built from (the sentences, the triples, the stemmed text of the sentences
+    and the content hash of it all). Every change gets applied to both at the same time."""
+
+    def __init__(self, scope: tuple, graph, stemmed_texts: Dict[int, str] = None):
+        """
+        :param tuple scope: from document_scope or section_scope
+        :param TripleGraph graph: the graph that was just built (or loaded)
+        :param Dict[int, str] stemmed_texts: sentence id -> stemmed text from the tf-idf calculation, if there is one
+        """
+        from text_generation.models.triple import Triple
+
+        self.scope = scope
+        self.graph = graph
+        # held while the graph (or what is tracked about it) changes or gets read, see locked
+        self.lock = threading.RLock()
+        # sentence id -> the sentence object that the graph's nodes hold
+        self.sentences = {}
+        # triple id -> copy of the triple that is in the graph
+        self.triples = {}
+        # sentence id -> stemmed text from the build, until the term stats get made from them
+        self._built_stemmed_texts = dict(stemmed_texts or {})
+        # the term counts the tf-idf scores come from, made the first time a sentence changes
+        self._term_stats = None
+        # sentences that were added without any triples, they get them from the nlp server in settle (on the settle
+        # thread, see _settle_later)
+        self.pending = set()
+        self.content_hash = ContentHash()
+        # sentence id -> the record of it that is in the content hash
+        self._sentence_records = {}
+        # sentence id -> ids of its triples
+        self._sentence_triples = {}
+
+        for sentence in graph.sentences:
+            # the build deletes the sentences that didn't have any triples
+            if sentence.id is not None and sentence.id not in self.sentences:
+                self._track_sentence(sentence)
+        for triple in Triple.objects.filter(sentence_id__in=list(self.sentences)):
+            self._track_triple(triple)
+
+    def triple_saved(self, triple):
+        if triple.id in self.triples:
+            self._untrack_triple(triple.id)
+            self.graph.remove_triple(triple.id)
+        if triple.sentence_id in self.sentences:
+            triple = self._track_triple(triple)
+            self.graph.insert_triple(self.sentences[triple.sentence_id], triple, prune=False)
+
+    def triple_deleted(self, triple_id: int):
+        if triple_id in self.triples:
+            self._untrack_triple(triple_id)
+            self.graph.remove_triple(triple_id)
+
+    def sentence_saved(self, sentence, in_scope: bool, created: bool = False):
+        """
+        :param Sentence sentence: the sentence that was saved
+        :param bool in_scope: whether the sentence belongs in this graph now
+        :param bool created: whether the sentence was just created (so it can't have triples yet)
+        """
+        from text_generation.models.triple import Triple
+
+        if sentence.id not in self.sentences:
+            if in_scope:
+                self._track_sentence(copy.copy(sentence))
+                self._restem(sentence.id)
+                if not created:
+                    # it moved in from somewhere else, so it brings its triples along
+                    for triple in Triple.objects.filter(sentence_id=sentence.id):
+                        self.triple_saved(triple)
+                if not self._sentence_triples[sentence.id]:
+                    self.pending.add(sentence.id)
+            return
+        if not in_scope:
+            self.sentence_deleted(sentence.id)
+            return
+
+        tracked = self.sentences[sentence.id]
+        if tracked.text != sentence.text:
+            # the nodes hold sentences by their text, so its triples come out and go back in under the new text
+            triples = [self.triples[triple_id] for triple_id in self._sentence_triples[sentence.id]]
+            for triple in triples:
+                self.graph.remove_triple(triple.id)
+            self.content_hash.remove(self._sentence_records[sentence.id])
+            tracked = copy.copy(sentence)
+            self.sentences[sentence.id] = tracked
+            self._sentence_records[sentence.id] = ContentHash.sentence_record(tracked)
+            self.content_hash.add(self._sentence_records[sentence.id])
+            self._restem(sentence.id)
+            for triple in triples:
+                self.graph.insert_triple(tracked, triple, prune=False)
+            return
+
+        if tracked is not sentence:
+            # nothing the graph uses changed, but keep the other fields current since the graph saves these objects
+            for field in type(sentence)._meta.concrete_fields:
+                setattr(tracked, field.attname, getattr(sentence, field.attname))
+        record = ContentHash.sentence_record(tracked)
+        if record != self._sentence_records[sentence.id]:
+            self.content_hash.remove(self._sentence_records[sentence.id])
+            self._sentence_records[sentence.id] = record
+            self.content_hash.add(record)
+
+    def sentence_deleted(self, sentence_id: int):
+        if sentence_id not in self.sentences:
+            return
+        for triple_id in list(self._sentence_triples[sentence_id]):
+            self.triple_deleted(triple_id)
+        self.content_hash.remove(self._sentence_records.pop(sentence_id))
+        del self.sentences[sentence_id]
+        del self._sentence_triples[sentence_id]
+        self.pending.discard(sentence_id)
+        self._stats().remove(sentence_id)
+
+    def settle(self):
+        """Gets triples for the sentences that were added without any and drops the ones that still don't have any,
+        the same as a build does"""
+        from text_generation.models.sentence import Sentence
+
+        with self.lock:
+            pending, self.pending = self.pending, set()
+        if not pending:
+            return
+        # no lock is held from here on, the nlp server can take a while and the new triples come back in through
+        # triple_saved like anyone else's. Whoever added them may have built their triples in the meantime
+        sentences = list(Sentence.objects.filter(pk__in=list(pending), triple__isnull=True))
+        Sentence.build_triples_bulk(sentences)
+        for sentence in sentences:
+            if not sentence.triple_set.exists() and not sentence.is_user_defined:
+                logger.warning(f'NO TRIPLE FOUND in non-user defined sentence. DELETING: f{sentence.text}')
+                sentence.delete()
+
+    def _track_sentence(self, sentence):
+        self.sentences[sentence.id] = sentence
+        self._sentence_records[sentence.id] = ContentHash.sentence_record(sentence)
+        self.content_hash.add(self._sentence_records[sentence.id])
+        self._sentence_triples[sentence.id] = set()
+
+    def _track_triple(self, triple):
+        from text_generation.models.triple import Triple
+
+        # a copy, so changes to the caller's object don't change what we think is in the graph
+        triple = Triple(id=triple.id, sentence_id=triple.sentence_id, subject=triple.subject,
+                        relation=triple.relation, object=triple.object, tokens=triple.tokens,
+                        tokens_version=triple.tokens_version)
+        self.triples[triple.id] = triple
+        self._sentence_triples[triple.sentence_id].add(triple.id)
+        self.content_hash.add(ContentHash.triple_record(triple))
+        self.pending.discard(triple.sentence_id)
+        return triple
+
+    def _untrack_triple(self, triple_id: int):
+        triple = self.triples.pop(triple_id)
+        self._sentence_triples[triple.sentence_id].discard(triple_id)
+        self.content_hash.remove(ContentHash.triple_record(triple))
+
+    def tf_idf_scores(self, sentences) -> Optional[Tuple[Dict[int, str], Dict[str, float]]]:
+        """The stemmed texts and tf-idf scores from the term stats, if the graph has exactly these sentences in this
+        order (a token's score depends on the order), so they don't have to be fitted again after an edit
+
+        :param List[Sentence] sentences: the sentences the scores are for
+        :return: sentence id -> stemmed text and token -> score, None if the graph has other sentences
+        """
+        if self.pending or list(self.sentences) != [sentence.id for sentence in sentences]:
+            return None
+        if any(self.sentences[sentence.id].text != sentence.text for sentence in sentences):
+            return None
+        stats = self._stats()
+        return dict(stats.texts), stats.scores()
+
+    @property
+    def stemmed_texts(self) -> Dict[int, str]:
+        """sentence id -> stemmed text of the sentences that have one so far"""
+        if self._term_stats is None:
+            return dict(self._built_stemmed_texts)
+        return dict(self._term_stats.texts)
+
+    def _restem(self, sentence_id: int):
+        self._stats().set(sentence_id, stemmed_text(self.sentences[sentence_id].text))
+
+    def _stats(self) -> TermStats:
+        """The term stats of the sentences, the first time it's called they get made from the sentences (only the ones
+        the build didn't stem get stemmed) and the graph starts getting its tf-idf scores from them. The scores are
+        worked out from the counts when the graph looks them up, so a change only costs the tokens it changes."""
+        if self._term_stats is None:
+            self._term_stats = TermStats(corpus_idf.usable(corpus_idf.STEMMED))
+            for sentence_id, sentence in self.sentences.items():
+                text = self._built_stemmed_texts.get(sentence_id)
+                self._term_stats.set(sentence_id, stemmed_text(sentence.text) if text is None else text)
+            self._built_stemmed_texts = {}
+            self.graph.update_tfidf(self._term_stats.view())
+        return self._term_stats
+
+
+_lock = threading.RLock()
+# scope -> TrackedGraph, least recently used first
+_tracked = OrderedDict()
+
+
+def track(scope: tuple, graph, stemmed_texts: Dict[int, str] = None) -> TrackedGraph:
+    """Starts keeping the graph up to date, it replaces whatever graph was there for the scope
+
+    :param tuple scope: from document_scope or section_scope
+    :param TripleGraph graph: the graph that was just built or loaded
+    :param Dict[int, str] stemmed_texts: sentence id -> stemmed text, if they are around
+    :return TrackedGraph:
+    """
+    with _lock:
+        _tracked.pop(scope, None)
+        tracked = TrackedGraph(scope, graph, stemmed_texts)
+        _tracked[scope] = tracked
+        while len(_tracked) > TRIPLE_GRAPH_CACHE_SIZE:
+            _tracked.popitem(last=False)
+        return tracked
+
+
+def tf_idf_scores(scope: tuple, sentences) -> Optional[Tuple[Dict[int, str], Dict[str, float]]]:
+    """The stemmed texts and tf-idf scores of the sentences from the graph kept for the scope, see
+    TrackedGraph.tf_idf_scores
+
+    :param tuple scope: from document_scope or section_scope
+    :param List[Sentence] sentences: the sentences the scores are for
+    :return: sentence id -> stemmed text and token -> score, None if there isn't a graph with these sentences
+    """
+    with _lock:
+        tracked = _tracked.get(scope)
+    if tracked is None:
+        return None
+    with tracked.lock:
+        return tracked.tf_idf_scores(sentences)
+
+
+def forget(scope: tuple):
+    """Stops keeping the graph for the scope up to date, e.g. because it is about to be rebuilt"""
+    with _lock:
+        _tracked.pop(scope, None)
+
+
+def get(scope: tuple) -> Optional[TrackedGraph]:
+    """The up to date graph for the scope, or None if there isn't one being kept. Sentences that were added without
+    triples aren't in it until the settle thread gets to them (a graph without them is the same graph)
+
+    :param tuple scope: from document_scope or section_scope
+    :return TrackedGraph:
+    """
+    with _lock:
+        tracked = _tracked.get(scope)
+        if tracked is None:
+            return None
+        _tracked.move_to_end(scope)
+        return tracked
+
+
+def locked(graph):
+    """Keeps the graph from changing while the caller reads it (e.g. walks it for tree_data), the saves on other
+    threads change the graphs that are kept up to date
+
+    :param TripleGraph graph: a graph, it doesn't have to be one that is kept
+    :return: a context manager
+    """
+    with _lock:
+        for tracked in _tracked.values():
+            if tracked.graph is graph:
+                return tracked.lock
+    return nullcontext()
+
+
+def clear():
+    with _lock:
+        _tracked.clear()
+
+
+def sentence_saved(sentence, created: bool = False):
+    section_documents = {}
+    for tracked in _all():
+        in_scope = _in_scope(tracked.scope, sentence, section_documents)
+        with tracked.lock:
+            tracked.sentence_saved(sentence, in_scope, created)
+            pending = bool(tracked.pending)
+        if pending:
+            _settle_later(tracked)
+
+
+def sentence_deleted(sentence_id: int):
+    for tracked in _all():
+        with tracked.lock:
+            tracked.sentence_deleted(sentence_id)
+
+
+def triple_saved(triple):
+    for tracked in _all():
+        with tracked.lock:
+            tracked.triple_saved(triple)
+
+
+def triple_deleted(triple_id: int):
+    for tracked in _all():
+        with tracked.lock:
+            tracked.triple_deleted(triple_id)
+
+
+# (when, graph) for the graphs that have sentences waiting for triples, see _settle_later
+_settle_queue = queue.Queue()
+_settler_lock = threading.Lock()
+_settler: Optional[threading.Thread] = None
+
+
+def _settle_later(tracked: TrackedGraph):
+    """Has the settle thread settle the graph in TRIPLE_GRAPH_SETTLE_SECONDS, so the nlp server is never called from
+    a read and the code that added the sentences has time to build their triples itself"""
+    global _settler
+    with _settler_lock:
+        if _settler is None or not _settler.is_alive():
+            _settler = threading.Thread(target=_settle_queued, name='triple-graph-settle', daemon=True)
+            _settler.start()
+    _settle_queue.put((time.monotonic() + TRIPLE_GRAPH_SETTLE_SECONDS, tracked))
+
+
+def _settle_queued():
+    while True:
+        when, tracked = _settle_queue.get()
+        try:
+            time.sleep(max(when - time.monotonic(), 0))
+            tracked.settle()
+        except Exception:
+            logger.exception(f'Settling the graph for {tracked.scope} failed')
+        finally:
+            # this thread isn't a request, so nothing else closes its connection
+            connection.close()
+            _settle_queue.task_done()
+
+
+def _all():
+    """The graphs being kept, the global lock is only held to list them so one slow graph doesn't hold up the rest"""
+    with _lock:
+        return list(_tracked.values())
+
+
+def _in_scope(scope: tuple, sentence, section_documents: Dict[int, int]) -> bool:
+    """Whether the sentence is one the graph for the scope gets built from, the same sentences as the builds use
+
+    :param tuple scope: the scope of the graph
+    :param Sentence sentence: the sentence
+    :param Dict[int, int] section_documents: section id -> document id, filled in as sections get looked up
+    :return bool:
+    """
+    from text_generation.models.section import Section
+
+    kind, pk, all_sentences = scope
+    if kind == SECTION:
+        return sentence.section_id == pk
+    if sentence.document_id == pk and (all_sentences or sentence.section_id is None):
+        return True
+    if all_sentences and sentence.section_id is not None:
+        if sentence.section_id not in section_documents:
+            section_documents[sentence.section_id] = Section.objects.filter(
+                pk=sentence.section_id).values_list('document_id', flat=True).first()
+        return section_documents[sentence.section_id] == pk
+    return False
@@ -0,0 +1,174 @@
+"""Shared client for the Stanford CoreNLP server. It annotates the same way pycorenlp's StanfordCoreNLP does, but:
+
+- the connections are pooled and kept alive instead of opening a new one (plus an extra GET to check the server is up)
+  for every annotation
+- every call has a timeout, so a slow or stuck server raises NLPServerError instead of holding the request forever
+- annotate_many/submit run annotations on a thread pool, at most NLP_CLIENT_MAX_CONCURRENCY at a time, and block once
+  NLP_CLIENT_MAX_QUEUE are waiting, so a big document can't pile up an unbounded backlog
+
+There is one client per server url, use get_client."""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from living_documents_server.settings import NLP_SERVER_URL, NLP_CLIENT_CONNECT_TIMEOUT, NLP_CLIENT_READ_TIMEOUT, \
+    NLP_CLIENT_MAX_CONCURRENCY, NLP_CLIENT_MAX_QUEUE
+from text_generation import replay
+
+logger = logging.getLogger(__name__)
+
+
+class NLPServerError(Exception):
+    """The nlp server couldn't be reached or didn't answer in time"""
+
+
+class NLPClient:
+    # how many of the latest latencies the percentiles in stats are taken over
+    LATENCY_WINDOW = 1000
+
+    def __init__(self, server_url: str, max_concurrency: int = NLP_CLIENT_MAX_CONCURRENCY,
+                 max_queue: int = NLP_CLIENT_MAX_QUEUE, connect_timeout: float = NLP_CLIENT_CONNECT_TIMEOUT,
+                 read_timeout: float = NLP_CLIENT_READ_TIMEOUT):
+        """
+        :param str server_url: where the CoreNLP server is
+        :param int max_concurrency: how many annotations can be going at once, also the size of the connection pool
+        :param int max_queue: how many submitted annotations can be waiting for a thread before submit blocks
+        :param float connect_timeout: seconds to wait for a connection
+        :param float read_timeout: seconds to wait for the annotation once the text has been sent
+        """
+        self.server_url = server_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency, pool_block=True)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='nlp-client')
+        # one slot for every annotation that is running or waiting to run
+        self._slots = threading.BoundedSemaphore(max_concurrency + max_queue)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._in_flight = 0
+        self._requests = 0
+        self._errors = 0
+        self._timeouts = 0
+        self._total_latency = 0.0
+        self._latencies = deque(maxlen=self.LATENCY_WINDOW)
+
+    def annotate(self, text: str, properties: Dict = None, timeout: float = None):
+        """Annotates the text in the calling thread
+
+        :param str text: the text to annotate
+        :param Dict properties: CoreNLP properties, e.g. annotators and outputFormat
+        :param float timeout: seconds to wait for the annotation, instead of the client's read timeout
+        :return: the annotation as a dict if json was asked for and came back, otherwise the text of the response
+        """
+        assert isinstance(text, str)
+        properties = properties or {}
+        return replay.get_store().call('nlp', [text, properties], lambda: self._annotate(text, properties, timeout))
+
+    def _annotate(self, text: str, properties: Dict, timeout: Optional[float]):
+        with self._lock:
+            self._in_flight += 1
+        start = time.perf_counter()
+        try:
+            response = self._session.post(
+                self.server_url, params={'properties': json.dumps(properties)}, data=text.encode(),
+                timeout=self.timeout if timeout is None else (self.timeout[0], timeout))
+        except requests.exceptions.Timeout as error:
+            self._finished(start, timed_out=True)
+            raise NLPServerError(f'NLP server at {self.server_url} did not answer in time') from error
+        except requests.exceptions.RequestException as error:
+            self._finished(start, failed=True)
+            raise NLPServerError(f'Could not reach the NLP server at {self.server_url}: {error}') from error
+        self._finished(start, failed=not response.ok)
+
+        if properties.get('outputFormat') == 'json':
+            try:
+                return response.json()
+            except ValueError:
+                pass
+        return response.text
+
+    def submit(self, text: str, properties: Dict = None, timeout: float = None) -> Future:
+        """Annotates the text on the client's threads, blocks while the queue is full
+
+        :return Future: resolves to what annotate returns
+        """
+        self._slots.acquire()
+        with self._lock:
+            self._queued += 1
+        try:
+            future = self._executor.submit(self._run_queued, text, properties, timeout)
+        except BaseException:
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def annotate_many(self, texts: List[str], properties: Dict = None, timeout: float = None) -> List:
+        """Annotates all of the texts concurrently
+
+        :return List: what annotate returns for each text, in the same order
+        """
+        futures = [self.submit(text, properties, timeout) for text in texts]
+        return [future.result() for future in futures]
+
+    def stats(self) -> Dict[str, float]:
+        """Queue depth, errors and latencies (in seconds) since the client was made"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                'queued': self._queued,
+                'in_flight': self._in_flight,
+                'requests': self._requests,
+                'errors': self._errors,
+                'timeouts': self._timeouts,
+                'mean_latency': self._total_latency / self._requests if self._requests else 0.0,
+                'p50_latency': latencies[len(latencies) // 2] if latencies else 0.0,
+                'p95_latency': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+                'max_latency': latencies[-1] if latencies else 0.0,
+            }
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._session.close()
+
+    def _run_queued(self, text: str, properties: Dict, timeout: float):
+        with self._lock:
+            self._queued -= 1
+        return self.annotate(text, properties, timeout)
+
+    def _finished(self, start: float, failed: bool = False, timed_out: bool = False):
+        latency = time.perf_counter() - start
+        with self._lock:
+            self._in_flight -= 1
+            self._requests += 1
+            self._errors += failed or timed_out
+            self._timeouts += timed_out
+            self._total_latency += latency
+            self._latencies.append(latency)
+        if timed_out or failed:
+            logger.warning(f'NLP server request to {self.server_url} failed after {latency:.2f}s')
+
+
+_clients_lock = threading.Lock()
+# server url -> NLPClient
+_clients = {}
+
+
+def get_client(server_url: str = NLP_SERVER_URL) -> NLPClient:
+    """The shared client for the server, it's made the first time it's asked for"""
+    server_url = server_url.rstrip('/')
+    with _clients_lock:
+        if server_url not in _clients:
+            _clients[server_url] = NLPClient(server_url)
+        return _clients[server_url]
@@ -0,0 +1,150 @@
+"""Term counts for a set of sentences, kept up to date as sentences are added, edited and removed, so the tf-idf scores
+don't have to be refitted over every sentence after an edit. A change only touches the counts of the tokens in the
+sentence it changes, and a token's score is worked out when it's asked for. The scores are the same as tf_idf_scores
+(which fits a TfidfVectorizer) gives for the sentences' stemmed texts in order, with the same corpus idf if there is
+one."""
+import math
+from collections import Counter
+from collections.abc import Mapping
+from typing import Dict, Iterator, Optional
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+# splits a stemmed text into tokens the same way tf_idf_scores does
+_analyze = TfidfVectorizer().build_analyzer()
+
+
+class TermStats:
+    """Term frequencies per sentence and document frequencies per token. A sentence keeps its place in the order when
+    it's edited and goes at the end when it's added, and a token's score comes from the last sentence it's in."""
+
+    def __init__(self, corpus=None):
+        """
+        :param CorpusIdf corpus: the idf comes from it instead of from the sentences, see corpus_idf
+        """
+        self.corpus = corpus
+        # sentence id -> stemmed text
+        self.texts = {}
+        # sentence id -> token -> count
+        self._term_frequencies = {}
+        # token -> sentence id -> count, the sentences the token is in
+        self._postings = {}
+        # token -> the sentence the token's score comes from
+        self._last = {}
+        # sentence id -> place in the order
+        self._positions = {}
+        self._next_position = 0
+
+    def __len__(self) -> int:
+        return len(self._term_frequencies)
+
+    def __contains__(self, sentence_id: int) -> bool:
+        return sentence_id in self._term_frequencies
+
+    def set(self, sentence_id: int, stemmed_text: str):
+        """Adds the sentence, or changes its text if it's there already
+
+        :param int sentence_id: the id of the sentence
+        :param str stemmed_text: its stemmed text, see stemmed_text
+        """
+        if sentence_id not in self._positions:
+            self._positions[sentence_id] = self._next_position
+            self._next_position += 1
+        old = self._term_frequencies.get(sentence_id, {})
+        new = Counter(_analyze(stemmed_text))
+        self.texts[sentence_id] = stemmed_text
+        self._term_frequencies[sentence_id] = new
+        for token in old.keys() - new.keys():
+            self._drop_posting(token, sentence_id)
+        for token, count in new.items():
+            self._postings.setdefault(token, {})[sentence_id] = count
+            last = self._last.get(token)
+            if last is None or self._positions[sentence_id] > self._positions[last]:
+                self._last[token] = sentence_id
+
+    def remove(self, sentence_id: int):
+        """Takes the sentence out, nothing happens if it isn't there
+
+        :param int sentence_id: the id of the sentence
+        """
+        if sentence_id not in self._term_frequencies:
+            return
+        for token in self._term_frequencies.pop(sentence_id):
+            self._drop_posting(token, sentence_id)
+        del self.texts[sentence_id]
+        del self._positions[sentence_id]
+
+    def idf(self, token: str) -> float:
+        """The smoothed inverse document frequency, the one TfidfVectorizer uses by default
+
+        :param str token: the token
+        :return float:
+        """
+        if self.corpus is not None:
+            return float(self.corpus.idf([token])[0])
+        return math.log((1 + len(self)) / (1 + len(self._postings[token]))) + 1
+
+    def score(self, token: str) -> Optional[float]:
+        """The tf-idf score of the token in the last sentence it's in, normalized over that sentence's tokens
+
+        :param str token: the token
+        :return float: the score, None if no sentence has the token
+        """
+        sentence_id = self._last.get(token)
+        if sentence_id is None:
+            return None
+        term_frequencies = self._term_frequencies[sentence_id]
+        if self.corpus is not None:
+            # all of the sentence's terms in one lookup
+            weights = dict(zip(term_frequencies, np.fromiter(term_frequencies.values(), float)
+                               * self.corpus.idf(list(term_frequencies))))
+        else:
+            weights = {term: count * self.idf(term) for term, count in term_frequencies.items()}
+        return weights[token] / math.sqrt(sum(weight * weight for weight in weights.values()))
+
+    def scores(self) -> Dict[str, float]:
+        """Every token's score, this is the same as tf_idf_scores over the stemmed texts in order
+
+        :return Dict[str, float]: token -> score
+        """
+        return {token: self.score(token) for token in self._last}
+
+    def view(self) -> 'TermScores':
+        """The scores, worked out as they get looked up, for TripleGraph.update_tfidf
+
+        :return TermScores:
+        """
+        return TermScores(self)
+
+    def _drop_posting(self, token: str, sentence_id: int):
+        postings = self._postings[token]
+        del postings[sentence_id]
+        if not postings:
+            del self._postings[token]
+            del self._last[token]
+        elif self._last[token] == sentence_id:
+            self._last[token] = max(postings, key=self._positions.__getitem__)
+
+
+class TermScores(Mapping):
+    """token -> score that only works out the scores that get looked up, the tokens a graph filters on are a small
+    part of all of them. It always has the current scores of the TermStats it's made from."""
+
+    def __init__(self, stats: TermStats):
+        self._stats = stats
+
+    def __contains__(self, token) -> bool:
+        return token in self._stats._last
+
+    def __getitem__(self, token: str) -> float:
+        score = self._stats.score(token)
+        if score is None:
+            raise KeyError(token)
+        return score
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._stats._last))
+
+    def __len__(self) -> int:
+        return len(self._stats._last)
@@ -1,7 +1,15 @@
+import logging
+import os
+import random
+import time
+from typing import List
+
 from text_generation.annotators.triple_graph import TripleGraph, Node, OBJECT, RELATION
 from text_generation.models.document import Document
 from text_generation.models.sentence import Sentence
-from unittest import TestCase
+from text_generation.models.triple import Triple
+from text_generation.utilities import process_text
+from unittest import TestCase, skipUnless
 
 
 class TestNode(TestCase):
@@ -74,7 +82,7 @@ class TestNode(TestCase):
 
     def test_add_sentences(self):
         mary_hadlamb_node = Node('Mari', OBJECT, self.sentence)
-        cow_sentence = Sentence('Mary had a cow.')
+        cow_sentence = Sentence(text='Mary had a cow.')
         mary_hadcow_node = Node('Mari', OBJECT, cow_sentence)
 
         self.mary_node.add_child(mary_hadlamb_node)
@@ -85,7 +93,7 @@ class TestNode(TestCase):
         self.mary_node.add_child(Node('had', RELATION, self.sentence))
         self.assertEqual(len(self.mary_node.children), 1)
 
-        cow_sentence = Sentence('Mary had a cow.')
+        cow_sentence = Sentence(text='Mary had a cow.')
         second_mary = Node('Mary', OBJECT, cow_sentence)
 
         second_had = Node('had', RELATION, self.sentence)
@@ -1114,3 +1122,124 @@ class TestTripleGraph(TestCase):
         # print([sentence.text for sentence in document.graph.roots[0].sentences])
 
         # print(document.order_sentences())
+
+
+class TestTripleGraphScaling(TestCase):
+    """Benchmarks for building big graphs, these don't touch the database or the nlp server, the sentences and
+    triples are never saved."""
+
+    def setUp(self):
+        # insert_triple logs a few lines for every triple
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    @staticmethod
+    def _word(prefix: str, i: int) -> str:
+        """Makes a made up alphabetic word so the stemmer leaves it mostly alone"""
+        letters = ''
+        i += 26 * 26
+        while i:
+            letters = chr(97 + i % 26) + letters
+            i //= 26
+        return prefix + letters
+
+    def _build_seconds(self, number_of_triples: int) -> float:
+        """Builds a graph out of random triples and times the inserts. Subjects, modifiers, relations and objects come
+        from separate vocabularies that grow with the number of triples, so this measures the token lookups and not
+        the reachability checks that happen when roots get merged.
+        """
+        rand = random.Random(0)
+        vocabulary_size = number_of_triples // 4
+        subjects = [self._word('s', i) for i in range(vocabulary_size)]
+        modifiers = [self._word('m', i) for i in range(vocabulary_size)]
+        relations = [self._word('r', i) for i in range(vocabulary_size)]
+        objects = [self._word('o', i) for i in range(vocabulary_size)]
+        tf_idf_scores = {token['stemmed_word']: 0.5
+                         for word in subjects + modifiers + relations + objects
+                         for token in process_text(word)}
+
+        triples = []
+        for i in range(number_of_triples):
+            sentence = Sentence(text=f'Sentence {i}.', position=i)
+            triple = Triple(sentence=sentence,
+                            subject=f'{rand.choice(subjects)} {rand.choice(modifiers)}',
+                            relation=rand.choice(relations),
+                            object=rand.choice(objects))
+            triples.append((sentence, triple))
+
+        graph = TripleGraph([], tf_idf_scores)
+        start = time.perf_counter()
+        for sentence, triple in triples:
+            graph.insert_triple(sentence, triple)
+        return time.perf_counter() - start
+
+    @skipUnless(os.environ.get('RUN_BENCHMARKS'), 'timing benchmark, set RUN_BENCHMARKS to run it')
+    def test_build_scales_linearly(self):
+        small = self._build_seconds(5000)
+        large = self._build_seconds(20000)
+        print(f'\nbuilt 5000 triples in {small:.2f}s, 20000 triples in {large:.2f}s')
+        # 4x the triples, a quadratic build would take ~16x as long
+        self.assertLess(large / small, 8)
+
+    def _hub_insert_seconds(self, number_of_children: int, number_of_inserts: int = 20000) -> float:
+        """Gives a hub node (think a common subject) a lot of children and times adding to it and checking it"""
+        sentence = Sentence(text='The hub had a lot of children.', position=0)
+        hub = Node('hub', OBJECT, sentence, 'hub')
+        for i in range(number_of_children):
+            hub.add_child(Node(self._word('c', i), OBJECT, sentence, 'child'))
+
+        probes = [Node(self._word('c', i % number_of_children), OBJECT, sentence, 'child')
+                  for i in range(number_of_inserts)]
+        start = time.perf_counter()
+        for probe in probes:
+            hub.add_child(probe)
+            hub.is_child_sentence(probe, sentence)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(len(hub.children), number_of_children)
+        return elapsed
+
+    @skipUnless(os.environ.get('RUN_BENCHMARKS'), 'timing benchmark, set RUN_BENCHMARKS to run it')
+    def test_hub_node_inserts(self):
+        small = self._hub_insert_seconds(10)
+        large = self._hub_insert_seconds(5000)
+        print(f'\n20000 inserts into a hub with 10 children took {small:.3f}s, with 5000 children {large:.3f}s')
+        # 500x the children, a scan of the children on every insert would be way more than this
+        self.assertLess(large / small, 5)
+
+    def _chain_graph(self, depth: int) -> (TripleGraph, List[Node], List[Sentence]):
+        """A graph that is one long chain of nodes, there is a new sentence every 1000 nodes"""
+        sentences = [Sentence(text=f'Sentence number {i}.') for i in range((depth + 999) // 1000)]
+        nodes = [Node(self._word('n', i), OBJECT, sentences[i // 1000], 'word') for i in range(depth)]
+        for parent, child in zip(nodes, nodes[1:]):
+            parent.add_child(child)
+        graph = TripleGraph([], {})
+        graph._add_root(nodes[0])
+        return graph, nodes, sentences
+
+    def test_deep_chain_walks(self):
+        """A 100k node chain is way past the recursion limit, every walk over the graph has to get through it"""
+        depth = 100000
+        graph, nodes, sentences = self._chain_graph(depth)
+
+        start = time.perf_counter()
+        self.assertEqual(sum(1 for _ in graph.iter_nodes()), depth)
+        self.assertTrue(graph._is_reachable(nodes[-1]))
+        self.assertEqual(graph.sentence_ordering_output(), sentences)
+        self.assertEqual([sentence.position for sentence in sentences], list(range(len(sentences))))
+
+        tree_depth = 0
+        entry = graph.tree_data()[0]
+        while entry['children']:
+            entry = entry['children'][0]
+            tree_depth += 1
+        self.assertEqual(tree_depth, depth - 1)
+        print(f'\nwalked a {depth} node chain every way in {time.perf_counter() - start:.2f}s')
+
+    def test_deep_chain_str(self):
+        # the prefix grows with the level, so the string is quadratic in the depth, keep this one smaller
+        depth = 5000
+        graph, _, _ = self._chain_graph(depth)
+        self.assertEqual(str(graph).count('\n-'), depth - 1)
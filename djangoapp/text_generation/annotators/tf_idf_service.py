@@ -0,0 +1,151 @@
+"""The tf-idf scores of the sentences a document or section builds its triple graph from. They only depend on the texts
+of the sentences (and their order), so they are kept under a fingerprint of those (and of the text processing) and only
+calculated again when the sentences change. The scores are kept in memory (the TF_IDF_CACHE_MEMORY_SIZE most recently
+used) and in the TfIdfScores table (the TF_IDF_CACHE_SIZE most recently used, trimmed every TF_IDF_CACHE_PRUNE_EVERY
+saves), so they outlive the request and the process."""
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from django.utils import timezone
+
+from living_documents_server.settings import (TF_IDF_CACHE_MEMORY_SIZE, TF_IDF_CACHE_PRUNE_EVERY, TF_IDF_CACHE_SIZE,
+                                              TF_IDF_CACHE_TOUCH_SECONDS)
+from text_generation.utilities import TOKENS_VERSION, stemmed_texts, tf_idf_scores
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+# fingerprint -> {'stemmed_texts': [...], 'scores': {...}}, least recently used first
+_memory = OrderedDict()
+# fingerprint -> when the last use of the scores in memory was saved in the table (time.monotonic)
+_touched = {}
+_counts = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'evictions': 0}
+# scores saved since the table was last trimmed
+_unpruned = 0
+
+
+def fingerprint(texts: List[str]) -> str:
+    """The hash of the sentence texts in order
+
+    :param List[str] texts: the texts of the sentences
+    :return str: hex digest
+    """
+    return hashlib.sha256(json.dumps(texts).encode()).hexdigest()
+
+
+def scores_for(sentences) -> Tuple[Dict[int, str], Dict[str, float]]:
+    """The stemmed texts and tf-idf scores of the sentences, calculated only if these sentences (by their texts) don't
+    have them already
+
+    :param sentences: the sentences, in the order the scores get calculated in (a later sentence's score for a token
+        wins, see tf_idf_scores)
+    :return: sentence id -> stemmed text, and token -> score
+    """
+    from text_generation.models.tf_idf_scores import TfIdfScores
+
+    from text_generation.annotators import corpus_idf
+
+    sentences = list(sentences)
+    corpus = corpus_idf.usable(corpus_idf.STEMMED)
+    texts = [sentence.text for sentence in sentences]
+    # the stemmed texts change with the text processing, and scores from the corpus idf change as articles get added
+    # to it (enough to matter once there are a lot more)
+    key = fingerprint(texts + [f'tokens {TOKENS_VERSION}']
+                      + ([] if corpus is None else [f'corpus idf {corpus.version}']))
+    touch = False
+    with _lock:
+        entry = _memory.get(key)
+        if entry is not None:
+            _memory.move_to_end(key)
+            _counts['memory_hits'] += 1
+            # so the table doesn't evict scores that keep getting used from memory
+            touch = time.monotonic() - _touched.get(key, 0) >= TF_IDF_CACHE_TOUCH_SECONDS
+            if touch:
+                _touched[key] = time.monotonic()
+    if touch:
+        TfIdfScores.objects.filter(key=key).update(last_used=timezone.now())
+    if entry is None:
+        saved = TfIdfScores.objects.filter(key=key).first()
+        if saved is not None:
+            entry = saved.load()
+            TfIdfScores.objects.filter(id=saved.id).update(last_used=timezone.now())
+            with _lock:
+                _remember(key, entry)
+                _counts['db_hits'] += 1
+    if entry is None:
+        stemmed = stemmed_texts(texts)
+        entry = {'stemmed_texts': stemmed, 'scores': tf_idf_scores(stemmed, corpus) if stemmed else {}}
+        _store(key, entry)
+        with _lock:
+            _counts['misses'] += 1
+    by_id = {sentence.id: text for sentence, text in zip(sentences, entry['stemmed_texts'])}
+    return by_id, dict(entry['scores'])
+
+
+def stats() -> Dict[str, int]:
+    """Hit, miss and eviction counts since the process started (or since clear)"""
+    with _lock:
+        counts = dict(_counts)
+        counts['hits'] = counts['memory_hits'] + counts['db_hits']
+        counts['in_memory'] = len(_memory)
+        return counts
+
+
+def clear(persistent: bool = False):
+    """Empties the in memory cache and zeroes the counts
+
+    :param bool persistent: also empty the TfIdfScores table
+    """
+    from text_generation.models.tf_idf_scores import TfIdfScores
+
+    global _unpruned
+    with _lock:
+        _memory.clear()
+        _touched.clear()
+        for name in _counts:
+            _counts[name] = 0
+        _unpruned = 0
+    if persistent:
+        TfIdfScores.objects.all().delete()
+
+
+def prune():
+    """Evicts the least recently used scores past TF_IDF_CACHE_SIZE from the table"""
+    from text_generation.models.tf_idf_scores import TfIdfScores
+
+    extra = TfIdfScores.objects.count() - TF_IDF_CACHE_SIZE
+    if extra > 0:
+        evicted = list(TfIdfScores.objects.order_by('last_used', 'id').values_list('id', flat=True)[:extra])
+        TfIdfScores.objects.filter(id__in=evicted).delete()
+        with _lock:
+            _counts['evictions'] += len(evicted)
+
+
+def _store(key: str, entry: Dict):
+    from text_generation.models.tf_idf_scores import TfIdfScores
+
+    global _unpruned
+    with _lock:
+        _remember(key, entry)
+    TfIdfScores.objects.bulk_create([TfIdfScores(key=key, data=TfIdfScores.pack(entry), last_used=timezone.now())],
+                                    ignore_conflicts=True)
+    with _lock:
+        _unpruned += 1
+        if _unpruned < TF_IDF_CACHE_PRUNE_EVERY:
+            return
+        _unpruned = 0
+    prune()
+
+
+def _remember(key: str, entry: Dict):
+    _memory[key] = entry
+    _memory.move_to_end(key)
+    _touched[key] = time.monotonic()
+    while len(_memory) > TF_IDF_CACHE_MEMORY_SIZE:
+        evicted, _ = _memory.popitem(last=False)
+        _touched.pop(evicted, None)
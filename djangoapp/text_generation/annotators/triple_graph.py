@@ -1,11 +1,11 @@
-from typing import List, Dict, Any
+from collections import Counter
+from typing import List, Dict, Any, Tuple
 
-from pycorenlp import StanfordCoreNLP
 import logging, datetime
 
 from text_generation.models.sentence import Sentence
 from text_generation.models.triple import Triple
-from text_generation.utilities import process_text
+from text_generation.annotators.nlp_client import get_client
 
 from living_documents_server.settings import NLP_SERVER_URL
 
@@ -16,6 +16,69 @@ OBJECT = 'OBJECT'
 logger = logging.getLogger(__name__)
 
 
+class _Edge:
+    """The edge from a node to one of its children, it holds the child that is actually in the graph"""
+    __slots__ = ('node', 'weight')
+
+    def __init__(self, node: 'Node', weight: int = 1):
+        self.node = node
+        self.weight = weight
+
+
+class ChildEdges:
+    """The children of a node. It works like a dict of child node -> edge weight, but a node that only looks like the
+    child (same token and speech type) gets you both the weight and the child that is actually in the graph with a
+    single hashed lookup.
+    """
+    __slots__ = ('_edges',)
+
+    def __init__(self):
+        self._edges = {}
+
+    def __contains__(self, node: 'Node') -> bool:
+        return node in self._edges
+
+    def __iter__(self):
+        return iter(self._edges)
+
+    def __reversed__(self):
+        return reversed(self._edges)
+
+    def __len__(self) -> int:
+        return len(self._edges)
+
+    def __getitem__(self, node: 'Node') -> int:
+        return self._edges[node].weight
+
+    def items(self):
+        """(child, weight) pairs, like dict.items()"""
+        return ((edge.node, edge.weight) for edge in self._edges.values())
+
+    def get_edge(self, node: 'Node') -> _Edge:
+        """Gets the edge to the child that matches the node, or None if there isn't one"""
+        return self._edges.get(node)
+
+    def get_node(self, node: 'Node') -> 'Node':
+        """Gets the child in the graph that matches the node, or None if there isn't one"""
+        edge = self._edges.get(node)
+        if edge is None:
+            return None
+        return edge.node
+
+    def add(self, node: 'Node', weight: int = 1) -> _Edge:
+        """Adds a new child, use get_edge first if it might already be here"""
+        edge = _Edge(node, weight)
+        self._edges[node] = edge
+        node.parent_count += 1
+        return edge
+
+    def pop(self, node: 'Node') -> 'Node':
+        """Removes the child that matches the node and returns the child that was in the graph"""
+        child = self._edges.pop(node).node
+        child.parent_count -= 1
+        return child
+
+
 class Node:
     """This is the node that is used to construct the TripleGraph, each node has three types of children
         subjects, objects, relations. Use the RELATION, OBJECT global variables to specify which
@@ -24,21 +87,25 @@ class Node:
 
     # all of the sentences that this token has been involved in
 
-    def __init__(self, token: str, speech_type: str, sentence, first_actual_word):
+    def __init__(self, token: str, speech_type: str, sentence, first_actual_word=None):
         """
         :param str token: the token/stemmed word dict that the node represents
         :param str speech_type: the type of speech that the node is (use RELATION, or OBJECT global variables)
         :param Sentence sentence: the sentence that this token came from
+        :param str first_actual_word: the word before it was stemmed, leave it out for nodes only used for lookups
         """
         self.token = token
         self.sentences = set()
         self.actual_words_b4_stemmer = set()
         self.sentences.add(sentence)
-        self.actual_words_b4_stemmer.add(first_actual_word)
+        if first_actual_word is not None:
+            self.actual_words_b4_stemmer.add(first_actual_word)
         # use the RELATION, or OBJECT global variables
         self.speech_type = speech_type
-        # child dictionary with edges as values and nodes as keys
-        self.children = {}
+        # child nodes with the edge weights
+        self.children = ChildEdges()
+        # how many nodes have this one as a child
+        self.parent_count = 0
         self.color = 0
 
     def __hash__(self):
@@ -67,14 +134,15 @@ class Node:
         :param Node child: the node to add
         :return: the Node that is in the actually in the tree
         """
-        if child in self.children:
-            self.children[child] += 1
-            tree_node = self.get_child(child)
+        edge = self.children.get_edge(child)
+        if edge is not None:
+            edge.weight += 1
+            tree_node = edge.node
             tree_node.sentences.update(child.sentences)
             tree_node.actual_words_b4_stemmer.update(child.actual_words_b4_stemmer)
             return tree_node
         else:
-            self.children[child] = 1
+            self.children.add(child)
             return child
 
     def delete_sentence(self, del_sentence) -> 'bool':
@@ -96,8 +164,9 @@ class Node:
 
     def delete_child(self, child: 'Node', child_sentence) -> 'bool':
         if self.is_child_sentence(child, child_sentence):
-            if self.children[child] > 1:
-                self.children[child] -= 1
+            edge = self.children.get_edge(child)
+            if edge.weight > 1:
+                edge.weight -= 1
                 return False
             else:
                 self.children.pop(child)
@@ -105,17 +174,15 @@ class Node:
         raise ValueError("child not exists")
 
     def is_child_sentence(self, child: 'Node', child_sentence) -> bool:
-        if child in self.children:
-            tree_node = self.get_child(child)
-            if child_sentence in tree_node.sentences:
-                return True
+        tree_node = self.children.get_node(child)
+        if tree_node is not None and child_sentence in tree_node.sentences:
+            return True
         return False
 
     def is_child_actualWord(self, child: 'Node', child_actualWord) -> bool:
-        if child in self.children:
-            tree_node = self.get_child(child)
-            if child_actualWord in tree_node.actual_words_b4_stemmer:
-                return True
+        tree_node = self.children.get_node(child)
+        if tree_node is not None and child_actualWord in tree_node.actual_words_b4_stemmer:
+            return True
         return False
 
     def get_child(self, item: 'Node') -> 'Node':
@@ -124,13 +191,7 @@ class Node:
         :param Node item: the node with the values you are looking for
         :return: the node in the graph or None if it isn't in the tree
         """
-        child_nodes = list(self.children.keys())
-        # filter the collection and return it
-        matching = list(filter(lambda x: x == item, child_nodes))
-        if matching:
-            return matching[0]
-        else:
-            return None
+        return self.children.get_node(item)
 
     def merge(self, node: 'Node') -> 'Node':
         """Takes a similar node and merges it with the one in the tree
@@ -174,6 +235,9 @@ class _NetworkXNode:
 class TripleGraph:
     """This is the graph of all of the triples sitting on the sentences"""
 
+    # bump this when the snapshot layout (or what goes into building a graph) changes, old snapshots get rebuilt
+    SNAPSHOT_VERSION = 2
+
     def __init__(self,
                  sentences,
                  tfidf_scores: Dict = {str: float},
@@ -195,13 +259,13 @@ class TripleGraph:
         logger.warning(
             '{}: Connecting to ' + NLP_SERVER_URL + " ".format(
                 datetime.datetime.now()))
-        self._nlp_server = StanfordCoreNLP(NLP_SERVER_URL)
+        self._nlp_server = get_client()
         logger.warning("after NLP server is set")
         self._min_cut = min_cut
         self._max_cut = max_cut
         self._tfidf_scores = tfidf_scores
-        # self._token_lookup = {str: Node}
-        self._token_lookup = []
+        # token -> Node, holds at most one node per token
+        self._token_lookup = {}
         self._build_graph()
         self._equivalent_colors = []
         # self._update_tfidf = False
@@ -210,35 +274,68 @@ class TripleGraph:
         """Internal function that inserts all of the nodes for initial list of sentences"""
         self.tokens = {str: Node}
         self.roots = []
+        # how many times each node shows up in roots, so membership checks don't scan the list
+        self._root_counts = Counter()
+        # triple id -> (sentence, the nodes the triple went through), so a saved triple can be taken back out exactly
+        self._triple_paths = {}
+        # sentence -> ids of its triples in _triple_paths
+        self._sentence_triples = {}
         logger.warning("in internal build-triple graph")
         # logger.warning("self.sentences")
         # logger.warning(self.sentences)
-        for sentence in self.sentences:
+        sentences = list(self.sentences)
+        triples = self._triples_by_sentence(sentences)
+        # only build for the sentences that don't already have triples, all in one go
+        missing = [sentence for sentence in sentences if not triples.get(sentence.id)]
+        if missing:
+            logger.warning(f"about to build triples for {len(missing)} sentences")
+            Sentence.build_triples_bulk(missing)
+            triples.update(self._triples_by_sentence(missing))
+
+        for sentence in sentences:
             logger.warning("for sentence in graph sentences")
-            # only build if sentence doesn't already have triples
-            if len(sentence.triple_set.all()) == 0:
-                logger.warning("about to build triples with each sentence")
-                sentence.build_triples()
             # if it still doesn't have any triples from openie,
             # then it is probably a bogus sentence and we can delete it
-            if len(sentence.triple_set.all()) == 0:
+            if not triples.get(sentence.id):
                 if not sentence.is_user_defined:
                     logger.warning(f'NO TRIPLE FOUND in non-user defined sentence. DELETING: f{sentence.text}')
                     sentence.delete()
             # but if it does have a triple, then insert it
             else:
                 logger.warning("in else block to insert")
-                for triple in sentence.triple_set.all():
+                for triple in triples[sentence.id]:
                     self.insert_triple(sentence, triple)
         logger.warning("done with internal build-triple graph")
 
-    def insert_triple(self, sentence, triple: Triple) -> (Node, Node, Node):
+    @staticmethod
+    def _triples_by_sentence(sentences) -> Dict[int, List[Triple]]:
+        """Gets the triples for all of the sentences with one query
+
+        :param List[Sentence] sentences:
+        :return Dict[int, List[Triple]]: sentence id -> its triples
+        """
+        triples = {}
+        sentence_ids = [sentence.id for sentence in sentences if sentence.id is not None]
+        stale = []
+        for triple in Triple.objects.filter(sentence_id__in=sentence_ids).order_by('id'):
+            triples.setdefault(triple.sentence_id, []).append(triple)
+            if not triple.tokens_current():
+                stale.append(triple)
+        if stale:
+            # saved before they were tokenized (or with other text processing), so the next build can skip them
+            for triple in stale:
+                triple.process_tokens()
+            Triple.objects.bulk_update(stale, ['tokens', 'tokens_version'])
+        return triples
+
+    def insert_triple(self, sentence, triple: Triple, prune: bool = True) -> (Node, Node, Node):
         """Aside from initializing the graph, this is the only place you should be calling externally. This function
         takes a triple and sentence and inserts it into the graph, it handles all of the merging and what not inside
         this function if a new connection is made.
 
         :param Sentence sentence: The sentence that the triple belongs to
         :param Dict triple: The triple (generated by Document object)
+        :param bool prune: delete the triple (and the sentence if it was its last one) when it gets filtered out
         :return Node: returns the root subject node
         """
         # this should return one or no items, if it is no items then it was a stop word or something
@@ -248,27 +345,32 @@ class TripleGraph:
 
         # filter the subject and object by tf-idf (not relation)
         logger.warning("in insert-triple")
-        processed_subject = self._process_triple_element(triple.subject)
+        processed_subject, processed_relation, processed_object = self._triple_tokens(triple)
         logger.warning("processed_subject")
         # logger.warning(processed_subject)
-        processed_relation = self._process_triple_element(
-            triple.relation, False, False)
         logger.warning("processed_relation")
         # logger.warning(processed_relation)
-        processed_object = self._process_triple_element(triple.object)
         logger.warning("processed_object")
         # logger.warning(processed_object)
         #  if processed_subject and processed_object:
 
+        if triple.id in self._triple_paths:
+            # it is already in here, put it back in fresh
+            self.remove_triple(triple.id)
+
         if processed_subject and processed_object:
+            path = []
             subject_node = self._insert_triple_nodes(
                 processed_subject, processed_relation, processed_object,
-                sentence)
+                sentence, path)
+            if triple.id is not None:
+                self._triple_paths[triple.id] = (sentence, path)
+                self._sentence_triples.setdefault(sentence, set()).add(triple.id)
 
             return subject_node
         # if the filtering takes out the sentence, it is *probably* a bogus sentence, we could tune this if we find
         # that we are filtering too many sentences out
-        else:
+        elif prune:
             logger.warning(f'DELETING THE TRIPLE:\n{triple}\n{sentence.text}')
             # wipe out the filtered triple
             triple.delete()
@@ -277,20 +379,155 @@ class TripleGraph:
                 logger.warning(f'ALL TRIPLES DELETED, DELETING SENTENCE:\n{sentence.text}')
                 sentence.delete()
 
+    def to_snapshot(self) -> Dict:
+        """Everything needed to put the graph back together without rebuilding it, as json friendly types. Sentences
+        are stored by id, so only saved sentences make it into the snapshot.
+
+        :return Dict: the snapshot, see from_snapshot
+        """
+        # nodes are numbered by identity, relation nodes with the same token are different nodes
+        index = {}
+        nodes = []
+        to_number = []
+
+        def number(node: Node) -> int:
+            if id(node) not in index:
+                index[id(node)] = len(nodes)
+                nodes.append(node)
+                to_number.append(node)
+            return index[id(node)]
+
+        roots = [number(root) for root in self.roots]
+        lookup = {token: number(node) for token, node in self._token_lookup.items()}
+        paths = [[triple_id, sentence.id, [number(node) for node in path]]
+                 for triple_id, (sentence, path) in self._triple_paths.items() if sentence.id is not None]
+        serialized = {}
+        while to_number:
+            node = to_number.pop()
+            edges = [[number(child), weight] for child, weight in node.children.items()]
+            serialized[index[id(node)]] = [
+                node.token,
+                node.speech_type,
+                sorted(sentence.id for sentence in node.sentences if sentence.id is not None),
+                sorted(node.actual_words_b4_stemmer),
+                edges,
+            ]
+
+        return {
+            'version': self.SNAPSHOT_VERSION,
+            'nodes': [serialized[i] for i in range(len(nodes))],
+            'roots': roots,
+            'lookup': lookup,
+            'paths': paths,
+            'tfidf_scores': dict(self._tfidf_scores),
+            'min_cut': self._min_cut,
+            'max_cut': self._max_cut,
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Dict, sentences) -> 'TripleGraph':
+        """Puts a graph back together from to_snapshot, this doesn't touch the triples or the nlp server
+
+        :param Dict snapshot: from to_snapshot
+        :param List[Sentence] sentences: the sentences the graph was built from, nodes get these sentence objects
+        :return TripleGraph:
+        """
+        if snapshot.get('version') != cls.SNAPSHOT_VERSION:
+            raise ValueError(f"can't load a version {snapshot.get('version')} triple graph snapshot")
+
+        graph = cls.__new__(cls)
+        graph.sentences = sentences
+        graph._nlp_server = get_client()
+        graph._min_cut = snapshot['min_cut']
+        graph._max_cut = snapshot['max_cut']
+        graph._tfidf_scores = snapshot['tfidf_scores']
+        graph._equivalent_colors = []
+        graph.tokens = {str: Node}
+
+        sentences_by_id = {sentence.id: sentence for sentence in sentences}
+        nodes = []
+        for token, speech_type, sentence_ids, actual_words, _ in snapshot['nodes']:
+            node = Node(token, speech_type, None)
+            node.sentences = {sentences_by_id[i] for i in sentence_ids if i in sentences_by_id}
+            node.actual_words_b4_stemmer = set(actual_words)
+            nodes.append(node)
+        for node, serialized in zip(nodes, snapshot['nodes']):
+            for child_index, weight in serialized[4]:
+                node.children.add(nodes[child_index], weight)
+
+        graph.roots = []
+        graph._root_counts = Counter()
+        for root_index in snapshot['roots']:
+            graph._add_root(nodes[root_index])
+        graph._token_lookup = {token: nodes[i] for token, i in snapshot['lookup'].items()}
+        graph._triple_paths = {}
+        graph._sentence_triples = {}
+        for triple_id, sentence_id, path in snapshot['paths']:
+            if sentence_id in sentences_by_id:
+                sentence = sentences_by_id[sentence_id]
+                graph._triple_paths[triple_id] = (sentence, [nodes[i] for i in path])
+                graph._sentence_triples.setdefault(sentence, set()).add(triple_id)
+        return graph
+
+    @property
+    def tfidf_scores(self) -> Dict:
+        return self._tfidf_scores
+
     def update_tfidf(self, tfidf_scores):
         self._tfidf_scores = tfidf_scores
         # self._update_tfidf = False
 
+    def remove_triple(self, triple_id: int) -> bool:
+        """Takes a saved triple back out of the graph along the nodes it went in through. The edges it added lose a
+        weight, its sentence comes off the nodes no other triple from the sentence goes through, nodes with no
+        sentences left get dropped and nodes that lost their last parent become roots.
+
+        :param int triple_id: the id of the triple
+        :return bool: whether the triple was in the graph
+        """
+        if triple_id not in self._triple_paths:
+            return False
+        sentence, path = self._triple_paths.pop(triple_id)
+        triple_ids = self._sentence_triples[sentence]
+        triple_ids.discard(triple_id)
+        if not triple_ids:
+            del self._sentence_triples[sentence]
+
+        for parent, child in zip(path, path[1:]):
+            edge = parent.children.get_edge(child)
+            if edge is not None and edge.node is child:
+                edge.weight -= 1
+                if edge.weight == 0:
+                    parent.children.pop(child)
+
+        # the nodes the rest of the sentence's triples still go through keep the sentence
+        still_used = {id(node) for other_id in triple_ids for node in self._triple_paths[other_id][1]}
+        for node in {id(node): node for node in path}.values():
+            if id(node) not in still_used:
+                node.sentences.discard(sentence)
+            if not node.sentences:
+                if self._token_lookup.get(node.token) is node:
+                    del self._token_lookup[node.token]
+                while self._is_root(node):
+                    self._remove_root(node)
+            elif node.parent_count == 0 and not self._is_root(node):
+                self._add_root(node)
+        return True
+
     def delete_sentence(self, sentence):
+        triple_ids = self._sentence_triples.get(sentence)
+        if triple_ids:
+            for triple_id in list(triple_ids):
+                self.remove_triple(triple_id)
+            return
         for triple in sentence.triple_set.all():
             self.delete_triple(sentence, triple)
 
     def delete_triple(self, sentence, triple: Triple):
         # self._update_tfidf = True
-        processed_subject = self._process_triple_element(triple.subject)
-        processed_relation = self._process_triple_element(
-            triple.relation, False, False)
-        processed_object = self._process_triple_element(triple.object)
+        if self.remove_triple(triple.id):
+            return
+        processed_subject, processed_relation, processed_object = self._triple_tokens(triple)
 
         if processed_subject and processed_object:
             subject_node = self._delete_triple_nodes(
@@ -311,19 +548,15 @@ class TripleGraph:
         MODIFY THE TOKEN lOOKuP
         """
         popped_token = subject_tokens.pop(0)
-        subject_node = Node(popped_token["stemmed_word"], OBJECT, sentence)
+        subject_node = Node(popped_token["stemmed_word"], OBJECT, sentence,
+                            first_actual_word=popped_token["actual_word"])
         ifInTokenLookUp, nodeInTokenLookUp = self.searchTokenLookUp(subject_node)
         if ifInTokenLookUp:
             subject_node = nodeInTokenLookUp
-        # if subject_node in self._token_lookup:
-        #     subject_node = self._token_lookup[subject_node]
         if not subject_node.delete_sentence(sentence):
-            if subject_node in self._token_lookup:
-                self._token_lookup.remove(subject_node)
-        #         changed pop to remove
+            self._remove_from_lookup(subject_node)
         # remove subject node from root
-        if subject_node in self.roots:
-            self.roots.remove(subject_node)
+        self._remove_root(subject_node)
 
         current_subject = subject_node
         current_subject = self._delete_triple_children(
@@ -354,42 +587,43 @@ class TripleGraph:
         for token in tokens:
             if current_node is not None:
                 # construct the token
-                to_delete = Node(token["stemmed_word"], part_of_speech, sentence)
+                to_delete = Node(token["stemmed_word"], part_of_speech, sentence,
+                                 first_actual_word=token["actual_word"])
                 child_node = current_node.get_child(to_delete)
                 # delete the child from current subject
                 if current_node.is_child_sentence(to_delete, sentence):
                     if current_node.delete_child(to_delete, sentence):
                         if not self._is_reachable(child_node):
-                            self.roots.append(child_node)
+                            self._add_root(child_node)
 
                 # delete sentence from child
                 if child_node is not None:
                     if not child_node.delete_sentence(sentence):
                         if is_object:
-                            if child_node in self._token_lookup:
-                                self._token_lookup.remove(child_node)
+                            self._remove_from_lookup(child_node)
                         # remove the child node from root candidate
-                        if child_node in self.roots:
-                            self.roots.remove(child_node)
+                        self._remove_root(child_node)
 
                 current_node = child_node
 
         return current_node
 
-    def _process_triple_element(self,
-                                text: str,
-                                filter_stops: bool = True,
-                                filter_tfidf: bool = True) -> List[str]:
-        """Internal function that takes a triple element and does a number of operations including stemming and
-        filtering (e.g. 'little lamb' returns two stemmed tokens).
+    def _triple_tokens(self, triple: Triple) -> Tuple[List, List, List]:
+        """The tokens of the triple's subject, relation and object, processed and (but for the relation) filtered by
+        their tf-idf scores, from the ones the triple saved so there's no text to process
+
+        :param Triple triple: the triple
+        :return Tuple[List[Token], List[Token], List[Token]]: the subject, relation and object tokens
+        """
+        subject, relation, object_ = triple.element_tokens()
+        return self._filter_tfidf(subject), relation, self._filter_tfidf(object_)
+
+    def _filter_tfidf(self, tokens: List) -> List:
+        """Gets rid of the tokens with low/high tf-idf scores
 
-        :param str text: the text of the triple element
-        :param bool filter_stops: whether or not you want to exclude stop words (you probably don't if it is a RELATION)
-        :param filter_tfidf: whether or not you want to exclude meaningless words (you probably don't if it is a RELATION)
-        :return List[str]: the processed tokens from the triple
+        :param List[Token] tokens: the tokens of a triple element
+        :return List[Token]: the ones that are left
         """
-        # List of Dicts {"stemmed_word": "", "processed_word": "", "actual_word": ""}
-        tokens = process_text(text, filter_stops)
 
         def tfidf_filter_func(token):
             """ function used in filter to get rid of low/high tfidf scored words
@@ -402,16 +636,55 @@ class TripleGraph:
             else:
                 return False
 
-        if filter_tfidf:
-            tokens = list(filter(tfidf_filter_func, tokens))
-
-        return tokens
+        return list(filter(tfidf_filter_func, tokens))
 
     def searchTokenLookUp(self, node):
-        for tempNode in self._token_lookup:
-            if tempNode.token == node.token:
-                return True, tempNode
-        return False, None
+        """Finds the node in the graph that has the same token as the node passed in, regardless of speech type
+
+        :param Node node: the node with the token you are looking for
+        :return (bool, Node): whether it was found, and the node in the graph (or None)
+        """
+        found = self._token_lookup.get(node.token)
+        return found is not None, found
+
+    def get_node(self, token: str) -> Node:
+        """Gets the node in the graph for a stemmed token
+
+        :param str token: the stemmed token
+        :return Node: the node in the graph or None if the token isn't in the graph
+        """
+        return self._token_lookup.get(token)
+
+    def _add_to_lookup(self, node: Node):
+        """Adds the node to the token lookup unless its token is already in there, the first node for a token wins
+
+        :param Node node: the node to add
+        """
+        self._token_lookup.setdefault(node.token, node)
+
+    def _remove_from_lookup(self, node: Node):
+        """Removes the node from the token lookup if it is the node stored for its token
+
+        :param Node node: the node to remove
+        """
+        if self._token_lookup.get(node.token) == node:
+            del self._token_lookup[node.token]
+
+    def _is_root(self, node: Node) -> bool:
+        return self._root_counts[node] > 0
+
+    def _add_root(self, node: Node):
+        self.roots.append(node)
+        self._root_counts[node] += 1
+
+    def _remove_root(self, node: Node):
+        """Removes the first root that matches the node, if there is one
+
+        :param Node node: the root to remove
+        """
+        if self._is_root(node):
+            self.roots.remove(node)
+            self._root_counts[node] -= 1
 
     def _insert_node(self, node: Node) -> Node:
         """Takes a node and inserts it into the graph, if a node with the same token exists it returns the existing node
@@ -423,12 +696,9 @@ class TripleGraph:
         ifInTokenLookUp, nodeInTokenLookUp = self.searchTokenLookUp(node)
         if ifInTokenLookUp:
             node = nodeInTokenLookUp.merge(node)
-        # if node in self._token_lookup.values():
-        #     # found node so merge and get the new node
-        #     node = self._token_lookup[node].merge(node)
         else:
             # empty graph or didn't find the node
-            self.roots.append(node)
+            self._add_root(node)
 
         return node
 
@@ -438,31 +708,17 @@ class TripleGraph:
 
         :param Node node:
         """
-        self._visited = []
-        self._update_lookup_helper(node)
-
-    def _update_lookup_helper(self, node: Node):
-        """This updates the token lookup, that is used to locate a token within the graph, it recurses until it finds
-        one that is in it, because that means that we have hit an existing node
-
-        :param Node node: the node to update
-        """
-        if node in self._visited:
-            return
+        def expand(current: Node, is_new: bool) -> bool:
+            # everything below an existing node is already in the lookup, so stop there
+            return is_new and not self.searchTokenLookUp(current)[0]
 
-        self._visited.append(node)
-        ifInTokenLookUp, nodeInTokenLookUp = self.searchTokenLookUp(node)
-        # if node.speech_type != RELATION and node not in self._token_lookup:
-        #     self._token_lookup[node.token] = node
-        if node.speech_type != RELATION and not ifInTokenLookUp:
-            self._token_lookup.append(node)
-        # update for all of the children
-        for child in node.children:
-            self._update_lookup_helper(child)
+        for current, _, is_new in self.depth_first([node], expand=expand):
+            if is_new and current.speech_type != RELATION:
+                self._add_to_lookup(current)
 
     def _insert_triple_nodes(self, subject_tokens: List[Dict],
                              relation_tokens: List[Dict],
-                             object_tokens: List[Dict], sentence) -> Node:
+                             object_tokens: List[Dict], sentence, path: List[Node] = None) -> Node:
         """This takes the tokens from the triple and creates the appropriate nodes, it checks if the object node already
         exists (not the subject node) and merges the node to link it up. The subject node has everything linked to it.
 
@@ -470,6 +726,7 @@ class TripleGraph:
         :param List[str] relation_tokens: tokens for relation
         :param List[str] object_tokens: tokens for object
         :param Sentence sentence: the sentence that the tokens are in
+        :param List[Node] path: if given the nodes in the graph that the triple goes through get added to it, in order
         :return Node: root subject node
         """
         # add the subject tokens, it connects them like (little -> lamb) would be two subject nodes with lamb as
@@ -485,17 +742,20 @@ class TripleGraph:
 
         subject_node = self._insert_node(subject_node)
         self._update_lookup(subject_node)
+        if path is not None:
+            path.append(subject_node)
 
         current_subject = subject_node
 
         if subject_tokens:
-            current_subject = self._insert_triple_children(current_subject, subject_tokens, OBJECT, sentence)
+            current_subject = self._insert_triple_children(current_subject, subject_tokens, OBJECT, sentence,
+                                                           path=path)
         # add relation tokens
         current_relation = self._insert_triple_children(
-            current_subject, relation_tokens, RELATION, sentence, False)
+            current_subject, relation_tokens, RELATION, sentence, False, path=path)
         if object_tokens:
             # add the object tokens
-            self._insert_triple_children(current_relation, object_tokens, OBJECT, sentence)
+            self._insert_triple_children(current_relation, object_tokens, OBJECT, sentence, path=path)
 
         return subject_node
 
@@ -504,7 +764,8 @@ class TripleGraph:
                                 tokens: List[Dict],
                                 part_of_speech: str,
                                 sentence,
-                                is_object: bool = True):
+                                is_object: bool = True,
+                                path: List[Node] = None):
         """This recursively inserts the list of tokens (which are in the order the occured in, e.g. 'Little lamb' would
         be ['little', 'lamb'] and assembles a subgraph which it attaches to the parent.
 
@@ -513,6 +774,7 @@ class TripleGraph:
         :param str part_of_speech: which pos the tokens belong to
         :param Sentence sentence: the sentence the tokens are part of
         :param bool is_object: switch to treat object and relation differently, e.g. don't add to lookup dict
+        :param List[Node] path: if given the nodes that get added to or merged with are appended to it
         :return:
         """
         for token in tokens:
@@ -522,25 +784,64 @@ class TripleGraph:
             ifInTokenLookUp, nodeInTokenLookUp = self.searchTokenLookUp(to_add)
 
             # see if this object already exists
-            # if ifInTokenLookUp and is_object:
             if ifInTokenLookUp:
                 to_add = nodeInTokenLookUp.merge(to_add)
             else:
-                # self._token_lookup[to_add] = to_add
-                self._token_lookup.append(to_add)
+                self._add_to_lookup(to_add)
 
             # add the child and update the current subject to the child
             current_node = current_node.add_child(to_add)
+            if path is not None:
+                path.append(current_node)
 
             if is_object:
                 # test if it is a root
-                if to_add in self.roots and len(self.roots) > 1:
-                    self.roots.remove(to_add)
+                if self._is_root(to_add) and len(self.roots) > 1:
+                    self._remove_root(to_add)
                     if not self._is_reachable(to_add):
-                        self.roots.append(to_add)
+                        self._add_root(to_add)
 
         return current_node
 
+    def depth_first(self, start_nodes: List[Node] = None, visited: set = None, level: int = 0, expand=None):
+        """Walks the graph depth first, in the same order a recursive pre-order walk would, but with an explicit stack
+        so deep graphs can't blow the recursion limit. Nodes that were already visited are still yielded when they
+        are reached again (so callers can mark them), they just aren't expanded again by default.
+
+        :param List[Node] start_nodes: where to start the walk, defaults to the roots
+        :param set visited: nodes to treat as already visited, it is updated as the walk goes
+        :param int level: the level of the start nodes
+        :param expand: function (node, is_new) -> bool that decides if the children of a node get walked, by default
+            only the first time the node is reached
+        :return: generator of (node, level, is_new)
+        """
+        if start_nodes is None:
+            start_nodes = self.roots
+        if visited is None:
+            visited = set()
+        if expand is None:
+            expand = lambda node, is_new: is_new
+
+        # children go on in reverse so they come off in order
+        to_visit = [(node, level) for node in reversed(start_nodes)]
+        while to_visit:
+            node, node_level = to_visit.pop()
+            is_new = node not in visited
+            visited.add(node)
+            # decide before handing the node out, the caller might change what expand looks at
+            walk_children = expand(node, is_new)
+            yield node, node_level, is_new
+            if walk_children:
+                to_visit.extend((child, node_level + 1) for child in reversed(node.children))
+
+    def iter_nodes(self, start_nodes: List[Node] = None):
+        """Every node reachable from the start nodes (the roots by default) once, in depth first order
+
+        :param List[Node] start_nodes: where to start the walk
+        :return: generator of Node
+        """
+        return (node for node, _, is_new in self.depth_first(start_nodes) if is_new)
+
     def _is_reachable(self, node):
         """ This is an internal function that makes sure that if we are removing a root that it is still reachable
         in the graph and we aren't amputating a subgraph (e.g. a->b, b->c, c->a and a doesn't get removed)
@@ -548,33 +849,11 @@ class TripleGraph:
         :param Node node: the node to test if it is reachable in the current state of the graph
         :return bool: is it in the graph or not
         """
-        visited = []
-
-        def _is_reachable_helper(current, node):
-            """ helper function that handles the recursion
-
-            :param Node current: where you are in the graph traversal
-            :param Node node: the node to find
-            :return bool: is it reachable or not
-            """
-            visited.append(current)
+        # only the first root gets checked, same as it always has
+        for current in self.iter_nodes(self.roots[:1]):
             if current is node:
                 return True
-            else:
-                for child in current.children:
-                    if not child in visited:
-                        # only return if you found it
-                        if (_is_reachable_helper(child, node)):
-                            return True
-            return False
-
-        # check all roots
-        for root in self.roots:
-            return _is_reachable_helper(root, node)
-        # for root in self.roots:
-        #     if _is_reachable_helper(root, node):
-        #         return True
-        # return False
+        return False
 
     def _color_graph(self):
         """ This goes through and assigns a color to each root, then if it encounters an already colored root, then it
@@ -586,7 +865,7 @@ class TripleGraph:
             current_color = current_color + 1
 
             nodes_to_visit = [root]
-            visited = [root]
+            visited = {root}
 
             # it barfs if we recurse
             while nodes_to_visit:
@@ -601,7 +880,7 @@ class TripleGraph:
                 for child in current_node.children:
                     if child not in visited:
                         nodes_to_visit.append(child)
-                        visited.append(child)
+                        visited.add(child)
 
     def _get_equivalent_colors(self, color: int) -> List[int]:
         """Helper function to get a list of related colors to whatever color we are looking for, color is represented
@@ -645,74 +924,22 @@ class TripleGraph:
         Goes through every node in the graph
         :return: array of ordered sentenced
         """
-        visited = []
-        sentence_count = {}
-
-        def node_out(node: Node, counter2) -> str:
-            # counter - sentence position
-            output = []  # array of ordered sentences
-            for sentence in node.sentences:
-                if sentence not in sentence_count:  # checks for already added sentence
-                    sentence_count[sentence] = True
-                    # output += str(sentence) + '\n'
-                    # logger.warn("Text: " + sentence.text)
-                    # logger.warn("Previous position: " + str(sentence.position))
-                    sentence.position = counter2
-                    # logger.warn("New position: " + str(sentence.position))
-                    output.append(sentence)  # make more sophisticated later
-                    counter2 = counter2 + 1
-            return output
-
+        visited = set()
+        sentence_count = set()
         sentence_out = []  # all sentences
 
-        def out_helper(node: Node, counter3) -> str:
-            output = []
-            # if node.speech_type != RELATION and node in visited:
-            if node in visited:
-                return output
-
-            # if node.speech_type != RELATION:  # ask about relation
-            results3 = node_out(node, counter3)
-            visited.append(node)
-            if len(results3) > 0:
-                # logger.warn(str(results3).format(
-                #     datetime.datetime.now()))
-                # counter3 = results3[len(results3)-1].position + 1
-                for y in range(len(results3)):
-                    sentence_out.append(results3[y])
-                    # output.append(results3[y])
-
-            for child in node.children:
-                # output += out_helper(child)
-                if len(sentence_out) > 0:
-                    counter5 = sentence_out[len(sentence_out) - 1].position + 1
-                else:
-                    counter5 = 0
-                out_helper(child, counter5)
-                # if len(results4) > 0:
-                #     counter3 = results4[len(results4)-1].position + 1
-                # for m in range(len(results4)):
-                #     output.append(results4[m])
-
-            # return output
-
-        i = 0
-        for root in self.roots:
-            # sentence_out += out_helper(root)
-            # sentence_out += '\n\n'
-            i += 1
+        for i, root in enumerate(self.roots, start=1):
             logger.warn('{}: Root ' + str(i).format(
                 datetime.datetime.now()))
-            if len(sentence_out) == 0:
-                counter = 0
-            else:
-                counter = sentence_out[len(sentence_out) - 1].position + 1
+            for node, _, is_new in self.depth_first([root], visited):
+                if not is_new:
+                    continue
+                for sentence in node.sentences:
+                    if sentence not in sentence_count:  # checks for already added sentence
+                        sentence_count.add(sentence)
+                        sentence.position = len(sentence_out)
+                        sentence_out.append(sentence)
 
-            out_helper(root, counter)
-            # results = out_helper(root, counter)
-            # for x in range(len(results)):
-            #     sentence_out.append(results[x])
-        # logger.warn(sentence_out)
         return sentence_out
 
     def sort_sentences(self) -> None:
@@ -721,67 +948,59 @@ class TripleGraph:
 
         :return: None
         """
-        visited_nodes = []
-        updated_sentences = []
+        updated_sentences = set()
         position_counter = 0
 
-        def sort_sentences_helper(node: Node, position_counter: int) -> int:
-            if node not in visited_nodes:
-                visited_nodes.append(node)
-                for sentence in node.sentences:
-                    if not sentence.id in updated_sentences:
-                        updated_sentences.append(sentence.id)
-                        sentence.position = position_counter
-                        sentence.save()
-                        position_counter = position_counter + 1
-
-                for child in node.children:
-                    position_counter = sort_sentences_helper(child, position_counter)
+        for node in self.iter_nodes():
+            for sentence in node.sentences:
+                if not sentence.id in updated_sentences:
+                    updated_sentences.add(sentence.id)
+                    sentence.position = position_counter
+                    sentence.save()
+                    position_counter = position_counter + 1
 
-            return position_counter
+    def tree_data(self) -> List[Dict]:
+        """The graph as nested {"name", "children"} dicts, one per root, that is what the tree view draws. Nodes that
+        were already drawn show up again without their children.
 
+        :return List[Dict]:
+        """
+        visited = set()
+        tree = []
         for root in self.roots:
-            position_counter = sort_sentences_helper(root, position_counter)
+            root_entry = {"name": str(root), "children": []}
+            tree.append(root_entry)
+            visited.add(root)
+            # children_at[level - 1] is where the nodes on that level go
+            children_at = [root_entry["children"]]
+            for node, level, _ in self.depth_first(list(root.children), visited, level=1):
+                entry = {"name": str(node), "children": []}
+                children_at[level - 1].append(entry)
+                del children_at[level:]
+                children_at.append(entry["children"])
+
+        return tree
 
     def __str__(self) -> str:
         """Prints the graph in string format
 
         :return str:
         """
-        visited = []
-
-        def str_helper(node: Node, level: int) -> str:
-            """Recursive function to print the node and determine level prefix
-
-            :param Node node: node to print
-            :param int level: level of the graph
-            :return str:
-            """
-            prefix = ''
-            for i in range(0, level):
-                prefix = f'{prefix}-'
-            string = f'\n{prefix}{node}'
-
-            if node.speech_type != RELATION and node in visited:
-                return f'{string} -- VISITED'
-
-            # this is here and not at the top because of adding the VISITED part of the string and kickout
-            visited.append(node)
-
-            for child in node.children:
-                string += str_helper(child, level + 1)
-
-            return string
+        visited = set()
+        # relation nodes get printed out in full every time
+        expand = lambda node, is_new: is_new or node.speech_type == RELATION
 
-        string = ''
+        parts = []
         for root in self.roots:
-            string += str(root)
-            visited.append(root)
-            for child in root.children:
-                string += str_helper(child, 1)
-            string += '\n\n'
+            parts.append(str(root))
+            visited.add(root)
+            for node, level, is_new in self.depth_first(list(root.children), visited, level=1, expand=expand):
+                parts.append(f'\n{"-" * level}{node}')
+                if not is_new and node.speech_type != RELATION:
+                    parts.append(' -- VISITED')
+            parts.append('\n\n')
 
-        return string
+        return ''.join(parts)
 
     def plot_graph(self):
         """Draws a networkx graph, it really only looks decent for smallish graphs"""
@@ -796,7 +1015,7 @@ class TripleGraph:
 
             graph.add_node(root)
             nodes_to_visit = [root]
-            visited = [root]
+            visited = {root}
 
             # it barfs if we recurse
             while nodes_to_visit:
@@ -811,7 +1030,7 @@ class TripleGraph:
                             key=id(child),
                             weight=current_node.children[child.node])
                         nodes_to_visit.append(child)
-                        visited.append(child)
+                        visited.add(child)
 
             color_map = []
             for node in graph:
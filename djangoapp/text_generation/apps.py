@@ -9,3 +9,7 @@ class TextGenerationConfig(AppConfig):
 
     def ready(self):
         import text_generation.signals
+        from living_documents_server.settings import SUMMARIZER_WARM_MODELS
+        if SUMMARIZER_WARM_MODELS:
+            from text_generation.summarizers import model_registry
+            model_registry.warm_up(SUMMARIZER_WARM_MODELS)
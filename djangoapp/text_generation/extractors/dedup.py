@@ -0,0 +1,116 @@
+"""Finds the articles that are the same story, either exactly (same text once the whitespace and case are normalized)
+or nearly (a syndicated copy with its own boilerplate around it), so the same story doesn't get summarized twice.
+Exact copies are found by a hash of the text, near copies by the SimHash of the text's word shingles: texts that
+share most of their shingles have fingerprints that differ in only a few bits."""
+import hashlib
+import re
+from typing import Iterable, List
+
+import numpy as np
+
+from living_documents_server import settings
+
+FINGERPRINT_BITS = 64
+WORD_RE = re.compile(r'\w+')
+
+
+def content_hash(text: str) -> str:
+    """Hash of the text with the case and whitespace normalized, it's the same for exact copies"""
+    return hashlib.sha1(' '.join(text.lower().split()).encode()).hexdigest()
+
+
+def simhash(text: str, shingle_size: int = settings.ARTICLE_DEDUP_SHINGLE_SIZE) -> int:
+    """
+    The SimHash fingerprint of the text's word shingles
+
+    Parameters
+    ----------
+    text:
+        The text to fingerprint
+    shingle_size:
+        How many words are in a shingle
+
+    Returns
+    -------
+    int
+        A FINGERPRINT_BITS bit fingerprint, similar texts have fingerprints
+        with a small hamming distance
+    """
+    words = WORD_RE.findall(text.lower())
+    shingles = {' '.join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))}
+    digests = b''.join(hashlib.blake2b(shingle.encode(), digest_size=FINGERPRINT_BITS // 8).digest()
+                       for shingle in shingles)
+    # one row of bits per shingle, a bit of the fingerprint is set when most of the shingles have it set
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(len(shingles), FINGERPRINT_BITS)
+    return int.from_bytes(np.packbits(bits.sum(axis=0) * 2 > len(shingles)).tobytes(), 'big')
+
+
+def max_distance(similarity: float) -> int:
+    """The most bits two fingerprints can differ in and still be near copies at the similarity (0 to 1), which is
+    the share of the fingerprint bits that agree (see ARTICLE_DEDUP_SIMILARITY)"""
+    return int(round((1 - similarity) * FINGERPRINT_BITS))
+
+
+class Deduplicator:
+    """
+    Keeps the first of each story it's given. The fingerprints are split into
+    max_distance + 1 bands, two fingerprints within max_distance bits of each
+    other have at least one band exactly the same, so only the ones that share
+    a band get compared.
+    """
+
+    def __init__(self, similarity: float = settings.ARTICLE_DEDUP_SIMILARITY):
+        """
+        Parameters
+        ----------
+        similarity:
+            How close (0 to 1, 1 only being exact copies) two texts have to be
+            to count as the same story, as the share of their fingerprint bits
+            that agree, not of their shingles
+        """
+        self.max_distance = max_distance(similarity)
+        bands = self.max_distance + 1
+        self._bands = [(FINGERPRINT_BITS * i // bands, FINGERPRINT_BITS * (i + 1) // bands) for i in range(bands)]
+        self._hashes = set()
+        # (band, its bits) -> the fingerprints kept that have them
+        self._buckets = {}
+        self.exact = 0
+        self.near = 0
+
+    def is_duplicate(self, text: str) -> bool:
+        """Whether the text is a copy of one seen before, if it isn't it's remembered"""
+        text_hash = content_hash(text)
+        if text_hash in self._hashes:
+            self.exact += 1
+            return True
+        fingerprint = simhash(text)
+        keys = [(band, fingerprint >> start & (1 << end - start) - 1) for band, (start, end) in enumerate(self._bands)]
+        for key in keys:
+            for seen in self._buckets.get(key, []):
+                if bin(fingerprint ^ seen).count('1') <= self.max_distance:
+                    self.near += 1
+                    return True
+        self._hashes.add(text_hash)
+        for key in keys:
+            self._buckets.setdefault(key, []).append(fingerprint)
+        return False
+
+
+def unique(articles: Iterable, similarity: float = settings.ARTICLE_DEDUP_SIMILARITY) -> List:
+    """
+    The articles that aren't copies of one that came before them
+
+    Parameters
+    ----------
+    articles:
+        Anything with a text, e.g. newspaper articles
+    similarity:
+        See Deduplicator
+
+    Returns
+    -------
+    List
+        The first article of each story, in the order they came in
+    """
+    deduplicator = Deduplicator(similarity)
+    return [article for article in articles if not deduplicator.is_duplicate(article.text)]
@@ -0,0 +1,253 @@
+import atexit
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+from newspaper import Config
+from requests.adapters import HTTPAdapter
+
+from living_documents_server import settings
+from text_generation.extractors import http_cache, politeness
+
+logger = logging.getLogger(__name__)
+
+# what was downloaded from a url, content is the raw bytes of the body
+Download = namedtuple('Download', ['url', 'content', 'content_type', 'encoding'])
+# a fetch waiting for a thread, the first by (priority, order) that can start goes next. url is where it goes to the
+# network, None if it doesn't
+_Job = namedtuple('_Job', ['priority', 'order', 'url', 'context', 'fetch', 'item', 'future'])
+
+
+def download_text(download: Download) -> str:
+    """The body of the download decoded as text"""
+    return download.content.decode(download.encoding or 'utf-8', errors='replace')
+
+
+class FetchPool:
+    """
+    The threads that every article extractor fetches its urls on. There is one
+    pool for the whole process (see get_pool), so an extractor doesn't start
+    its own threads and a burst of requests can't have more than max_workers
+    fetches going at once. Downloads go through one session, so connections
+    to a host are kept alive and reused, and no more than per_host of them
+    go to the same host at once.
+
+    Waiting fetches go in order of their politeness priority, and a download
+    only gets a thread once its host has a token and a free connection, so
+    the threads aren't tied up waiting on one slow host.
+    """
+
+    def __init__(self, max_workers: int = settings.ARTICLE_FETCH_WORKERS,
+                 per_host: int = settings.ARTICLE_FETCH_PER_HOST):
+        """
+        Parameters
+        ----------
+        max_workers:
+            The most fetches that run at the same time, the rest wait their turn
+        per_host:
+            The most downloads from one host that run at the same time, also
+            how many connections to a host are kept open
+        """
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='article-fetch')
+        self._session = requests.Session()
+        # the same user agent newspaper downloads with
+        self._session.headers['User-Agent'] = Config().browser_user_agent
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=per_host)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._lock = threading.Condition()
+        # the fetches waiting for a thread, a heap of _Job
+        self._jobs = []
+        self._order = itertools.count()
+        # host -> downloads from it that were given a thread
+        self._host_downloads = {}
+        # seconds until the first host that has downloads waiting gets a token, see _next_job
+        self._host_wait = None
+        self._queued = 0
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+
+    def map(self, fetch: Callable[[Any], Any], items: List[Any],
+            urls: Optional[List[Optional[str]]] = None) -> List[Optional[Any]]:
+        """
+        Runs fetch for every item (usually a url) on the pool's threads and
+        waits for all of them. A fetch that raises counts as failed and gives
+        None, the fetches are expected to time out on their own (see
+        ARTICLE_FETCH_TIMEOUT).
+
+        Parameters
+        ----------
+        fetch:
+            Takes an item and returns what was fetched
+        items:
+            The urls (or downloads, etc.) to fetch
+        urls:
+            Where each item's fetch goes to the network (None if it doesn't),
+            it only gets a thread once the host has a token and fewer than
+            per_host downloads going
+
+        Returns
+        -------
+        List
+            What fetch returned for each item, in the same order as the items
+        """
+        urls = urls or [None] * len(items)
+        level = politeness.current_priority()
+        futures = []
+        with self._lock:
+            for item, url in zip(items, urls):
+                future = Future()
+                # each fetch runs in a copy of the caller's context, so it keeps the caller's politeness priority
+                heapq.heappush(self._jobs, _Job(level, next(self._order), url, contextvars.copy_context(), fetch,
+                                                item, future))
+                futures.append(future)
+            self._queued += len(items)
+            self._lock.notify_all()
+        # every thread runs whichever fetch can go next, not necessarily the one it was submitted for
+        for _ in items:
+            self._executor.submit(self._run_next)
+        return [future.result() for future in futures]
+
+    def download(self, url: str) -> Optional[Download]:
+        """
+        Downloads the url over the pool's session, on the calling thread. It
+        comes from the http cache if it's there and fresh. The per host limit
+        is kept by map, so go through download_all to have it apply.
+
+        Parameters
+        ----------
+        url:
+            The url to download
+
+        Returns
+        -------
+        Download
+            The body of the response, None if the server sent back an error, it's
+            a pdf that's too big (or the cache is offline and doesn't have it)
+        """
+        # pdfs can be huge (e.g. scanned books), past ARTICLE_PDF_MAX_MB they're not worth downloading
+        max_size = int(settings.ARTICLE_PDF_MAX_MB * 2 ** 20) if url.endswith('.pdf') else None
+        response = http_cache.get_cache().get(url, self._session, settings.ARTICLE_FETCH_TIMEOUT, max_size)
+        if response is None:
+            return None
+        content = response.content
+        if not response.ok:
+            logger.warning(f'Downloading {url} failed with status {response.status_code}')
+            return None
+        return Download(url, content, response.headers.get('Content-Type', ''), response.encoding)
+
+    def download_all(self, urls: List[str]) -> List[Optional[Download]]:
+        """Downloads all of the urls at once (up to the limits), see download and map"""
+        cache = http_cache.get_cache()
+        return self.map(self.download, urls, [url if cache.goes_to_network(url) else None for url in urls])
+
+    def stats(self) -> Dict[str, int]:
+        """Fetches waiting for a thread, running, and finished (and failed) since the pool started"""
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'queued': self._queued,
+                'in_flight': self._in_flight,
+                'completed': self._completed,
+                'failed': self._failed,
+            }
+
+    def shutdown(self, wait: bool = True):
+        """Stops taking fetches, waits for the ones that are running if wait is set"""
+        self._executor.shutdown(wait=wait)
+        self._session.close()
+
+    def _run_next(self):
+        with self._lock:
+            job = self._next_job()
+            while job is None:
+                # woken when a fetch is queued or finishes, or when the first host gets a token
+                self._lock.wait(self._host_wait)
+                job = self._next_job()
+            self._queued -= 1
+            self._in_flight += 1
+        if job.url is not None:
+            job.future.set_result(job.context.run(self._run, job.fetch, job.item, job.url))
+        else:
+            job.future.set_result(job.context.run(self._run, job.fetch, job.item))
+
+    def _next_job(self) -> Optional[_Job]:
+        """Takes the first job that can start now off the queue, with its host token if it downloads. When none can,
+        _host_wait is how long until a host has a token (None if they're waiting on downloads to finish)"""
+        self._host_wait = None
+        scheduler = politeness.get_scheduler()
+        blocked = set()
+        # the jobs passed over on the way to the one that goes, they're pushed back on the heap
+        skipped = []
+        found = None
+        while self._jobs:
+            job = heapq.heappop(self._jobs)
+            if job.url is not None:
+                host = politeness.host_of(job.url)
+                if host in blocked or self._host_downloads.get(host, 0) >= self.per_host:
+                    skipped.append(job)
+                    continue
+                wait = scheduler.take_host_token(job.url)
+                if wait > 0:
+                    blocked.add(host)
+                    self._host_wait = wait if self._host_wait is None else min(self._host_wait, wait)
+                    skipped.append(job)
+                    continue
+                self._host_downloads[host] = self._host_downloads.get(host, 0) + 1
+            found = job
+            break
+        for job in skipped:
+            heapq.heappush(self._jobs, job)
+        return found
+
+    def _run(self, fetch: Callable[[Any], Any], item: Any, url: Optional[str] = None) -> Optional[Any]:
+        failed = False
+        try:
+            # the download's host token was taken when it was given the thread
+            with politeness.prepaid(url) if url is not None else nullcontext():
+                return fetch(item)
+        except Exception:
+            failed = True
+            logger.exception(f'Fetching {getattr(item, "url", item)} failed')
+            return None
+        finally:
+            with self._lock:
+                if url is not None:
+                    self._host_downloads[politeness.host_of(url)] -= 1
+                self._in_flight -= 1
+                self._completed += 1
+                self._failed += failed
+                self._lock.notify_all()
+
+
+_pool_lock = threading.Lock()
+_pool = None
+
+
+def get_pool() -> FetchPool:
+    """The process' fetch pool, it's started the first time it's asked for"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = FetchPool()
+        return _pool
+
+
+@atexit.register
+def shutdown(wait: bool = True):
+    """Shuts the process' fetch pool down, the next get_pool starts a new one"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait)
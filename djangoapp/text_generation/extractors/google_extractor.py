@@ -8,10 +8,10 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
 import logging
 from typing import List
 
-import requests
 from bs4 import BeautifulSoup
 from newspaper import Article
 
+from text_generation.extractors import http_cache, retrieval_context
 from text_generation.extractors.article_extractor import ArticleExtractor
 
 logger = logging.getLogger(__name__)
@@ -78,9 +78,6 @@ class GoogleExtractor(ArticleExtractor):
         List[strs]
             The top search result urls
         """
-        # links to return
-        urls = []
-
         # setup query
         # The query will include all user defined keywords (both positive/added and negative/deleted)
         query = '+'.join(['"' + word + '"' for word in search_terms])
@@ -92,25 +89,7 @@ class GoogleExtractor(ArticleExtractor):
         url = f'http://www.google.com/search?q={query}'
         logger.warning(f'Executing query: {url}')
 
-        # grab from web
-        query_results = requests.get(url)
-        query_soup = BeautifulSoup(query_results.text, 'lxml')
-
-        # scrape all of the links
-        for link in query_soup.find_all('a'):
-            link_url = link.get('href')
-            if link_url.startswith('/url'):
-                if not any(blacklist_element in link_url.lower()
-                           for blacklist_element in self.blacklist):
-                    # strip off the /url?q= part of string
-                    clean_url = link_url[7:]
-                    # strip of junk at end...which starts with '&'
-                    idx = clean_url.find('&')
-                    if idx > -1:
-                        clean_url = clean_url[:clean_url.find('&')]
-                    urls.append(clean_url)
-
-        return urls
+        return self.execute_google_query_url(url)
 
     def execute_google_query_url(self, google_query):
         """
@@ -118,12 +97,19 @@ class GoogleExtractor(ArticleExtractor):
         :param google_query:
         :return: urls from google search
         """
+        # the same query in the same request is only scraped once
+        context = retrieval_context.current()
+        if context is not None:
+            return context.search(google_query, self._scrape_google_query)
+        return self._scrape_google_query(google_query)
+
+    def _scrape_google_query(self, google_query: str) -> List[str]:
         # links to return
         urls = []
 
         # grab from web
-        query_results = requests.get(google_query)
-        query_soup = BeautifulSoup(query_results.text, 'lxml')
+        query_results = http_cache.get_cache().get(google_query)
+        query_soup = BeautifulSoup(query_results.text if query_results else '', 'lxml')
 
         # scrape all of the links
         for link in query_soup.find_all('a'):
@@ -0,0 +1,349 @@
+import codecs
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+
+from living_documents_server import settings
+from text_generation import replay
+from text_generation.extractors import politeness
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# the charset a page declares in a meta tag or an xml declaration, they're near the top
+_DECLARED_CHARSET = re.compile(rb'<meta[^>]*charset=["\']?\s*([\w.:-]+)|^<\?xml[^>]*encoding=["\']([\w.:-]+)', re.I)
+_DECLARED_CHARSET_BYTES = 4096
+
+
+def normalize_url(url: str) -> str:
+    """
+    The url in the form it's cached under: lower case scheme and host, no
+    default port, no fragment and the query parameters in sorted order
+
+    Parameters
+    ----------
+    url:
+        The url to normalize
+
+    Returns
+    -------
+    str
+        The normalized url
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{parts.port}'
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+
+def body_encoding(headers: Dict[str, str], content: bytes) -> str:
+    """
+    The encoding to decode a body with: the charset of the Content-Type if it
+    has one, otherwise the one the page declares, otherwise utf-8. requests
+    falls back to ISO-8859-1 for text without a charset, which garbles most
+    pages since they're utf-8 and only say so in a meta tag.
+
+    Parameters
+    ----------
+    headers:
+        The response headers
+    content:
+        The body
+
+    Returns
+    -------
+    str
+        The name of the encoding
+    """
+    content_type = headers.get('Content-Type', '')
+    if 'charset' in content_type.lower():
+        declared = [requests.utils.get_encoding_from_headers({'content-type': content_type})]
+    else:
+        match = _DECLARED_CHARSET.search(content[:_DECLARED_CHARSET_BYTES].lstrip())
+        declared = [(match.group(1) or match.group(2)).decode('ascii')] if match else []
+    for encoding in declared:
+        try:
+            return codecs.lookup(encoding).name
+        except LookupError:
+            logger.warning(f'Unknown encoding {encoding}, decoding as utf-8')
+    return 'utf-8'
+
+
+class CachedResponse:
+    """The parts of a response the extractors use, whether it came from the
+    network or the cache"""
+
+    def __init__(self, url: str, status_code: int, content: bytes, headers: Dict[str, str], encoding: str = None,
+                 from_cache: bool = False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.encoding = encoding
+        self.from_cache = from_cache
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+
+class HTTPCache:
+    """
+    Caches GET responses on disk, keyed by the normalized url. A response is
+    used as is for ttl seconds, after that it's revalidated with its ETag /
+    Last-Modified (if the server sent them) and only downloaded again if it
+    changed. Once the cache is bigger than max_bytes the least recently used
+    responses get deleted. When offline is set nothing goes to the network,
+    whatever is cached gets used no matter how old it is.
+    """
+    # response headers that get saved with the body
+    SAVED_HEADERS = ['Content-Type', 'ETag', 'Last-Modified']
+
+    def __init__(self, directory: str = settings.HTTP_CACHE_DIR, ttl: float = settings.HTTP_CACHE_TTL,
+                 max_bytes: int = settings.HTTP_CACHE_MAX_MB * 2 ** 20, offline: bool = settings.HTTP_CACHE_OFFLINE):
+        """
+        Parameters
+        ----------
+        directory:
+            Where the responses are kept, it's made if it isn't there
+        ttl:
+            Seconds a response is used without checking back with the server
+        max_bytes:
+            How big the cache can get before responses are evicted
+        offline:
+            Never go to the network, only use the cache
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # the size of the directory as of the last time it was measured, plus what this process wrote since. The
+        # other processes write to it as well, so it's measured again every so often and before evicting
+        self._size = self._measure()
+        self._written = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def get(self, url: str, session: requests.Session = None, timeout: float = None,
+            max_size: int = None) -> Optional[CachedResponse]:
+        """
+        GETs the url, from the cache when it can
+
+        Parameters
+        ----------
+        url:
+            The url to get
+        session:
+            The session to download with, plain requests if there isn't one
+        timeout:
+            Passed on to the download
+        max_size:
+            The most bytes the body can have, the download stops as soon as
+            it's bigger than that
+
+        Returns
+        -------
+        CachedResponse
+            The response, None if it isn't cached and the cache is offline or
+            the body is bigger than max_size
+        """
+        # recorded (or replayed) as a whole, so a replay doesn't need the cache either
+        return replay.get_store().call('http', normalize_url(url), lambda: self._get(url, session, timeout, max_size),
+                                       dump=_dump_response, load=_load_response)
+
+    def goes_to_network(self, url: str) -> bool:
+        """Whether get sends a request for the url right now, rather than answering from the cache (or a replay)"""
+        if self.offline or replay.get_store().mode == replay.REPLAY:
+            return False
+        meta_path, _ = self._paths(self._key(url))
+        try:
+            with open(meta_path) as meta_file:
+                stored_at = json.load(meta_file)['stored_at']
+        except (OSError, ValueError, KeyError):
+            return True
+        return time.time() - stored_at >= self.ttl
+
+    def _get(self, url: str, session: Optional[requests.Session], timeout: Optional[float],
+             max_size: Optional[int]) -> Optional[CachedResponse]:
+        key = self._key(url)
+        cached = self._load(key)
+        if cached is not None:
+            meta, content = cached
+            if self.offline or time.time() - meta['stored_at'] < self.ttl:
+                self.hits += 1
+                return self._response(url, meta, content)
+        elif self.offline:
+            logger.warning(f'{url} is not in the http cache and the cache is offline')
+            return None
+
+        headers = {}
+        if cached is not None:
+            if meta['headers'].get('ETag'):
+                headers['If-None-Match'] = meta['headers']['ETag']
+            if meta['headers'].get('Last-Modified'):
+                headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+        response = politeness.get_scheduler().send(
+            url, lambda: (session or requests).get(url, headers=headers, timeout=timeout, stream=True))
+        if cached is not None and response.status_code == 304:
+            response.close()
+            self.revalidated += 1
+            meta['stored_at'] = time.time()
+            self._store(key, meta, content)
+            return self._response(url, meta, content)
+
+        self.misses += 1
+        content = self._read(response, max_size)
+        if content is None:
+            logger.warning(f'{url} is bigger than {max_size} bytes, not downloading it')
+            return None
+        meta = {
+            'url': url,
+            'status_code': response.status_code,
+            'headers': {name: response.headers[name] for name in self.SAVED_HEADERS if name in response.headers},
+            'encoding': body_encoding(response.headers, content),
+            'stored_at': time.time(),
+        }
+        if response.ok:
+            self._store(key, meta, content)
+        return CachedResponse(url, response.status_code, content, meta['headers'], meta['encoding'])
+
+    def clear(self):
+        """Deletes everything that's cached"""
+        with self._lock:
+            for name in os.listdir(self.directory):
+                self._remove(os.path.join(self.directory, name))
+
+    def _read(self, response: requests.Response, max_size: Optional[int]) -> Optional[bytes]:
+        """The body of a streamed response, None (and the connection closed) once it's bigger than max_size"""
+        with response:
+            if max_size is not None and int(response.headers.get('Content-Length') or 0) > max_size:
+                return None
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size=2 ** 16):
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    return None
+                chunks.append(chunk)
+            return b''.join(chunks)
+
+    def _response(self, url: str, meta: Dict, content: bytes) -> CachedResponse:
+        # worked out again, responses cached before body_encoding have the ISO-8859-1 of requests
+        return CachedResponse(url, meta['status_code'], content, meta['headers'],
+                              body_encoding(meta['headers'], content), from_cache=True)
+
+    def _key(self, url: str) -> str:
+        return hashlib.sha256(normalize_url(url).encode()).hexdigest()
+
+    def _paths(self, key: str) -> (str, str):
+        path = os.path.join(self.directory, key)
+        return path + '.json', path + '.body'
+
+    def _load(self, key: str) -> Optional[tuple]:
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            with open(body_path, 'rb') as body_file:
+                content = body_file.read()
+            # the modified time is the last use, for eviction
+            os.utime(body_path)
+        except (OSError, ValueError):
+            return None
+        return meta, content
+
+    def _store(self, key: str, meta: Dict, content: bytes):
+        meta_path, body_path = self._paths(key)
+        with self._lock:
+            for path, data in [(body_path, content), (meta_path, json.dumps(meta).encode())]:
+                # written next to it and moved over, so a reader never sees half a file
+                temporary = f'{path}.{threading.get_ident()}.tmp'
+                with open(temporary, 'wb') as temporary_file:
+                    temporary_file.write(data)
+                if os.path.exists(path):
+                    self._size -= os.path.getsize(path)
+                os.replace(temporary, path)
+                self._size += len(data)
+                self._written += len(data)
+            if self._written > self.max_bytes * 0.1:
+                self._size = self._measure()
+                self._written = 0
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _measure(self) -> int:
+        """How big everything in the directory is now"""
+        size = 0
+        for name in os.listdir(self.directory):
+            try:
+                size += os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                # removed by another process in the meantime
+                pass
+        return size
+
+    def _evict(self):
+        # what the other processes wrote (and evicted) counts too
+        self._size = self._measure()
+        self._written = 0
+        bodies = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.body')]
+        bodies.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0)
+        for body_path in bodies:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            self._remove(body_path)
+            self._remove(body_path[:-len('.body')] + '.json')
+
+    def _remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._size -= size
+        except OSError:
+            pass
+
+
+def _dump_response(response: Optional[CachedResponse]) -> Optional[Dict]:
+    if response is None:
+        return None
+    return {'url': response.url, 'status_code': response.status_code, 'content': replay.dump_bytes(response.content),
+            'headers': response.headers, 'encoding': response.encoding}
+
+
+def _load_response(data: Optional[Dict]) -> Optional[CachedResponse]:
+    if data is None:
+        return None
+    return CachedResponse(data['url'], data['status_code'], replay.load_bytes(data['content']), data['headers'],
+                          data['encoding'], from_cache=True)
+
+
+_cache_lock = threading.Lock()
+_cache = None
+
+
+def get_cache() -> HTTPCache:
+    """The process' http cache, it's made the first time it's asked for"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = HTTPCache()
+        return _cache
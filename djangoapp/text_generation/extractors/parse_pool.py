@@ -0,0 +1,295 @@
+import atexit
+import io
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple
+
+import PyPDF2
+from PyPDF2.errors import PdfReadError
+from newspaper import Article, ArticleException
+
+from living_documents_server import settings
+
+logger = logging.getLogger(__name__)
+
+# what comes back from the parsing processes, only the plain text (and the title) of the page
+ParsedArticle = namedtuple('ParsedArticle', ['url', 'title', 'text'])
+# cpu seconds between the budget going off again, if the parsing caught it the first time
+BUDGET_INTERVAL = 0.05
+
+
+class ParseBudgetExceeded(Exception):
+    """The page took more cpu time to parse than there was left of the budget"""
+
+
+# set once the page that's being parsed goes over the budget
+_over_budget = False
+
+
+def _on_cpu_budget(signum, frame):
+    global _over_budget
+    _over_budget = True
+    raise ParseBudgetExceeded()
+
+
+def _start_worker():
+    """Runs in each parsing process when it starts. SIGPROF goes off after the process has used the cpu time that is
+    set with setitimer, which is how a page gets stopped once it's over its budget. newspaper catches most exceptions
+    itself, so the timer keeps going off until the exception gets out of it."""
+    signal.signal(signal.SIGPROF, _on_cpu_budget)
+    # ctrl-c goes to the whole process group, the parent shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def parse_page(url: str, content: bytes, encoding: Optional[str], cpu_seconds: float, max_pdf_pages: int,
+               max_pdf_chars: int) -> Tuple[Optional[ParsedArticle], float]:
+    """
+    Turns a downloaded page (html or pdf) into plain text, this is what runs
+    in the parsing processes
+
+    Parameters
+    ----------
+    url:
+        Where the page came from, pdfs are told apart by the .pdf at the end
+    content:
+        The body of the page
+    encoding:
+        The encoding of the body if it's html, utf-8 if it's None
+    cpu_seconds:
+        The most cpu time the page can take (what's left of the document's
+        budget), 0 for no limit
+    max_pdf_pages:
+        Only this many pages of a pdf get read
+    max_pdf_chars:
+        A pdf's pages stop getting read once this much text came out of them
+
+    Returns
+    -------
+    ParsedArticle
+        The text of the page, None if it couldn't be parsed, is a pdf with no
+        text or went over the budget
+    float
+        The cpu seconds parsing it took
+    """
+    global _over_budget
+    _over_budget = False
+    start = time.process_time()
+    try:
+        if cpu_seconds:
+            signal.setitimer(signal.ITIMER_PROF, cpu_seconds, BUDGET_INTERVAL)
+        try:
+            parsed = _parse(url, content, encoding, max_pdf_pages, max_pdf_chars)
+        finally:
+            if cpu_seconds:
+                signal.setitimer(signal.ITIMER_PROF, 0)
+    except ParseBudgetExceeded:
+        parsed = None
+    cpu_time = time.process_time() - start
+    if _over_budget:
+        logger.warning(f'Parsing {url} took more than the {cpu_seconds:.2f}s of cpu time left, skipping it')
+        return None, cpu_time
+    return parsed, cpu_time
+
+
+def _parse(url: str, content: bytes, encoding: Optional[str], max_pdf_pages: int,
+           max_pdf_chars: int) -> Optional[ParsedArticle]:
+    # if the article is a pdf run the pdf parser
+    if url.endswith('.pdf'):
+        try:
+            text = _pdf_text(url, content, max_pdf_pages, max_pdf_chars)
+        except PdfReadError:
+            return None
+        # Dunni did this in the original for when the pdf was scanned, I don't think we need to worry about this atm
+        #   # If the above returns as False, we run the OCR library textract to #convert
+        #   # scanned/image based PDF files into text
+        #   else:
+        #   text = textract.process("temp_file.pdf", method='tesseract', language='eng')
+        return ParsedArticle(url, '', text) if text else None
+
+    # if the article is a regular web page do this
+    try:
+        article = Article(url)
+        # the html is already downloaded, so this only hands it over
+        article.download(input_html=content.decode(encoding or 'utf-8', errors='replace'))
+        article.parse()
+        # TODO: not sure if we need this, but it does some nlp stuff - article.nlp()
+    except ArticleException:
+        return None
+    return ParsedArticle(url, article.title, article.text)
+
+
+def _pdf_text(url: str, content: bytes, max_pages: int, max_chars: int) -> str:
+    """The text of the pdf's pages, read one at a time so the ones past max_pages (or after max_chars of text) never
+    get parsed"""
+    start = time.perf_counter()
+    parts = []
+    chars = 0
+    with io.BytesIO(content) as pdf_file:
+        pdf = PyPDF2.PdfReader(pdf_file)
+        for index in range(min(len(pdf.pages), max_pages)):
+            parts.append(pdf.pages[index].extract_text())
+            chars += len(parts[-1])
+            if chars >= max_chars:
+                break
+        seconds = time.perf_counter() - start
+        logger.warning(f'Read {len(parts)} of the {len(pdf.pages)} pages of {url} ({chars} characters) in '
+                       f'{seconds:.2f}s, {len(parts) / max(seconds, 1e-6):.1f} pages/s')
+    return ''.join(parts)
+
+
+class ParsePool:
+    """
+    The processes that the extractors parse downloaded pages in, so the cpu
+    heavy parsing doesn't hold the GIL in the server's threads. There is one
+    pool for the whole process (see get_pool) and its processes are reused.
+    """
+
+    def __init__(self, processes: int = settings.ARTICLE_PARSE_PROCESSES,
+                 cpu_seconds: float = settings.ARTICLE_PARSE_CPU_SECONDS,
+                 max_pdf_pages: int = settings.ARTICLE_PARSE_MAX_PDF_PAGES,
+                 max_pdf_chars: int = settings.ARTICLE_PDF_MAX_CHARS):
+        """
+        Parameters
+        ----------
+        processes:
+            How many pages get parsed at once
+        cpu_seconds:
+            The most cpu time the pages of one parse_all can take together,
+            the pages after it runs out are skipped
+        max_pdf_pages:
+            Only this many pages of a pdf get read
+        max_pdf_chars:
+            A pdf's pages stop getting read once this much text came out of
+            them
+        """
+        self.processes = processes
+        self.cpu_seconds = cpu_seconds
+        self.max_pdf_pages = max_pdf_pages
+        self.max_pdf_chars = max_pdf_chars
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def parse_all(self, downloads: list) -> List[Optional[ParsedArticle]]:
+        """
+        Parses the downloads in the pool's processes, with one cpu budget
+        (cpu_seconds) for all of them. Each page's cpu time comes out of it,
+        and the pages that haven't started once it's used up are skipped. If
+        a parsing process dies, the pages that were being parsed are parsed
+        again one at a time, so only the one that kills it is lost.
+
+        Parameters
+        ----------
+        downloads:
+            From FetchPool.download_all, the ones that are None stay None
+
+        Returns
+        -------
+        List[ParsedArticle]
+            The text of each download in the same order, None for the ones
+            that couldn't be parsed
+        """
+        parsed = [None] * len(downloads)
+        waiting = deque(index for index, download in enumerate(downloads) if download is not None)
+        # pages that were being parsed when a process died, each gets parsed on its own
+        suspects = deque()
+        # future -> (index of the download, whether it's a suspect parsed on its own, the executor it's parsed in)
+        running = {}
+        budget = self.cpu_seconds
+        while waiting or suspects or running:
+            over_budget = self.cpu_seconds and budget <= 0
+            if over_budget and (waiting or suspects):
+                skipped = len(waiting) + len(suspects)
+                logger.warning(f'Parsing went over its {self.cpu_seconds}s of cpu time, skipping {skipped} pages')
+                waiting.clear()
+                suspects.clear()
+            if suspects:
+                if not running:
+                    index = suspects.popleft()
+                    future, executor = self._submit(downloads[index], budget)
+                    running[future] = (index, True, executor)
+            else:
+                while waiting and len(running) < self.processes:
+                    index = waiting.popleft()
+                    future, executor = self._submit(downloads[index], budget)
+                    running[future] = (index, False, executor)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, alone, executor = running.pop(future)
+                url = downloads[index].url
+                try:
+                    parsed[index], cpu_time = future.result()
+                    budget -= cpu_time
+                except BrokenProcessPool:
+                    # a parsing process died (e.g. ran out of memory), the rest of the pages get new ones
+                    self._reset(executor)
+                    if alone:
+                        logger.exception(f'Parsing process died while parsing {url}')
+                    else:
+                        suspects.append(index)
+                except Exception:
+                    logger.exception(f'Parsing {url} failed')
+        return parsed
+
+    def _submit(self, download, budget: float) -> Tuple[Future, ProcessPoolExecutor]:
+        executor = self._get_executor()
+        try:
+            return executor.submit(parse_page, download.url, download.content, download.encoding,
+                                   max(budget, 0) if self.cpu_seconds else 0, self.max_pdf_pages,
+                                   self.max_pdf_chars), executor
+        except BrokenProcessPool:
+            # it broke before the future of the page that broke it came back
+            self._reset(executor)
+            return self._submit(download, budget)
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawned rather than forked, the server has threads going (fetch pool, nlp client...) that a fork
+                # would copy in whatever state they're in
+                self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_start_worker)
+            return self._executor
+
+    def _reset(self, executor: ProcessPoolExecutor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+
+_pool_lock = threading.Lock()
+_pool = None
+
+
+def get_pool() -> ParsePool:
+    """The process' parse pool, its processes start the first time something gets parsed"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ParsePool()
+        return _pool
+
+
+@atexit.register
+def shutdown(wait: bool = True):
+    """Stops the process' parse pool, the next get_pool makes a new one"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait)
@@ -0,0 +1,271 @@
+"""Keeps the extractors from hitting one host (or everything together) too hard. Every request that goes to the network
+(the http cache sends them, see HTTPCache.get) waits for a token from its host's bucket and then one from the global
+bucket, and a 429 or 503 is retried after a jittered backoff that also holds back the rest of the host's requests.
+The global tokens go to interactive requests (a user is waiting on them) before background ones (e.g. suggested links
+and keywords), set with priority(). The fetch pool takes the host token before it gives a download a thread (see
+take_host_token and prepaid), so a thread doesn't sit waiting for one while other hosts' downloads queue up."""
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict
+from urllib.parse import urlsplit
+
+import requests
+
+from living_documents_server import settings
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+# statuses that mean the host wants us to slow down
+RETRY_STATUSES = {429, 503}
+# the longest a Retry-After header can make a request wait
+MAX_RETRY_AFTER = 60
+
+_priority = contextvars.ContextVar('fetch_priority', default=INTERACTIVE)
+# the host whose token the request that's about to be sent already took, see prepaid
+_prepaid = contextvars.ContextVar('fetch_prepaid', default=None)
+
+
+@contextmanager
+def priority(level: int):
+    """The requests sent inside it (and by the fetch pool for them) get the priority, INTERACTIVE or BACKGROUND"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    """The priority the requests sent right now get, see priority"""
+    return _priority.get()
+
+
+@contextmanager
+def prepaid(url: str):
+    """The first request to the url's host sent inside it doesn't take a host token, it was taken already with
+    take_host_token. Retries wait for their own."""
+    token = _prepaid.set(host_of(url))
+    try:
+        yield
+    finally:
+        _prepaid.reset(token)
+
+
+def host_of(url: str) -> str:
+    """The host the url's requests are counted against"""
+    return urlsplit(url).netloc.lower()
+
+
+class TokenBucket:
+    """
+    Lets rate requests a second through, up to burst at once after it's been
+    idle. Taking a token reserves it, so the caller knows how long to wait
+    and requests to the same host go in the order they asked.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes a token, returns how many seconds to wait before using it"""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def wait_time(self) -> float:
+        """Seconds until there is a token, without taking it"""
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self._tokens) / self.rate)
+
+    def take(self) -> float:
+        """Takes a token if there is one now and returns 0, otherwise returns the seconds until there is one and
+        takes nothing"""
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+            return 0.0
+
+    def pause(self, seconds: float):
+        """No tokens for the next seconds, e.g. the host sent back a 429"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class PolitenessScheduler:
+    """
+    Decides when each of the extractors' requests can go out. There is one
+    scheduler for the whole process (see get_scheduler).
+    """
+
+    def __init__(self, host_rate: float = settings.ARTICLE_FETCH_HOST_RATE,
+                 host_burst: float = settings.ARTICLE_FETCH_HOST_BURST,
+                 global_rate: float = settings.ARTICLE_FETCH_GLOBAL_RATE,
+                 host_rates: Dict[str, float] = settings.ARTICLE_FETCH_HOST_RATES,
+                 retries: int = settings.ARTICLE_FETCH_RETRIES, backoff: float = settings.ARTICLE_FETCH_BACKOFF):
+        """
+        Parameters
+        ----------
+        host_rate:
+            Requests a second to one host
+        host_burst:
+            Requests that can go to a host at once after it's been idle
+        global_rate:
+            Requests a second to all of the hosts together
+        host_rates:
+            host -> requests a second, for the hosts that need a different rate
+            (e.g. search engines that block quickly), they get no burst
+        retries:
+            How many times a 429 or 503 is retried
+        backoff:
+            Seconds before the first retry, it doubles for each one after
+        """
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.host_rates = host_rates
+        self.retries = retries
+        self.backoff = backoff
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._hosts = {}
+        self._condition = threading.Condition()
+        # (priority, order) of the requests waiting for a global token, the first one gets it next
+        self._waiting = []
+        self._order = itertools.count()
+        self.sent = 0
+        self.retried = 0
+        self.waited = 0.0
+        self.prepaid = 0
+
+    def send(self, url: str, request: Callable[[], requests.Response]) -> requests.Response:
+        """
+        Sends the request when the host's and the global rate allow it, and
+        again (after backing off) while it gets 429 or 503 back
+
+        Parameters
+        ----------
+        url:
+            Where the request goes, its host decides the bucket
+        request:
+            Sends the request and returns the response
+
+        Returns
+        -------
+        requests.Response
+            The last response, which can still be a 429 or 503 once the retries
+            run out
+        """
+        host = host_of(url)
+        for attempt in range(self.retries + 1):
+            self.acquire(host)
+            response = request()
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                return response
+            delay = self._backoff(attempt, response)
+            logger.warning(f'{url} sent back {response.status_code}, retrying in {delay:.1f}s')
+            response.close()
+            with self._condition:
+                self.retried += 1
+            self._host(host).pause(delay)
+        return response
+
+    def acquire(self, host: str):
+        """Waits for a token from the host's bucket (unless it's prepaid) and then from the global one"""
+        start = time.monotonic()
+        prepaid = _prepaid.get() == host
+        if prepaid:
+            _prepaid.set(None)
+        else:
+            time.sleep(self._host(host).reserve())
+        entry = (_priority.get(), next(self._order))
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            self._condition.notify_all()
+            while True:
+                if self._waiting[0] == entry:
+                    wait = self._global.wait_time()
+                    if wait <= 0:
+                        self._global.reserve()
+                        heapq.heappop(self._waiting)
+                        self._condition.notify_all()
+                        break
+                    # woken early if a request with a higher priority shows up
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+            self.sent += 1
+            self.prepaid += prepaid
+            self.waited += time.monotonic() - start
+
+    def take_host_token(self, url: str) -> float:
+        """Takes a token from the url's host bucket if it has one now, for a request that then gets sent inside
+        prepaid(url)
+
+        Parameters
+        ----------
+        url:
+            Where the request goes
+
+        Returns
+        -------
+        float
+            0 if it took the token, otherwise the seconds until the host has one
+        """
+        return self._host(host_of(url)).take()
+
+    def stats(self) -> Dict[str, float]:
+        """Requests sent (and how many of them had their host token already), 429/503s retried, seconds spent
+        waiting for tokens and the requests waiting right now"""
+        with self._condition:
+            return {'sent': self.sent, 'prepaid': self.prepaid, 'retried': self.retried, 'waited': self.waited,
+                    'waiting': len(self._waiting)}
+
+    def _host(self, host: str) -> TokenBucket:
+        with self._condition:
+            if host not in self._hosts:
+                if host in self.host_rates:
+                    self._hosts[host] = TokenBucket(self.host_rates[host], 1)
+                else:
+                    self._hosts[host] = TokenBucket(self.host_rate, self.host_burst)
+            return self._hosts[host]
+
+    def _backoff(self, attempt: int, response: requests.Response) -> float:
+        # full jitter, so the requests that were turned away together don't all come back together
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), MAX_RETRY_AFTER))
+        return delay
+
+
+_scheduler_lock = threading.Lock()
+_scheduler = None
+
+
+def get_scheduler() -> PolitenessScheduler:
+    """The process' politeness scheduler, it's made the first time it's asked for"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = PolitenessScheduler()
+        return _scheduler
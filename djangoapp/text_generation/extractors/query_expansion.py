@@ -0,0 +1,54 @@
+from typing import Callable, Iterable, List, Optional
+
+import numpy as np
+from scipy.sparse import spmatrix
+
+AGGREGATES = ('sum', 'max')
+
+
+def top_terms(tfidf_matrix: spmatrix, feature_names: np.ndarray, k: int, exclude: Iterable[str] = (),
+              aggregate: str = 'sum', analyzer: Optional[Callable[[str], List[str]]] = None) -> List[str]:
+    """
+    The k terms with the highest tf-idf score over all of the documents, it
+    works on the sparse matrix directly and only sorts the k it picks
+
+    Parameters
+    ----------
+    tfidf_matrix:
+        documents x terms, e.g. from TfidfVectorizer.fit_transform
+    feature_names:
+        The term of each column, e.g. TfidfVectorizer.get_feature_names_out()
+    k:
+        How many terms to pick
+    exclude:
+        Terms that can't be picked (e.g. the search terms), case doesn't matter
+    aggregate:
+        How a term's scores in the documents make its score, sum (terms that
+        matter in many of the documents) or max (terms that matter a lot in
+        one of them)
+    analyzer:
+        Splits each of exclude into terms, e.g. the vectorizer's
+        build_analyzer(), so a search like 'Machine Learning' leaves out
+        machine and learning. Without it every one of exclude is one term
+
+    Returns
+    -------
+    List[str]
+        The terms, highest score first (ties in alphabetical order)
+    """
+    if aggregate not in AGGREGATES:
+        raise ValueError(f'aggregate has to be one of {AGGREGATES}, not {aggregate}')
+    per_term = tfidf_matrix.sum(axis=0) if aggregate == 'sum' else tfidf_matrix.max(axis=0).todense()
+    scores = np.asarray(per_term, dtype=float).ravel()
+    if analyzer is None:
+        excluded = {term.lower() for term in exclude}
+    else:
+        excluded = {term for text in exclude for term in analyzer(text)}
+    if excluded:
+        scores[np.isin(feature_names, list(excluded))] = -np.inf
+    k = min(k, int(np.isfinite(scores).sum()))
+    if k <= 0:
+        return []
+    # the k best in no particular order, then just those get sorted
+    best = np.argpartition(-scores, k - 1)[:k]
+    return [str(feature_names[i]) for i in sorted(best, key=lambda i: (-scores[i], feature_names[i]))]
@@ -0,0 +1,149 @@
+"""Lets the steps of one generate request share what they retrieved. Generating a document (or a section) searches
+google for its articles and then again for its suggested links and keywords, and those are often the same query over
+the same articles. Inside a RetrievalContext each distinct search page is scraped once, each url is extracted once
+and each query expansion is fitted once, whichever extractor asks for them."""
+import contextvars
+import functools
+import logging
+from typing import Callable, Dict, List, Optional
+
+from newspaper import Article
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('retrieval_context', default=None)
+
+
+def current() -> Optional['RetrievalContext']:
+    """The context the caller runs in, None outside of one"""
+    return _current.get()
+
+
+class RetrievalContext:
+    """
+    What was retrieved so far in one request. It's used as a context
+    manager, the extractors find it with current(). It belongs to one
+    request, so it isn't meant to be shared between threads.
+    """
+
+    def __init__(self):
+        # search page url -> the links scraped from it
+        self._searches = {}
+        # url -> the extracted article, None if it failed
+        self._articles = {}
+        # (article urls, search terms) -> expanded terms
+        self._expansions = {}
+        self._token = None
+        self.searches_run = 0
+        self.searches_reused = 0
+        self.fetches = 0
+        self.fetches_avoided = 0
+        self.expansions_run = 0
+        self.expansions_reused = 0
+
+    def __enter__(self) -> 'RetrievalContext':
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current.reset(self._token)
+        logger.warning(f'Retrieval: {self.stats()}')
+
+    def search(self, url: str, run: Callable[[str], List[str]]) -> List[str]:
+        """
+        The links of a search page, run only scrapes it the first time
+
+        Parameters
+        ----------
+        url:
+            The search page, e.g. the google query
+        run:
+            Takes the url and returns the links on it
+
+        Returns
+        -------
+        List[str]
+            The links
+        """
+        if url in self._searches:
+            self.searches_reused += 1
+        else:
+            self.searches_run += 1
+            self._searches[url] = run(url)
+        return list(self._searches[url])
+
+    def articles(self, urls: List[str], extract: Callable[[List[str]], List[Optional[Article]]]) \
+            -> List[Optional[Article]]:
+        """
+        The articles at the urls, extract only gets the urls that weren't
+        extracted before
+
+        Parameters
+        ----------
+        urls:
+            The urls of the articles
+        extract:
+            Takes a list of urls and returns the article (None if it failed)
+            for each of them
+
+        Returns
+        -------
+        List[Article]
+            The article for each url, in the same order
+        """
+        missing = list(dict.fromkeys(url for url in urls if url not in self._articles))
+        self.fetches += len(missing)
+        self.fetches_avoided += len(urls) - len(missing)
+        if missing:
+            self._articles.update(zip(missing, extract(missing)))
+        return [self._articles[url] for url in urls]
+
+    def expanded_terms(self, articles: List[Article], search_terms: List[str],
+                       expand: Callable[[], List[str]]) -> List[str]:
+        """
+        The query expansion for the search terms over the articles, expand
+        only runs the first time
+
+        Parameters
+        ----------
+        articles:
+            The articles the expansion is fitted on
+        search_terms:
+            The terms that were searched for
+        expand:
+            Runs the expansion
+
+        Returns
+        -------
+        List[str]
+            The expanded terms
+        """
+        key = (tuple(article.url for article in articles), tuple(search_terms))
+        if key in self._expansions:
+            self.expansions_reused += 1
+        else:
+            self.expansions_run += 1
+            self._expansions[key] = expand()
+        return list(self._expansions[key])
+
+    def stats(self) -> Dict[str, int]:
+        """Searches, fetches and expansions that ran, and the ones that were reused instead"""
+        return {
+            'searches_run': self.searches_run,
+            'searches_reused': self.searches_reused,
+            'fetches': self.fetches,
+            'fetches_avoided': self.fetches_avoided,
+            'expansions_run': self.expansions_run,
+            'expansions_reused': self.expansions_reused,
+        }
+
+
+def scoped(method: Callable) -> Callable:
+    """Runs the method in a retrieval context of its own, unless it's called inside one already"""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if current() is not None:
+            return method(*args, **kwargs)
+        with RetrievalContext():
+            return method(*args, **kwargs)
+    return wrapper
@@ -5,10 +5,10 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
 import unittest
 from typing import List
 
-import requests
 from bs4 import BeautifulSoup
 from newspaper import Article
 
+from text_generation.extractors import http_cache, retrieval_context
 from text_generation.extractors.article_extractor import ArticleExtractor
 
 
@@ -54,15 +54,22 @@ class WikipediaExtractor(ArticleExtractor):
         List[strs]
             The top search result urls
         """
-        # links to return
-        urls = []
-
         query = '+'.join(search_terms)
         url = f'https://en.wikipedia.org/w/index.php?search={query}&title=Special:Search&fulltext=1'
 
+        # the same search in the same request is only scraped once
+        context = retrieval_context.current()
+        if context is not None:
+            return context.search(url, self._scrape_wikipedia_search)
+        return self._scrape_wikipedia_search(url)
+
+    def _scrape_wikipedia_search(self, url: str) -> List[str]:
+        # links to return
+        urls = []
+
         # grab from web
-        query_results = requests.get(url)
-        query_soup = BeautifulSoup(query_results.text, 'lxml')
+        query_results = http_cache.get_cache().get(url)
+        query_soup = BeautifulSoup(query_results.text if query_results else '', 'lxml')
 
         # scrape all of the links
         for link in query_soup.find_all('a'):
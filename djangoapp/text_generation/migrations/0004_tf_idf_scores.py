@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('text_generation', '0003_cached_annotation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TfIdfScores',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('data', models.BinaryField()),
+                ('last_used', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:50
+
+import functools
+import hashlib
+import json
+
+import nltk
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+# a frozen copy of the text processing there was when this was written (utilities.process_word and
+# triple.make_tokens), so changing them later doesn't change what this migration does. The triples whose tokens don't
+# match the text processing there is by then (TOKENS_VERSION and the key) get them made again the next time they're used
+TOKEN_FORMAT = 1
+EXTRA_STOPWORDS = {'displaystyle', 'mathbf', 'function', 'mathcal', 'alpha', 'boldsymbol'}
+
+
+def _english_stopwords():
+    try:
+        return set(nltk.corpus.stopwords.words('english'))
+    except LookupError:
+        nltk.download('stopwords')
+        return set(nltk.corpus.stopwords.words('english'))
+
+
+def _token_maker():
+    """The function that makes the tokens of a triple, and the TOKENS_VERSION they are"""
+    stopwords = _english_stopwords() | EXTRA_STOPWORDS
+    stemmer = nltk.stem.porter.PorterStemmer()
+    version = hashlib.sha256(json.dumps(
+        [TOKEN_FORMAT, type(stemmer).__name__, stemmer.mode, sorted(stopwords)]).encode()).hexdigest()[:16]
+    stem = functools.lru_cache(maxsize=None)(stemmer.stem)
+
+    def process_text(text, filter_stopwords=True):
+        tokens = []
+        for word in text.lower().split():
+            processed_word = ''.join(e for e in word if e.isalpha())
+            if filter_stopwords and processed_word in stopwords:
+                tokens.append(['', '', ''])
+            else:
+                tokens.append([stem(processed_word), processed_word, word])
+        return tokens
+
+    def make_tokens(subject, relation, object_):
+        return {
+            'key': hashlib.blake2b('\0'.join((subject, relation, object_)).encode(), digest_size=16).hexdigest(),
+            'subject': [token for token in process_text(subject) if token[0]],
+            'relation': process_text(relation, False),
+            'object': [token for token in process_text(object_) if token[0]],
+        }
+
+    return make_tokens, version
+
+
+def make_triple_tokens(apps, schema_editor):
+    """Saves the tokens of the triples that are there already, so building their graphs doesn't process text"""
+    Triple = apps.get_model('text_generation', 'Triple')
+    if not Triple.objects.exists():
+        return
+    make_tokens, tokens_version = _token_maker()
+    last_id = 0
+    while True:
+        triples = list(Triple.objects.filter(id__gt=last_id).exclude(tokens_version=tokens_version)
+                       .order_by('id')[:BATCH_SIZE])
+        if not triples:
+            return
+        for triple in triples:
+            triple.tokens = make_tokens(triple.subject, triple.relation, triple.object)
+            triple.tokens_version = tokens_version
+        Triple.objects.bulk_update(triples, ['tokens', 'tokens_version'])
+        last_id = triples[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('text_generation', '0004_tf_idf_scores'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='triple',
+            name='tokens',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='triple',
+            name='tokens_version',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=16),
+        ),
+        migrations.RunPython(make_triple_tokens, migrations.RunPython.noop),
+    ]
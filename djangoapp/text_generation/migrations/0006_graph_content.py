@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('text_generation', '0005_triple_tokens'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GraphContent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('all_sentences', models.BooleanField(default=False)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='graph_contents', to='text_generation.document')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('document', 'all_sentences'), name='unique_graph_content_scope')],
+            },
+        ),
+    ]
@@ -5,4 +5,7 @@ from .sentence import Sentence
 from .triple import Triple
 from .keyword import Keyword
 from .article import Article
-from .document_history import DocumentHistory
\ No newline at end of file
+from .document_history import DocumentHistory
+from .triple_graph_snapshot import TripleGraphSnapshot, GraphContent
+from .cached_annotation import CachedAnnotation
+from .tf_idf_scores import TfIdfScores
@@ -0,0 +1,24 @@
+import json
+import zlib
+from typing import Dict
+
+from django.db import models
+
+
+class CachedAnnotation(models.Model):
+    """An nlp server annotation saved as compressed json under the hash of the text and properties it was made from,
+    see annotators/annotation_cache.py"""
+    key = models.CharField(max_length=64, unique=True)
+    data = models.BinaryField()
+    # the least recently used ones get evicted once there are more than ANNOTATION_CACHE_SIZE
+    last_used = models.DateTimeField(db_index=True)
+
+    @staticmethod
+    def pack(annotation: Dict) -> bytes:
+        return zlib.compress(json.dumps(annotation, separators=(',', ':')).encode())
+
+    def load(self) -> Dict:
+        return json.loads(zlib.decompress(bytes(self.data)))
+
+    def __str__(self):
+        return f'{self.key} ({self.last_used})'
@@ -2,13 +2,13 @@ import datetime
 import logging
 import random
 
-from typing import List
+from typing import Dict, List
 
 from django.db import models
 from newspaper import Article as RawArticle
 from nltk.tokenize import sent_tokenize
-from sklearn.feature_extraction.text import TfidfVectorizer
 
+from text_generation.extractors import politeness, retrieval_context
 from text_generation.extractors.article_extractor import ArticleExtractor
 from text_generation.extractors.google_extractor import GoogleExtractor
 from text_generation.models.article import Article
@@ -24,7 +24,6 @@ from text_generation.summarizers.pre_summ_summarizer import PreSummSummarizer
 from text_generation.summarizers.bart_summarizer import BartSummarizer
 from text_generation.summarizers.t5_summarizer import T5Summarizer
 from text_generation.summarizers.gpt3_summarizer import GPT3Summarizer
-from text_generation.utilities import process_text
 
 logger = logging.getLogger(__name__)
 
@@ -46,13 +45,16 @@ class Document(models.Model):
         sentences = sent_tokenize(body_text)
 
         i = 0  # position in dictionary
+        new_sents = []
         for sentence in sentences:
             new_sent = Sentence(document=self, text=sentence, position=i)
             new_sent.save()
-            new_sent.build_triples()
+            new_sents.append(new_sent)
             i = i + 1
+        Sentence.build_triples_bulk(new_sents)
 
     # TODO should have a flag for regenerating section summaries as well
+    @retrieval_context.scoped
     def generate_summarization(self, get_articles=True, summarizer="gpt3") -> None:
         """This is mostly used for generating a new article right now, going to handle the updating of a summarization
         differently....probably need to do individual section generation or something.
@@ -105,6 +107,7 @@ class Document(models.Model):
         self.graph.sort_sentences()
         self.save()
 
+    @retrieval_context.scoped
     def generate_section_summarization(self, section: Section, get_articles=True, summarizer="gpt3") -> None:
         """
         This creates a new section and generates the text
@@ -215,7 +218,9 @@ class Document(models.Model):
         extractor = GoogleExtractor()
 
         logger.warning('{}: Getting related terms from google searches'.format(datetime.datetime.now()))
-        articles_s, expanded_terms = extractor.get_articles(search_terms=search_term, remove_terms=[])
+        # only suggestions, so the fetches for the document's own articles go first
+        with politeness.priority(politeness.BACKGROUND):
+            articles_s, expanded_terms = extractor.get_articles(search_terms=search_term, remove_terms=[])
         logger.warning('{}: Back from getting related terms from google searches'.format(datetime.datetime.now()))
         # if summarizer == "gpt3":
         # Keyword.objects.get_or_create(text="keyword", document=self)
@@ -262,11 +267,18 @@ class Document(models.Model):
             summarizer = GPT3Summarizer(words=200)
 
         logger.warning('{}:Summarizer set. About to summarize each article'.format(datetime.datetime.now()))
-        i = 1
+        to_summarize = []
         for article in articles:
             if len(article.text.split('.')) <= 5:
                 logger.warning("less than 5 sentences, skip...")
                 continue
+            to_summarize.append(article)
+        if hasattr(summarizer, 'summarize_many'):
+            # the summarizer batches the articles together
+            summarizer.summarize_many(document=self, articles=to_summarize, section=section)
+            return
+        i = 1
+        for article in to_summarize:
             logger.warning('Printing i')
             logger.warning(i)
             summarizer.summarize(document=self, text=article.text, section=section, article=article)
@@ -313,40 +325,17 @@ class Document(models.Model):
         shouldn't need to call this
         :return: None
         """
-        texts = []
-        allSents = self.getAllDocSecSentences()
-        if useAllSentences:
-            for sentence in allSents:
-                process_text_result = process_text(sentence.text)
-                list_of_stemmed_words = []
-                # get list of stemmed words
-                for res in process_text_result:
-                    list_of_stemmed_words.append(res["stemmed_word"])
-                texts.append(' '.join(list_of_stemmed_words))
-        else:
-            for sentence in self.sentences.filter(section=None):
-                process_text_result = process_text(sentence.text)
-                list_of_stemmed_words = []
-                # get list of stemmed words
-                for res in process_text_result:
-                    list_of_stemmed_words.append(res["stemmed_word"])
-                texts.append(' '.join(list_of_stemmed_words))
-
-        tfidf_vec = TfidfVectorizer()
-        transformed = tfidf_vec.fit_transform(texts)
-        index_value = {i[1]: i[0] for i in tfidf_vec.vocabulary_.items()}
-        temp_tf_idf_scores = []
-        # set em
-        for row in transformed:
-            temp_tf_idf_scores.append({
-                index_value[column]: value
-                for (column, value) in zip(row.indices, row.data)
-            })
-
-        self.tf_idf_scores = {}
-        for row in temp_tf_idf_scores:
-            for token in row.keys():
-                self.tf_idf_scores[token] = row[token]
+        from text_generation.annotators import graph_maintenance, tf_idf_service
+
+        sentences = self._graph_sentences(useAllSentences)
+        # a graph kept up to date since the last edit has the scores already, without fitting them over every sentence
+        maintained = graph_maintenance.tf_idf_scores(graph_maintenance.document_scope(self.id, useAllSentences),
+                                                     sentences)
+        if maintained is not None:
+            self.stemmed_texts, self.tf_idf_scores = maintained
+            return
+        # sentence id -> stemmed text, the graph maintenance reuses these when sentences change
+        self.stemmed_texts, self.tf_idf_scores = tf_idf_service.scores_for(sentences)
 
     def getAllDocSecSentences(self):
         allSents = []
@@ -358,13 +347,19 @@ class Document(models.Model):
         return allSents
 
     # TODO this is currently only building it for the 'intro' section and not the subsections
-    def build_triple_graph(self, useAllSentences=False) -> None:
+    def build_triple_graph(self, useAllSentences=False, track_changes=True) -> None:
         """
         Builds the triple graph for the sentences in the document
+        :param bool track_changes: keep the graph up to date as sentences and triples change, turn it off if the graph
+            is going to be edited by hand
         :return: None
         """
         logger.warn("in build-triple graph")
+        from text_generation.annotators import graph_maintenance
         from text_generation.annotators.triple_graph import TripleGraph
+        scope = graph_maintenance.document_scope(self.id, useAllSentences)
+        # the old graph would just get updated by the build and then thrown out
+        graph_maintenance.forget(scope)
         # logger.warn("self.sentences.all()")
         # logger.warn(self.sentences.all())
         # logger.warn("self.tf_idf_scores")
@@ -379,6 +374,73 @@ class Document(models.Model):
             self.graph = TripleGraph(self.sentences.filter(section=None), self.tf_idf_scores)
         #     use only section sentences
         logger.warning('{}: Triple Graph built'.format(datetime.datetime.now()))
+        if track_changes:
+            graph_maintenance.track(scope, self.graph, getattr(self, 'stemmed_texts', None))
+
+    def load_triple_graph(self, useAllSentences=False) -> None:
+        """
+        Same as calculating the tf-idf scores and building the triple graph, but it reuses the graph that has been kept
+        up to date in memory, or the saved snapshot of it, when they match the sentences and triples that are there now
+        :return: None
+        """
+        from text_generation.annotators import graph_content, graph_maintenance
+        from text_generation.annotators.triple_graph import TripleGraph
+        from text_generation.models.triple_graph_snapshot import TripleGraphSnapshot
+
+        scope = graph_maintenance.document_scope(self.id, useAllSentences)
+        tracked = graph_maintenance.get(scope)
+        # kept up to date as the sentences and triples change, so they're only read when the graph has to be loaded
+        content_hash = graph_content.content_hash(self.id, useAllSentences,
+                                                  lambda: self._graph_sentences(useAllSentences))
+        saved = TripleGraphSnapshot.objects.filter(
+            document=self,
+            all_sentences=useAllSentences,
+            content_hash=content_hash,
+            version=TripleGraph.SNAPSHOT_VERSION)
+
+        if tracked is not None:
+            # other threads' saves change it, so it's read (and saved) while they can't
+            with tracked.lock:
+                up_to_date = tracked.content_hash.hexdigest() == content_hash
+                if up_to_date:
+                    self.graph = tracked.graph
+                    self.tf_idf_scores = self.graph.tfidf_scores
+                    if not saved.exists():
+                        self._store_graph_snapshot(useAllSentences, content_hash, tracked.stemmed_texts)
+            if up_to_date:
+                logger.warning('{}: Triple Graph is up to date in memory'.format(datetime.datetime.now()))
+                return
+
+        snapshot = saved.first()
+        if snapshot is not None:
+            snapshot = snapshot.load()
+            self.tf_idf_scores = snapshot['tfidf_scores']
+            self.graph = TripleGraph.from_snapshot(snapshot, self._graph_sentences(useAllSentences))
+            stemmed_texts = {int(sentence_id): text for sentence_id, text in snapshot['stemmed_texts'].items()}
+            graph_maintenance.track(scope, self.graph, stemmed_texts)
+            logger.warning('{}: Triple Graph loaded from snapshot'.format(datetime.datetime.now()))
+            return
+
+        self.calculate_tf_idf_scores(useAllSentences=useAllSentences)
+        self.build_triple_graph(useAllSentences=useAllSentences)
+        # building can delete sentences and triples (and make new triples), so hash what is left, that also puts the
+        # saved hash right if a change went past the signals
+        content_hash = graph_content.reset(self.id, useAllSentences, self._graph_sentences(useAllSentences))
+        self._store_graph_snapshot(useAllSentences, content_hash, self.stemmed_texts)
+
+    def _store_graph_snapshot(self, useAllSentences: bool, content_hash: str, stemmed_texts: Dict[int, str]):
+        """Saves self.graph, the stemmed texts go along so the graph maintenance doesn't have to redo them"""
+        from text_generation.models.triple_graph_snapshot import TripleGraphSnapshot
+
+        snapshot = self.graph.to_snapshot()
+        snapshot['stemmed_texts'] = stemmed_texts
+        TripleGraphSnapshot.store(self, useAllSentences, content_hash, snapshot)
+
+    def _graph_sentences(self, useAllSentences=False) -> List[Sentence]:
+        """The sentences that build_triple_graph uses"""
+        if useAllSentences:
+            return self.getAllDocSecSentences()
+        return list(self.sentences.filter(section=None))
 
     def change_word_text(self, old_word: str, new_word: str):
         """
@@ -394,7 +456,8 @@ class Document(models.Model):
 
         if len(self.sentences.all()) > 0:
             self.calculate_tf_idf_scores()
-            self.build_triple_graph()
+            # change_word_using_triple_graph edits this graph by hand
+            self.build_triple_graph(track_changes=False)
 
         extractor = GoogleExtractor()
 
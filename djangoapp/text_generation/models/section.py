@@ -2,8 +2,6 @@ import logging
 import datetime
 
 from django.db import models
-from sklearn.feature_extraction.text import TfidfVectorizer
-from text_generation.utilities import process_text
 
 logger = logging.getLogger(__name__)
 
@@ -29,30 +27,16 @@ class Section(models.Model):
         shouldn't need to call this
         :return: None
         """
-        texts = []
-        for sentence in self.sentences.all():
-            process_text_result = process_text(sentence.text)
-            list_of_stemmed_words = []
-            # get list of stemmed words
-            for res in process_text_result:
-                list_of_stemmed_words.append(res["stemmed_word"])
-            texts.append(' '.join(list_of_stemmed_words))
+        from text_generation.annotators import graph_maintenance, tf_idf_service
 
-        tfidf_vec = TfidfVectorizer()
-        transformed = tfidf_vec.fit_transform(texts)
-        index_value = {i[1]: i[0] for i in tfidf_vec.vocabulary_.items()}
-        temp_tf_idf_scores = []
-        # set em
-        for row in transformed:
-            temp_tf_idf_scores.append({
-                index_value[column]: value
-                for (column, value) in zip(row.indices, row.data)
-            })
-
-        self.tf_idf_scores = {}
-        for row in temp_tf_idf_scores:
-            for token in row.keys():
-                self.tf_idf_scores[token] = row[token]
+        sentences = list(self.sentences.all())
+        # a graph kept up to date since the last edit has the scores already, without fitting them over every sentence
+        maintained = graph_maintenance.tf_idf_scores(graph_maintenance.section_scope(self.id), sentences)
+        if maintained is not None:
+            self.stemmed_texts, self.tf_idf_scores = maintained
+            return
+        # sentence id -> stemmed text, the graph maintenance reuses these when sentences change
+        self.stemmed_texts, self.tf_idf_scores = tf_idf_service.scores_for(sentences)
 
     # TODO this is currently only building it for the 'intro' section and not the subsections
     def build_triple_graph(self) -> None:
@@ -61,11 +45,16 @@ class Section(models.Model):
         :return: None
         """
         logger.warn("in build-triple graph")
+        from text_generation.annotators import graph_maintenance
         from text_generation.annotators.triple_graph import TripleGraph
+        scope = graph_maintenance.section_scope(self.id)
+        # the old graph would just get updated by the build and then thrown out
+        graph_maintenance.forget(scope)
         # logger.warn("self.sentences.all()")
         # logger.warn(self.sentences.all())
         # logger.warn("self.tf_idf_scores")
         # logger.warn(self.tf_idf_scores)
         self.graph = TripleGraph(self.sentences.all(),
                                  self.tf_idf_scores)  # saw this in test
-        logger.warning('{}: Triple Graph built for section'.format(datetime.datetime.now()))
\ No newline at end of file
+        logger.warning('{}: Triple Graph built for section'.format(datetime.datetime.now()))
+        graph_maintenance.track(scope, self.graph, getattr(self, 'stemmed_texts', None))
\ No newline at end of file
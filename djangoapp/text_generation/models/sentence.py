@@ -1,15 +1,42 @@
+import functools
 import logging
 import json
-from django.db import models
-from pycorenlp import StanfordCoreNLP
-from living_documents_server.settings import NLP_SERVER_URL
+from typing import Dict, List
+from django.db import models, transaction
+from living_documents_server.settings import NLP_ANNOTATE_BATCH_SIZE
+from text_generation.annotators.nlp_client import get_client
 
 logger = logging.getLogger(__name__)
 
-nlp_server = StanfordCoreNLP(NLP_SERVER_URL)
+nlp_server = get_client()
+OPENIE_PROPERTIES = {
+    'annotators': 'openie',
+    'outputFormat': 'json',
+    'openie.triple.strict': 'true'
+}
 # an article has many sentences
 
 
+def _load_annotation(annotation) -> Dict:
+    """pycorenlp hands back the json already loaded or as a string depending on the python version (and a string
+    when the server sends back an error)"""
+    if isinstance(annotation, dict):
+        return annotation
+    try:
+        return json.loads(annotation)
+    except ValueError:
+        logger.warning(f'NLP server did not send back json:\n{annotation}')
+        return {}
+
+
+def _triples_saved(triples: List['Triple']):
+    """What the post_save receiver does for each triple, for the ones bulk_create made"""
+    from text_generation.annotators import graph_maintenance
+
+    for triple in triples:
+        graph_maintenance.triple_saved(triple)
+
+
 class Sentence(models.Model):
     """(Sentence description)"""
     text = models.TextField(blank=True)
@@ -54,36 +81,86 @@ class Sentence(models.Model):
 
     def build_triples(self):
         # logger.warn("TRIPLES ARE BEING BUILT: " + self.text)
-        from text_generation.models.triple import Triple
+        from text_generation.annotators import annotation_cache
+
         logger.warning("About to run nlp server")
-        annotation_json = nlp_server.annotate(
-            self.text,
-            properties={
-                'annotators': 'openie',
-                'outputFormat': 'json',
-                'openie.triple.strict': 'true'
-            })
+        annotation_json = annotation_cache.annotate(nlp_server, self.text, OPENIE_PROPERTIES)
         logger.warning("Ran nlp server==")
         logger.warning("NLP server output stored in annotation_json")
         # logger.warning(annotation_json)
-        annotation_json = json.loads(annotation_json)
-        # TODO BVH To speed this up I can move this to document and do a bunch of them at the same time
+        annotation_json = _load_annotation(annotation_json)
         if 'sentences' in annotation_json:
             if len(annotation_json['sentences']) > 0:
                 if 'openie' in annotation_json['sentences'][0]:
-                    triples = annotation_json['sentences'][0]['openie']
-                    for triple in triples:
-                        new_triple = Triple(
-                            sentence=self,
-                            subject=triple["subject"],
-                            relation=triple["relation"],
-                            object=triple["object"])
+                    for new_triple in self._openie_triples(annotation_json['sentences'][0]):
                         new_triple.save()
                 else:
                     logger.warning(f"NO TRIPLES FOUND:\n{self.text}\n\n{annotation_json}")
         else:
             logger.warning("NO RESULTS FROM NLP SERVER")
 
+    @staticmethod
+    def build_triples_bulk(sentences: List['Sentence'], batch_size: int = NLP_ANNOTATE_BATCH_SIZE) -> int:
+        """Does build_triples for all of the sentences, but it sends them to the nlp server batch_size at a time (one
+        sentence per line) and saves each batch's triples with one bulk insert. The batches are sent concurrently and
+        sentences whose annotation is cached don't get sent at all.
+
+        :param List[Sentence] sentences: saved sentences to build triples for
+        :param int batch_size: how many sentences go in each request
+        :return int: how many triples were made
+        """
+        from text_generation.annotators import annotation_cache, graph_content
+        from text_generation.models.triple import Triple
+
+        properties = dict(OPENIE_PROPERTIES, **{'ssplit.eolonly': 'true'})
+        # blank lines don't make sentences, they would throw the lines and the results out of step
+        sentences = [sentence for sentence in sentences if sentence.text.strip()]
+        lines = [' '.join(sentence.text.split()) for sentence in sentences]
+        # each sentence is cached on its own (as a one line annotation), so it can be found again in any batch
+        keys = [annotation_cache.cache_key(line, properties) for line in lines]
+        cached = annotation_cache.get_many(list(set(keys)))
+        batches = [[(sentence, cached[key]['sentences'][0]) for sentence, key in zip(sentences, keys) if key in cached]]
+        uncached = [i for i, key in enumerate(keys) if key not in cached]
+        uncached_batches = [uncached[start:start + batch_size] for start in range(0, len(uncached), batch_size)]
+        logger.warning(f"About to run nlp server on {len(uncached)} sentences")
+        annotations = nlp_server.annotate_many(['\n'.join(lines[i] for i in batch) for batch in uncached_batches],
+                                               properties)
+        created = 0
+        for batch, annotation_json in zip(uncached_batches, annotations):
+            results = _load_annotation(annotation_json).get('sentences', [])
+            if len(results) != len(batch):
+                logger.warning(f'NLP server sent back {len(results)} sentences for {len(batch)}, '
+                               f'doing them one at a time')
+                for i in batch:
+                    sentences[i].build_triples()
+                continue
+            annotation_cache.put_many({keys[i]: {'sentences': [result]} for i, result in zip(batch, results)})
+            batches.append([(sentences[i], result) for i, result in zip(batch, results)])
+
+        for batch in batches:
+            triples = []
+            for sentence, result in batch:
+                sentence_triples = sentence._openie_triples(result)
+                if not sentence_triples:
+                    logger.warning(f"NO TRIPLES FOUND:\n{sentence.text}")
+                triples.extend(sentence_triples)
+            Triple.objects.bulk_create(triples)
+            # bulk_create doesn't send post_save, so the graphs (and their content hashes) have to be told
+            transaction.on_commit(functools.partial(_triples_saved, [triple for triple in triples if triple.id]))
+            graph_content.created(triples)
+            created += len(triples)
+        return created
+
+    def _openie_triples(self, sentence_json: Dict) -> List['Triple']:
+        """The (unsaved) triples from the openie results for one sentence"""
+        from text_generation.models.triple import Triple
+        triples = [Triple(sentence=self, subject=triple["subject"], relation=triple["relation"], object=triple["object"])
+                   for triple in sentence_json.get('openie', [])]
+        # bulk_create doesn't call save, which is where the tokens get made
+        for triple in triples:
+            triple.process_tokens()
+        return triples
+
     def __str__(self):
         """String for representing the Model object."""
         info = "%d: %s" % (self.position, self.text)
@@ -0,0 +1,24 @@
+import json
+import zlib
+from typing import Dict
+
+from django.db import models
+
+
+class TfIdfScores(models.Model):
+    """The tf-idf scores (and stemmed texts) of a set of sentences, saved as compressed json under the fingerprint of
+    the sentences' texts, see annotators/tf_idf_service.py"""
+    key = models.CharField(max_length=64, unique=True)
+    data = models.BinaryField()
+    # the least recently used ones get evicted once there are more than TF_IDF_CACHE_SIZE
+    last_used = models.DateTimeField(db_index=True)
+
+    @staticmethod
+    def pack(scores: Dict) -> bytes:
+        return zlib.compress(json.dumps(scores, separators=(',', ':')).encode())
+
+    def load(self) -> Dict:
+        return json.loads(zlib.decompress(bytes(self.data)))
+
+    def __str__(self):
+        return f'{self.key} ({self.last_used})'
@@ -1,20 +1,88 @@
+import hashlib
+from typing import Dict, List, Tuple
+
 from django.db import models
 
+ELEMENTS = ('subject', 'relation', 'object')
+
+
+def make_tokens(subject: str, relation: str, object_: str) -> Dict:
+    """The tokens a triple saves for its subject, relation and object, see Triple.element_tokens
+
+    :param str subject: the subject
+    :param str relation: the relation
+    :param str object_: the object
+    :return Dict: the key of the texts, and the [stemmed word, processed word, actual word] lists of each element
+    """
+    from text_generation.utilities import process_text
+
+    return {
+        'key': tokens_key(subject, relation, object_),
+        'subject': [list(token) for token in process_text(subject) if token.stemmed_word],
+        'relation': [list(token) for token in process_text(relation, False)],
+        'object': [list(token) for token in process_text(object_) if token.stemmed_word],
+    }
+
+
+def tokens_key(subject: str, relation: str, object_: str) -> str:
+    """Tells whether the tokens are for the subject, relation and object there are now, they can change without
+    save (e.g. update)"""
+    return hashlib.blake2b('\0'.join((subject, relation, object_)).encode(), digest_size=16).hexdigest()
+
 
 class Triple(models.Model):
     sentence = models.ForeignKey('Sentence', on_delete=models.CASCADE)
     subject = models.TextField()  # TODO change this to token (text, location, length)
-    # processed_subject = models.TextField()
     relation = models.TextField()
-    # processed_relation = models.TextField()
     object = models.TextField()
-    # processed_object = models.TextField()
     # store more info, anaphora, another class maybe, (original, anaphora)- only useful for sub and obj
 
     is_user_defined = models.BooleanField(default=False)
     is_deleted = models.BooleanField(default=False)
 
+    # the subject, relation and object as [stemmed word, processed word, actual word] lists, so building a graph
+    # doesn't have to process the text again, see element_tokens
+    tokens = models.JSONField(null=True, blank=True, editable=False)
+    # the text processing (stemmer and stop words) the tokens were made with, see utilities.TOKENS_VERSION
+    tokens_version = models.CharField(max_length=16, blank=True, default='', db_index=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.process_tokens()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'tokens', 'tokens_version'}
+        super().save(*args, **kwargs)
+
+    def process_tokens(self):
+        """Makes the tokens of the subject, relation and object, unless they were made already from the same text
+        with the same text processing"""
+        from text_generation.utilities import TOKENS_VERSION
+
+        if self.tokens_current():
+            return
+        self.tokens = make_tokens(self.subject, self.relation, self.object)
+        self.tokens_version = TOKENS_VERSION
+
+    def tokens_current(self) -> bool:
+        """Whether the tokens were made from the subject, relation and object there are now, with the text processing
+        there is now"""
+        from text_generation.utilities import TOKENS_VERSION
+
+        return (self.tokens_version == TOKENS_VERSION and bool(self.tokens)
+                and self.tokens.get('key') == tokens_key(self.subject, self.relation, self.object))
+
+    def element_tokens(self) -> Tuple[List, List, List]:
+        """The processed tokens of the subject, relation and object, the same as process_text gives for them (stop
+        words are kept in the relation) except that the subject and object leave out the words with nothing to stem,
+        the graph filters those out anyway
+
+        :return Tuple[List[Token], List[Token], List[Token]]: the subject, relation and object tokens
+        """
+        from text_generation.utilities import Token
+
+        self.process_tokens()
+        return tuple([Token(*token) for token in self.tokens[element]] for element in ELEMENTS)
+
     def __str__(self):
         """String for representing the Model object."""
         info = "%s, %s, %s" % (self.subject, self.relation, self.object)
-        return info
\ No newline at end of file
+        return info
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import zlib
+from typing import Dict
+
+from django.db import models
+
+
+class ContentHash:
+    """Order independent hash of the sentence and triple records that a graph is built from. It is the sum of the
+    sha256 of each record, so records can be added and removed one at a time as things change."""
+    MODULUS = 2 ** 256
+
+    def __init__(self):
+        self.value = 0
+
+    @staticmethod
+    def sentence_record(sentence) -> tuple:
+        return 'sentence', sentence.id, sentence.position, sentence.text
+
+    @staticmethod
+    def triple_record(triple) -> tuple:
+        return 'triple', triple.id, triple.sentence_id, triple.subject, triple.relation, triple.object
+
+    @staticmethod
+    def _digest(record: tuple) -> int:
+        return int.from_bytes(hashlib.sha256(json.dumps(record).encode()).digest(), 'big')
+
+    def add(self, record: tuple):
+        self.value = (self.value + self._digest(record)) % self.MODULUS
+
+    def remove(self, record: tuple):
+        self.value = (self.value - self._digest(record)) % self.MODULUS
+
+    def merge(self, other: 'ContentHash'):
+        """Adds the records that were added to other and takes out the ones that were removed from it"""
+        self.value = (self.value + other.value) % self.MODULUS
+
+    def hexdigest(self) -> str:
+        return format(self.value, '064x')
+
+    @classmethod
+    def from_hexdigest(cls, hexdigest: str) -> 'ContentHash':
+        content_hash = cls()
+        content_hash.value = int(hexdigest, 16)
+        return content_hash
+
+
+class TripleGraphSnapshot(models.Model):
+    """A built triple graph saved as compressed json, so it only has to be rebuilt when the sentences or triples it
+    was built from change. There is one per document and sentence scope (all sentences or just the intro)."""
+    document = models.ForeignKey(
+        'Document',
+        related_name='graph_snapshots',
+        on_delete=models.CASCADE)
+    all_sentences = models.BooleanField(default=False)
+    # hash of the sentences and triples the graph was built from
+    content_hash = models.CharField(max_length=64)
+    # TripleGraph.SNAPSHOT_VERSION when it was saved
+    version = models.IntegerField()
+    data = models.BinaryField()
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'all_sentences'], name='unique_graph_snapshot_scope')
+        ]
+
+    @staticmethod
+    def content_hash_for(sentences) -> str:
+        """Hashes everything a graph build reads, the sentences and their triples
+
+        :param List[Sentence] sentences: the sentences the graph is built from
+        :return str: hex digest
+        """
+        from text_generation.models.triple import Triple
+
+        content_hash = ContentHash()
+        sentences = {sentence.id: sentence for sentence in sentences}
+        for sentence in sentences.values():
+            content_hash.add(ContentHash.sentence_record(sentence))
+        for triple in Triple.objects.filter(sentence_id__in=list(sentences)).only(
+                'id', 'sentence_id', 'subject', 'relation', 'object'):
+            content_hash.add(ContentHash.triple_record(triple))
+        return content_hash.hexdigest()
+
+    @classmethod
+    def store(cls, document, all_sentences: bool, content_hash: str, snapshot: Dict) -> 'TripleGraphSnapshot':
+        """Saves the snapshot, replacing the old one for the same scope
+
+        :param Document document: the document the graph is for
+        :param bool all_sentences: whether the graph was built from all of the sentences or only the intro
+        :param str content_hash: from content_hash_for
+        :param Dict snapshot: from TripleGraph.to_snapshot
+        :return TripleGraphSnapshot:
+        """
+        stored, _ = cls.objects.update_or_create(
+            document=document,
+            all_sentences=all_sentences,
+            defaults={
+                'content_hash': content_hash,
+                'version': snapshot['version'],
+                'data': zlib.compress(json.dumps(snapshot, separators=(',', ':')).encode()),
+            })
+        return stored
+
+    def load(self) -> Dict:
+        """The snapshot dict that TripleGraph.from_snapshot takes"""
+        return json.loads(zlib.decompress(bytes(self.data)))
+
+    def __str__(self):
+        return f'{self.document_id}: {self.content_hash} (v{self.version})'
+
+
+class GraphContent(models.Model):
+    """The content hash of the sentences and triples that a document's graph gets built from now, kept up to date as
+    they get saved and deleted (see graph_content), so loading the graph can tell whether its snapshot is current
+    without reading and hashing all of them. There is one per document and sentence scope, once it's been worked out."""
+    document = models.ForeignKey(
+        'Document',
+        related_name='graph_contents',
+        on_delete=models.CASCADE)
+    all_sentences = models.BooleanField(default=False)
+    content_hash = models.CharField(max_length=64)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'all_sentences'], name='unique_graph_content_scope')
+        ]
+
+    def __str__(self):
+        return f'{self.document_id}: {self.content_hash}'
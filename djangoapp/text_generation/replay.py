@@ -0,0 +1,118 @@
+"""Records what the pipeline gets from outside (search pages and articles, CoreNLP annotations and OpenAI completions)
+into a fixture store, and plays it back instead of going to the network, so a whole generate_summarization can run
+(and be benchmarked) the same way every time without google, the sites, the NLP server or OpenAI. REPLAY_MODE
+decides what happens: off (the default) goes to the network as usual, record goes to the network and saves what came
+back, replay only uses what was saved and waits REPLAY_LATENCY seconds per call to stand in for the network."""
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict
+
+from living_documents_server import settings
+
+logger = logging.getLogger(__name__)
+
+OFF = 'off'
+RECORD = 'record'
+REPLAY = 'replay'
+MODES = (OFF, RECORD, REPLAY)
+
+
+class FixtureMissing(Exception):
+    """Replaying and nothing was recorded for the call"""
+
+
+class FixtureStore:
+    """
+    The recorded calls, one json file per call under directory/<kind>/, named
+    by a hash of what the call was (e.g. the url, or the text and properties
+    of an annotation).
+    """
+
+    def __init__(self, directory: str = settings.REPLAY_DIR, mode: str = settings.REPLAY_MODE,
+                 latency: Dict[str, float] = settings.REPLAY_LATENCY):
+        """
+        :param str directory: where the fixtures are kept
+        :param str mode: off, record or replay
+        :param Dict latency: kind -> seconds each replayed call of that kind takes
+        """
+        if mode not in MODES:
+            raise ValueError(f'REPLAY_MODE has to be one of {MODES}, not {mode}')
+        self.directory = directory
+        self.mode = mode
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.replayed = 0
+
+    def call(self, kind: str, key: Any, live: Callable[[], Any], dump: Callable[[Any], Any] = None,
+             load: Callable[[Any], Any] = None) -> Any:
+        """Makes the call live, live and records it, or replays it, depending on the mode
+
+        :param str kind: what sort of call it is, e.g. http, nlp or completion
+        :param key: anything json can dump that tells this call apart from others of its kind
+        :param Callable live: makes the call for real
+        :param Callable dump: turns what the call returned into something json can dump, as is if there isn't one
+        :param Callable load: turns what dump made back into what the call returns, as is if there isn't one
+        :return: what the call returned (or returned when it was recorded)
+        """
+        if self.mode == OFF:
+            return live()
+        path = self._path(kind, key)
+        if self.mode == REPLAY:
+            try:
+                with open(path) as fixture_file:
+                    data = json.load(fixture_file)['data']
+            except OSError:
+                raise FixtureMissing(f'Nothing was recorded for {kind} {key}') from None
+            time.sleep(self.latency.get(kind, 0))
+            with self._lock:
+                self.replayed += 1
+            return load(data) if load else data
+
+        value = live()
+        data = dump(value) if dump else value
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written next to it and moved over, so a replay never reads half a file
+        temporary = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary, 'w') as fixture_file:
+            json.dump({'key': key, 'data': data}, fixture_file)
+        os.replace(temporary, path)
+        with self._lock:
+            self.recorded += 1
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'mode': self.mode, 'recorded': self.recorded, 'replayed': self.replayed}
+
+    def _path(self, kind: str, key: Any) -> str:
+        name = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.directory, kind, name + '.json')
+
+
+def dump_bytes(content: bytes) -> str:
+    """For dump, bytes as text json can hold"""
+    return base64.b64encode(content).decode()
+
+
+def load_bytes(text: str) -> bytes:
+    """For load, the bytes dump_bytes made the text from"""
+    return base64.b64decode(text)
+
+
+_store_lock = threading.Lock()
+_store = None
+
+
+def get_store() -> FixtureStore:
+    """The process' fixture store, it's made the first time it's asked for"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = FixtureStore()
+        return _store
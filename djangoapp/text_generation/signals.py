@@ -1,8 +1,12 @@
+from text_generation.annotators import graph_content, graph_maintenance
 from text_generation.models.document import Document
 from text_generation.models.document_history import DocumentHistory
-from django.db.models.signals import post_save, pre_save
+from text_generation.models.sentence import Sentence
+from text_generation.models.triple import Triple
+from django.db.models.signals import post_save, pre_save, post_delete
 from django.db import transaction
 from django.dispatch import receiver
+import copy
 import logging
 import html
 
@@ -43,3 +47,45 @@ def make_history_signal(sender, instance, **kwargs):
     transaction.on_commit(lambda: make_history(instance.id))
 
 
+# the graphs only get changes that were committed, as they were when they were saved (the ids of deleted objects are
+# gone by the time the transaction commits)
+@receiver(post_save, sender=Sentence)
+def update_graphs_sentence_saved(sender, instance, created, **kwargs):
+    sentence = copy.copy(instance)
+    transaction.on_commit(lambda: graph_maintenance.sentence_saved(sentence, created))
+
+
+@receiver(post_delete, sender=Sentence)
+def update_graphs_sentence_deleted(sender, instance, **kwargs):
+    sentence_id = instance.id
+    transaction.on_commit(lambda: graph_maintenance.sentence_deleted(sentence_id))
+
+
+@receiver(post_save, sender=Triple)
+def update_graphs_triple_saved(sender, instance, **kwargs):
+    triple = copy.copy(instance)
+    transaction.on_commit(lambda: graph_maintenance.triple_saved(triple))
+
+
+@receiver(post_delete, sender=Triple)
+def update_graphs_triple_deleted(sender, instance, **kwargs):
+    triple_id = instance.id
+    transaction.on_commit(lambda: graph_maintenance.triple_deleted(triple_id))
+
+
+@receiver(pre_save, sender=Sentence)
+@receiver(pre_save, sender=Triple)
+def remember_graph_content(sender, instance, **kwargs):
+    graph_content.remember(instance)
+
+
+@receiver(post_save, sender=Sentence)
+@receiver(post_save, sender=Triple)
+def update_graph_content_saved(sender, instance, **kwargs):
+    graph_content.saved(instance)
+
+
+@receiver(post_delete, sender=Sentence)
+@receiver(post_delete, sender=Triple)
+def update_graph_content_deleted(sender, instance, **kwargs):
+    graph_content.deleted(instance)
@@ -7,11 +7,24 @@ import string
 from transformers import BartTokenizer, BartForConditionalGeneration, BartConfig
 from transformers import pipeline
 
+from living_documents_server.settings import SUMMARIZER_BATCH_TOKENS
 from text_generation.models.sentence import Sentence
+from text_generation.summarizers import model_registry
+from text_generation.summarizers.batching import token_budget_batches
 
 logger = logging.getLogger(__name__)
 
 
+def load_model():
+    model = BartForConditionalGeneration.from_pretrained('facebook/bart-large-cnn', cache_dir="./text_generation/summarizers/transformer_cache/")
+    model.eval()
+    tokenizer = BartTokenizer.from_pretrained('facebook/bart-large-cnn', cache_dir="./text_generation/summarizers/transformer_cache/")
+    return model, tokenizer
+
+
+model_registry.register('bart', load_model)
+
+
 class BartSummarizer:
     """This class takes a bunch of articles and creates an abstractive summarization using BART model."""
 
@@ -47,33 +60,54 @@ class BartSummarizer:
         :param section: the section (if there is one) to add the sentence to
         :return: list of the ids of the sentences that were added
         """
+        return self._save_sentences(document, article, self.summarize_texts([text])[0], section)
 
-        model = BartForConditionalGeneration.from_pretrained('facebook/bart-large-cnn', cache_dir="./text_generation/summarizers/transformer_cache/")
-        tokenizer = BartTokenizer.from_pretrained('facebook/bart-large-cnn', cache_dir="./text_generation/summarizers/transformer_cache/")
-        # text_input = nltk.tokenize.sent_tokenize(text)
-
-        text_words = nltk.tokenize.word_tokenize(text)
-        text_input = []
-        for i in range(0, len(text_words), 1024):
-            text_input.append(' '.join(text_words[i:i+1024]))
+    def summarize_many(self, document, articles, section=None) -> List[List[int]]:
+        """
+        Summarizes all of the articles together, their chunks go through the model in shared batches
+        :param document: This is of type document in the models.py
+        :param articles: the articles to summarize
+        :param section: the section (if there is one) to add the sentences to
+        :return: for each article, list of the ids of the sentences that were added
+        """
+        summaries = self.summarize_texts([article.text for article in articles])
+        return [self._save_sentences(document, article, summary, section)
+                for article, summary in zip(articles, summaries)]
 
-        inputs = tokenizer(text_input, max_length=1024, return_tensors='pt', truncation=True, padding=True)
-        # Generate Summary
-        summary_ids = model.generate(inputs['input_ids'], num_beams=5, max_length=self.words, early_stopping=True)
-        text_sum = [tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=False) for g in summary_ids]
+    def summarize_texts(self, texts: List[str]) -> List[List[str]]:
+        """
+        Summarizes each text. The texts are cut into chunks of 1024 words and the chunks of all of the texts are run
+        through generate in padded batches of at most SUMMARIZER_BATCH_TOKENS tokens
+        :param texts: the texts to summarize
+        :return: the summary sentences for each text
+        """
+        model, tokenizer = model_registry.get('bart')
+
+        chunks = []  # (index of the text, chunk)
+        for index, text in enumerate(texts):
+            text_words = nltk.tokenize.word_tokenize(text)
+            for i in range(0, len(text_words), 1024):
+                chunks.append((index, ' '.join(text_words[i:i+1024])))
+        lengths = [len(tokenizer(chunk, max_length=1024, truncation=True)['input_ids']) for _, chunk in chunks]
+
+        text_sum = [''] * len(chunks)
+        for batch in token_budget_batches(lengths, SUMMARIZER_BATCH_TOKENS):
+            inputs = tokenizer([chunks[i][1] for i in batch], max_length=1024, return_tensors='pt', truncation=True,
+                               padding=True)
+            # Generate Summary
+            with model_registry.inference('bart'):
+                summary_ids = model.generate(inputs['input_ids'], attention_mask=inputs['attention_mask'],
+                                             num_beams=5, max_length=self.words, early_stopping=True)
+            for i, g in zip(batch, summary_ids):
+                text_sum[i] = tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=False)
 
         # tokenize the sentences to insert into the data model
-        # final_sum_sents = [nltk.tokenize.sent_tokenize(text_sum[i]) for i in range(len(text_sum))]
-        final_sum_sents = []
-        for i in range(len(text_sum)):
-            new_sent = self.sent_remove_punc(text_sum[i])
-            final_sum_sents += nltk.tokenize.sent_tokenize(text_sum[i])
-        print(final_sum_sents)
-
-        # summarizer = pipeline("summarization")
-        # final_sum_sents = summarizer(text, max_length=125, min_length=30, do_sample=False)['summary_text']
-
+        final_sum_sents = [[] for _ in texts]
+        for (index, _), chunk_sum in zip(chunks, text_sum):
+            final_sum_sents[index] += nltk.tokenize.sent_tokenize(chunk_sum)
+        return final_sum_sents
 
+    def _save_sentences(self, document, article, final_sum_sents: List[str], section=None) -> List[int]:
         final_sent_ids = []  # keep track of sentence ids
         for sent in final_sum_sents:
             if section is not None:
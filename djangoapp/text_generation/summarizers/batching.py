@@ -0,0 +1,31 @@
+from typing import List
+
+
+def token_budget_batches(lengths: List[int], budget: int) -> List[List[int]]:
+    """Groups inputs into batches for a padded generate call. Inputs of about the same length go together so there
+    is little padding, and a batch's padded size (how many inputs times the longest one) stays within the budget.
+    An input that is longer than the budget on its own gets a batch to itself.
+
+    Parameters
+    ----------
+    lengths
+        how many tokens each input has
+    budget
+        the most tokens (padding included) a batch can have
+
+    Returns
+    -------
+    List[List[int]]
+        indexes into lengths for each batch
+    """
+    batches = []
+    batch = []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # sorted, so this one is the longest in the batch
+        if batch and (len(batch) + 1) * lengths[index] > budget:
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(batch)
+    return batches
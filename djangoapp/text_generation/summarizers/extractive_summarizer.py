@@ -197,6 +197,7 @@ class ExtractiveSummarizer:
         logger.warn('{}: Adding sentences to document'.format(
             datetime.datetime.now()))
         i = 0  # position in dictionary
+        new_sents = []
         for a in final_sel_var_list:
             sentence = sentences[int(a)]
             sentence = sentence.strip()
@@ -209,8 +210,9 @@ class ExtractiveSummarizer:
             else:
                 new_sent = Sentence(document=document, text=sentence, position=i)
             new_sent.save()
-            new_sent.build_triples()
+            new_sents.append(new_sent)
             i = i + 1
+        Sentence.build_triples_bulk(new_sents)
 
         logger.warn('{}: Finished generating summary'.format(
             datetime.datetime.now()))
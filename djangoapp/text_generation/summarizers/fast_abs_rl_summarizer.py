@@ -31,6 +31,7 @@ from .fast_abs_rl.model.extract import PtrExtractSumm
 from .fast_abs_rl.model.rl import ActorCritic
 from .fast_abs_rl.data.batcher import conver2id, pad_batch_tensorize
 from text_generation.models.sentence import Sentence
+from text_generation.summarizers import model_registry
 from living_documents_server import settings
 
 logger = logging.getLogger(__name__)
@@ -180,11 +181,8 @@ def _process_beam(id2word, beam, art_sent):
         return hyp
     return list(map(process_hyp, beam))
 
-def decode(input_doc, model_dir, batch_size,
-           beam_size, diverse, max_len, cuda):
-    start = time()
-    # setup model
-    logger.warning('{}: Got to decode'.format(datetime.datetime.now()))
+def load_models(model_dir, beam_size, max_len, cuda):
+    """The abstractor and extractor that decode runs"""
     with open(join(model_dir, 'meta.json')) as f:
         meta = json.loads(f.read())
     if meta['net_args']['abstractor'] is None:
@@ -200,6 +198,17 @@ def decode(input_doc, model_dir, batch_size,
             abstractor = BeamAbstractor(join(model_dir, 'abstractor'),
                                         max_len, cuda)
     extractor = RLExtractor(model_dir, cuda=cuda)
+    return abstractor, extractor
+
+
+def decode(input_doc, model_dir, batch_size,
+           beam_size, diverse, max_len, cuda):
+    start = time()
+    # setup model
+    logger.warning('{}: Got to decode'.format(datetime.datetime.now()))
+    model_name = 'fast_abs_rl-beam{}'.format(beam_size)
+    abstractor, extractor = model_registry.get(
+        model_name, lambda: load_models(model_dir, beam_size, max_len, cuda))
 
     # setup loader
     def coll(batch):
@@ -215,7 +224,7 @@ def decode(input_doc, model_dir, batch_size,
     # Decoding
     i = 0
     output_summ = []
-    with torch.no_grad():
+    with torch.no_grad(), model_registry.inference(model_name):
         for i_debug, raw_article_batch in enumerate(loader):
             # print(i_debug)
             tokenized_article_batch = map(tokenize(None), raw_article_batch)
@@ -300,6 +309,12 @@ def summarize_func(input_doc, beam_size):
     logger.warning('{}: Decode finished'.format(datetime.datetime.now()))
     return summ_results
 
+
+# what FastSummarizer decodes with, so it can be warmed up
+model_registry.register('fast_abs_rl-beam5', lambda: load_models(
+    settings.FAST_ABS_RL_SUMMARIZER_MODEL_DIR, 5, settings.FAST_ABS_RL_SUMMARIZER_MAX_LEN,
+    settings.FAST_ABS_RL_SUMMARIZER_CUDA and torch.cuda.is_available()))
+
 class FastSummarizer:
     """This class takes a bunch of articles and creates an extractive summarization based on textrank algorithm."""
 
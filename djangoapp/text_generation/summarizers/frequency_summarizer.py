@@ -4,8 +4,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
 import unittest
 
 import nltk
-from pycorenlp import StanfordCoreNLP
-
+from text_generation.annotators.nlp_client import get_client
 from text_generation.utilities import tf_idf_reduce_noun_adjectives
 from text_generation.models.sentence import Sentence
 
@@ -17,8 +16,7 @@ class FrequencySummarizer:
     def __init__(self, min_cut: float = 0.1, max_cut: float = 0.9):
         self._min_cut = min_cut
         self._max_cut = max_cut
-        self.nlp_server = StanfordCoreNLP(
-            'http://lws-hanrahan.ist.psu.edu:8080')
+        self.nlp_server = get_client('http://lws-hanrahan.ist.psu.edu:8080')
 
     def summarize(self, document, article, text: str, n: int = 20, section=None):
         """
@@ -14,6 +14,7 @@ nltk.download('stopwords')
 import openai as ai
 
 from .gpt3_info.secrets import OPENAI_KEY
+from text_generation import replay
 from text_generation.models.sentence import Sentence
 from text_generation.models.keyword import Keyword
 
@@ -40,9 +41,15 @@ def getMaxTokensNumber(textPrompt):
 
     return 4096 - numTokens
 
+def completion_with_backoff(**kwargs):
+    # recorded and replayed like the rest of what comes from outside, see replay
+    return replay.get_store().call('completion', kwargs, lambda: _completion_with_backoff(**kwargs),
+                                   load=ai.util.convert_to_openai_object)
+
+
 # copied from https://platform.openai.com/docs/guides/rate-limits/error-mitigation
 @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(7))
-def completion_with_backoff(**kwargs):
+def _completion_with_backoff(**kwargs):
     return ai.Completion.create(**kwargs)
 
 class GPT3Summarizer:
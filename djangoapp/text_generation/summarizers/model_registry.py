@@ -0,0 +1,155 @@
+"""Loads each summarizer model (weights, tokenizer, checkpoint...) once per process instead of once per article. The
+summarizer modules register a loader under a name and get the loaded model back from here. Models listed in
+SUMMARIZER_WARM_MODELS get loaded when the app starts, and once the loaded models take more than
+SUMMARIZER_MODEL_MEMORY_MB the least recently used ones get dropped."""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable
+
+from living_documents_server.settings import SUMMARIZER_MODEL_MEMORY_MB
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+# name -> function that loads the model
+_loaders = {}
+# name -> lock held while the model loads, so two requests don't both load it
+_load_locks = {}
+# name -> loaded model, least recently used first
+_models = OrderedDict()
+# name -> size of the loaded model in bytes
+_sizes = {}
+# name -> load and inference counts and times
+_stats = {}
+
+
+def register(name: str, loader: Callable[[], Any]):
+    """Says how to load a model, it doesn't get loaded until get (or warm_up) asks for it
+
+    :param str name: what the model is called in get, warm_up, stats and SUMMARIZER_WARM_MODELS
+    :param Callable loader: takes no arguments and returns the model, e.g. a (model, tokenizer) tuple
+    """
+    with _lock:
+        _loaders[name] = loader
+        _load_locks.setdefault(name, threading.Lock())
+        _stats.setdefault(name, {'loads': 0, 'load_seconds': 0.0, 'inferences': 0, 'inference_seconds': 0.0})
+
+
+def get(name: str, loader: Callable[[], Any] = None) -> Any:
+    """The loaded model, it gets loaded the first time it's asked for
+
+    :param str name: the name it was registered under
+    :param Callable loader: registers the model under the name if it isn't already
+    :return: whatever the loader returned
+    """
+    with _lock:
+        if name not in _loaders:
+            if loader is None:
+                raise KeyError(f'no summarizer model registered as {name}')
+            register(name, loader)
+        if name in _models:
+            _models.move_to_end(name)
+            return _models[name]
+        load_lock = _load_locks[name]
+
+    with load_lock:
+        with _lock:
+            if name in _models:
+                _models.move_to_end(name)
+                return _models[name]
+        start = time.perf_counter()
+        model = _loaders[name]()
+        seconds = time.perf_counter() - start
+        size = _size_of(model)
+        logger.warning(f'Loaded summarizer model {name} in {seconds:.1f}s ({size / 2 ** 20:.0f}MB)')
+        with _lock:
+            _models[name] = model
+            _sizes[name] = size
+            _stats[name]['loads'] += 1
+            _stats[name]['load_seconds'] += seconds
+            _evict_over_limit(keep=name)
+        return model
+
+
+@contextmanager
+def inference(name: str):
+    """Times what runs inside it as inference for the model, for stats
+
+    :param str name: the model's name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            _stats[name]['inferences'] += 1
+            _stats[name]['inference_seconds'] += seconds
+
+
+def warm_up(names: Iterable[str]):
+    """Loads the models now so the first summary doesn't wait for them"""
+    for name in names:
+        try:
+            get(name)
+        except Exception:
+            logger.exception(f'Could not warm up summarizer model {name}')
+
+
+def evict(name: str):
+    """Drops the loaded model, the next get loads it again"""
+    with _lock:
+        _models.pop(name, None)
+        _sizes.pop(name, None)
+
+
+def stats() -> Dict[str, Dict[str, float]]:
+    """Per model: how many times and for how long (seconds) it was loaded and ran inference, and its size in MB if
+    it's loaded"""
+    with _lock:
+        return {name: dict(counts, loaded=name in _models, size_mb=_sizes.get(name, 0) / 2 ** 20)
+                for name, counts in _stats.items()}
+
+
+def clear():
+    """Drops all of the loaded models and the stats, the loaders stay registered"""
+    with _lock:
+        _models.clear()
+        _sizes.clear()
+        for counts in _stats.values():
+            for key in counts:
+                counts[key] = 0
+
+
+def _evict_over_limit(keep: str):
+    limit = SUMMARIZER_MODEL_MEMORY_MB * 2 ** 20
+    for name in list(_models):
+        if sum(_sizes.values()) <= limit:
+            break
+        if name != keep:
+            logger.warning(f'Evicting summarizer model {name} ({_sizes[name] / 2 ** 20:.0f}MB) to stay under '
+                           f'{SUMMARIZER_MODEL_MEMORY_MB}MB')
+            evict(name)
+
+
+def _size_of(model: Any, seen: set = None) -> int:
+    """Roughly how many bytes the model's tensors take up. It counts the parameters and buffers of torch modules and
+    any tensors, also inside tuples, lists, dicts and plain objects, everything else counts as nothing."""
+    seen = set() if seen is None else seen
+    if id(model) in seen or model is None or isinstance(model, (str, bytes, int, float, bool)):
+        return 0
+    seen.add(id(model))
+    if hasattr(model, 'parameters') and hasattr(model, 'buffers'):
+        return sum(_size_of(tensor, seen) for tensor in list(model.parameters()) + list(model.buffers()))
+    if hasattr(model, 'numel') and hasattr(model, 'element_size'):
+        return model.numel() * model.element_size()
+    if isinstance(model, dict):
+        return sum(_size_of(value, seen) for value in model.values())
+    if isinstance(model, (list, tuple, set)):
+        return sum(_size_of(value, seen) for value in model)
+    if hasattr(model, '__dict__'):
+        return sum(_size_of(value, seen) for value in vars(model).values())
+    return 0
@@ -25,6 +25,7 @@ from .pre_summ.models.model_builder import ExtSummarizer
 from .pre_summ.models.trainer_ext import build_trainer
 from .pre_summ.models.predictor import build_predictor
 from .pre_summ.others.logging import logger, init_logger
+from text_generation.summarizers import model_registry
 sys.path.append(os.path.abspath(os.path.join('text_generation/summarizers/pre_summ')))
 
 
@@ -113,6 +114,46 @@ class Args:
         self.block_trigram = True
 
 
+ABS_MODEL_PATH = 'text_generation/summarizers/pre_summ/pre-trained_models/bertsumextabs_cnndm_final_model.pt'
+EXT_MODEL_PATH = 'text_generation/summarizers/pre_summ/pre-trained_models/bertext_cnndm_transformer.pt'
+
+
+def _load_checkpoint(args, path):
+    """Loads the checkpoint and sets the model flags it was trained with on args
+
+    :return: the checkpoint and the model flags
+    """
+    logger.info('Loading checkpoint from %s' % path)
+    checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+    opt = {k: v for k, v in vars(checkpoint['opt']).items() if k in model_flags}
+    for k, v in opt.items():
+        setattr(args, k, v)
+    return checkpoint, opt
+
+
+def load_abs_model():
+    args = Args()
+    checkpoint, opt = _load_checkpoint(args, ABS_MODEL_PATH)
+    device = "cpu" if args.visible_gpus == '-1' else "cuda"
+    model = AbsSummarizer(args, device, checkpoint)
+    model.eval()
+    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True, cache_dir=args.temp_dir)
+    return opt, model, tokenizer
+
+
+def load_ext_model():
+    args = Args()
+    checkpoint, opt = _load_checkpoint(args, EXT_MODEL_PATH)
+    device = "cpu" if args.visible_gpus == '-1' else "cuda"
+    model = ExtSummarizer(args, device, checkpoint)
+    model.eval()
+    return opt, model
+
+
+model_registry.register('presumm_abs', load_abs_model)
+model_registry.register('presumm_ext', load_ext_model)
+
+
 class PreSummSummarizer:
     def __init__(self):
         self.args = Args()
@@ -158,27 +199,21 @@ class PreSummSummarizer:
                 new_input += new_paragraph
         text_input = new_input
 
-        self.args.test_from = 'text_generation/summarizers/pre_summ/pre-trained_models/bertsumextabs_cnndm_final_model.pt'
-        logger.info('Loading checkpoint from %s' % self.args.test_from)
+        self.args.test_from = ABS_MODEL_PATH
         device = "cpu" if self.args.visible_gpus == '-1' else "cuda"
 
-        checkpoint = torch.load(self.args.test_from, map_location=lambda storage, loc: storage)
-        opt = vars(checkpoint['opt'])
-        for k in opt.keys():
-            if (k in model_flags):
-                setattr(self.args, k, opt[k])
+        opt, model, tokenizer = model_registry.get('presumm_abs')
+        for k, v in opt.items():
+            setattr(self.args, k, v)
         # print(args)
 
-        model = AbsSummarizer(self.args, device, checkpoint)
-        model.eval()
-
         test_iter = data_loader.load_text(self.args, text_input, device)
 
-        tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True, cache_dir=self.args.temp_dir)
         symbols = {'BOS': tokenizer.vocab['[unused0]'], 'EOS': tokenizer.vocab['[unused1]'],
                    'PAD': tokenizer.vocab['[PAD]'], 'EOQ': tokenizer.vocab['[unused2]']}
         predictor = build_predictor(self.args, tokenizer, symbols, model, logger)
-        final_summ = predictor.translate(test_iter, -1)
+        with model_registry.inference('presumm_abs'):
+            final_summ = predictor.translate(test_iter, -1)
         # print(final_summ)
         return final_summ
 
@@ -229,26 +264,21 @@ class PreSummSummarizer:
                 new_input += new_paragraph
             text_input = new_input
 
-        self.args.test_from = 'text_generation/summarizers/pre_summ/pre-trained_models/bertext_cnndm_transformer.pt'
-        logger.info('Loading checkpoint from %s' % self.args.test_from)
-        checkpoint = torch.load(self.args.test_from, map_location=lambda storage, loc: storage)
-        opt = vars(checkpoint['opt'])
-        for k in opt.keys():
-            if (k in model_flags):
-                setattr(self.args, k, opt[k])
+        self.args.test_from = EXT_MODEL_PATH
+        opt, model = model_registry.get('presumm_ext')
+        for k, v in opt.items():
+            setattr(self.args, k, v)
         # print(args)
         device = "cpu" if self.args.visible_gpus == '-1' else "cuda"
         device_id = 0 if device == "cuda" else -1
 
-        model = ExtSummarizer(self.args, device, checkpoint)
-        model.eval()
-
         test_iter = data_loader.load_text(self.args, text_input, device)
 
         trainer = build_trainer(self.args, device_id, model, None)
         final_summ = ""
         try:
-            final_summ = trainer.test(test_iter, -1)
+            with model_registry.inference('presumm_ext'):
+                final_summ = trainer.test(test_iter, -1)
         except:
             pass
         # print(final_summ)
@@ -7,11 +7,24 @@ import string
 from transformers import AutoModelWithLMHead, AutoTokenizer
 from transformers import pipeline
 
+from living_documents_server.settings import SUMMARIZER_BATCH_TOKENS
 from text_generation.models.sentence import Sentence
+from text_generation.summarizers import model_registry
+from text_generation.summarizers.batching import token_budget_batches
 
 logger = logging.getLogger(__name__)
 
 
+def load_model():
+    model = AutoModelWithLMHead.from_pretrained("t5-base", cache_dir="./text_generation/summarizers/transformer_cache/")
+    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained("t5-base", cache_dir="./text_generation/summarizers/transformer_cache/")
+    return model, tokenizer
+
+
+model_registry.register('t5', load_model)
+
+
 class T5Summarizer:
     """This class takes a bunch of articles and creates an abstractive summarization using BART model."""
 
@@ -47,27 +60,55 @@ class T5Summarizer:
         :param section: the section (if there is one) to add the sentence to
         :return: list of the ids of the sentences that were added
         """
-        model = AutoModelWithLMHead.from_pretrained("t5-base", cache_dir="./text_generation/summarizers/transformer_cache/")
-        tokenizer = AutoTokenizer.from_pretrained("t5-base", cache_dir="./text_generation/summarizers/transformer_cache/")
-        # text_input = nltk.tokenize.sent_tokenize(text)
+        return self._save_sentences(document, article, self.summarize_texts([text])[0], section)
+
+    def summarize_many(self, document, articles, section=None) -> List[List[int]]:
+        """
+        Summarizes all of the articles together, their chunks go through the model in shared batches
+        :param document: This is of type document in the models.py
+        :param articles: the articles to summarize
+        :param section: the section (if there is one) to add the sentences to
+        :return: for each article, list of the ids of the sentences that were added
+        """
+        summaries = self.summarize_texts([article.text for article in articles])
+        return [self._save_sentences(document, article, summary, section)
+                for article, summary in zip(articles, summaries)]
+
+    def summarize_texts(self, texts: List[str]) -> List[List[str]]:
+        """
+        Summarizes each text. The chunks of all of the texts are run through generate in padded batches of at most
+        SUMMARIZER_BATCH_TOKENS tokens
+        :param texts: the texts to summarize
+        :return: the summary sentences for each text
+        """
+        model, tokenizer = model_registry.get('t5')
 
-        text_words = nltk.tokenize.word_tokenize(text)
-        text_sum = []
         # T5 uses a max_length of 512 so we cut the article to 512 tokens.
-        for i in range(0, len(text_words), 512):
-            text_input = ' '.join(text_words[i:i+1024])
-            inputs = tokenizer.encode("summarize: " + text_input, return_tensors="pt", max_length=512, truncation=True)
-            outputs = model.generate(inputs, max_length=self.words, min_length=40, length_penalty=2.0, num_beams=4, early_stopping=True)
-            text_output = [tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=False) for g in outputs]
-            text_sum.append(text_output[0])
-        # print(text_sum)
-
-        final_sum_sents = []
-        for i in range(len(text_sum)):
-            new_sent = self.sent_remove_punc(text_sum[i])
-            final_sum_sents += nltk.tokenize.sent_tokenize(new_sent)
-        print(final_sum_sents)
+        chunks = []  # (index of the text, chunk)
+        for index, text in enumerate(texts):
+            text_words = nltk.tokenize.word_tokenize(text)
+            for i in range(0, len(text_words), 512):
+                chunks.append((index, "summarize: " + ' '.join(text_words[i:i+1024])))
+        lengths = [len(tokenizer(chunk, max_length=512, truncation=True)['input_ids']) for _, chunk in chunks]
+
+        text_sum = [''] * len(chunks)
+        for batch in token_budget_batches(lengths, SUMMARIZER_BATCH_TOKENS):
+            inputs = tokenizer([chunks[i][1] for i in batch], return_tensors="pt", max_length=512, truncation=True,
+                               padding=True)
+            with model_registry.inference('t5'):
+                outputs = model.generate(inputs['input_ids'], attention_mask=inputs['attention_mask'],
+                                         max_length=self.words, min_length=40, length_penalty=2.0, num_beams=4,
+                                         early_stopping=True)
+            for i, g in zip(batch, outputs):
+                text_sum[i] = tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+        final_sum_sents = [[] for _ in texts]
+        for (index, _), chunk_sum in zip(chunks, text_sum):
+            new_sent = self.sent_remove_punc(chunk_sum)
+            final_sum_sents[index] += nltk.tokenize.sent_tokenize(new_sent)
+        return final_sum_sents
 
+    def _save_sentences(self, document, article, final_sum_sents: List[str], section=None) -> List[int]:
         final_sent_ids = []  # keep track of sentence ids
         for sent in final_sum_sents:
             if section is not None:
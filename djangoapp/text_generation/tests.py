@@ -1,15 +1,67 @@
+import importlib
+import itertools
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
 from collections import OrderedDict
-
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+import numpy as np
+from django.apps import apps
 from django.contrib.auth.models import User
 from django.test import TestCase
 from rest_framework.test import APIClient
-
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+
+from text_generation import replay
+from living_documents_server import settings
+from text_generation.annotators import annotation_cache, corpus_idf, graph_maintenance, tf_idf_service
+from text_generation.annotators.corpus_idf import CorpusIdf
+from text_generation.annotators.nlp_client import NLPClient, NLPServerError
+from text_generation.annotators.term_stats import TermStats
+from text_generation.annotators.triple_graph import TripleGraph
 from text_generation.extractors.article_extractor import ArticleExtractor
 from text_generation.extractors.google_extractor import GoogleExtractor
-from .models import Sentence, Document, Section, Keyword, Article
+from text_generation.extractors import dedup, fetch_pool, http_cache, parse_pool, politeness, retrieval_context
+from text_generation.extractors.dedup import Deduplicator
+from text_generation.extractors.fetch_pool import Download, FetchPool
+from text_generation.extractors.http_cache import HTTPCache, body_encoding, normalize_url
+from text_generation.extractors.parse_pool import ParsedArticle, ParsePool
+from text_generation.extractors.politeness import PolitenessScheduler
+from text_generation.extractors.query_expansion import top_terms
+from text_generation.extractors.retrieval_context import RetrievalContext
+from text_generation.replay import FixtureMissing, FixtureStore, OFF, RECORD, REPLAY
+from text_generation.summarizers import model_registry
+from text_generation.summarizers.batching import token_budget_batches
+from text_generation import utilities
+from text_generation.utilities import stemmed_text, tf_idf_scores
+from .models import (Sentence, Document, Section, Keyword, Article, Triple, TripleGraphSnapshot, GraphContent,
+                     CachedAnnotation, TfIdfScores)
+from .models.triple import make_tokens
 from .serializers import DocumentSerializer, ArticleSerializer, SentenceSerializer
 
 
+def _empty_corpus_idf(test_case):
+    """Gives the test a corpus idf of its own that starts out empty, so the articles it extracts don't go into the
+    real one and the scores it checks don't come from it"""
+    directory = tempfile.TemporaryDirectory()
+    test_case.addCleanup(directory.cleanup)
+    for patcher in [mock.patch.object(settings, 'CORPUS_IDF_DIR', directory.name),
+                    mock.patch.object(corpus_idf, '_stores', {})]:
+        patcher.start()
+        test_case.addCleanup(patcher.stop)
+    # the articles still being added go into the test's own
+    test_case.addCleanup(corpus_idf.flush)
+
+
 class DeepLearningIntegrationTest(TestCase):
     def test_pytorch_version(self):
         import torch
@@ -117,6 +169,205 @@ class DocumentTest(TestCase):
         # print(self.document.sentences.all())
 
 
+class TripleGraphSnapshotTest(TestCase):
+    def setUp(self):
+        self.document = Document.objects.create(title='Mary')
+        for position, (text, triple) in enumerate([
+                ('Mary had a little lamb.', ('Mary', 'had', 'little lamb')),
+                ('The lamb followed Mary to school.', ('lamb', 'followed', 'Mary')),
+                ('Phil had a big goat.', ('Phil', 'had', 'big goat'))]):
+            sentence = Sentence.objects.create(text=text, document=self.document, position=position)
+            Triple.objects.create(sentence=sentence, subject=triple[0], relation=triple[1], object=triple[2])
+
+    def tearDown(self):
+        graph_maintenance.clear()
+
+    def test_load_uses_snapshot(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.document.load_triple_graph(useAllSentences=True)
+        built = self.document.graph
+        self.assertEqual(TripleGraphSnapshot.objects.filter(document=self.document).count(), 1)
+
+        # like a fresh process, nothing kept in memory
+        graph_maintenance.clear()
+        document = Document.objects.get(pk=self.document.id)
+        with mock.patch.object(Document, 'build_triple_graph', side_effect=AssertionError('rebuilt the graph')), \
+                mock.patch.object(TripleGraphSnapshot, 'content_hash_for', side_effect=AssertionError('hashed')):
+            document.load_triple_graph(useAllSentences=True)
+        self.assertEqual(str(document.graph), str(built))
+        self.assertEqual(document.graph.tree_data(), built.tree_data())
+        self.assertEqual(document.tf_idf_scores, self.document.tf_idf_scores)
+        lamb = document.graph.get_node('lamb')
+        self.assertEqual({sentence.id for sentence in lamb.sentences},
+                         {sentence.id for sentence in built.get_node('lamb').sentences})
+
+    def test_change_rebuilds(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.document.load_triple_graph(useAllSentences=True)
+        old_hash = TripleGraphSnapshot.objects.get(document=self.document).content_hash
+
+        # like another process, the graph kept in memory doesn't see it but the saved content hash does
+        graph_maintenance.clear()
+        triple = Triple.objects.get(subject='Phil')
+        triple.object = 'school'
+        with self.captureOnCommitCallbacks(execute=True):
+            triple.save()
+        document = Document.objects.get(pk=self.document.id)
+        document.load_triple_graph(useAllSentences=True)
+        self.assertIsNotNone(document.graph.get_node('school'))
+        self.assertIsNone(document.graph.get_node('goat'))
+        snapshot = TripleGraphSnapshot.objects.get(document=self.document)
+        self.assertNotEqual(snapshot.content_hash, old_hash)
+
+
+class GraphMaintenanceTest(TestCase):
+    def setUp(self):
+        _empty_corpus_idf(self)
+        graph_maintenance.clear()
+        self.document = Document.objects.create(title='Mary')
+        self.sentences = []
+        for position in range(50):
+            sentence = Sentence.objects.create(
+                text=f'Mary had lamb{position} and goat{position} at farm{position % 5}.',
+                document=self.document, position=position)
+            Triple.objects.create(sentence=sentence, subject='Mary', relation='had',
+                                  object=f'lamb{position} goat{position}')
+            Triple.objects.create(sentence=sentence, subject=f'goat{position}', relation='lived at',
+                                  object=f'farm{position % 5}')
+            self.sentences.append(sentence)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.document.load_triple_graph(useAllSentences=True)
+
+    def tearDown(self):
+        graph_maintenance.clear()
+
+    @staticmethod
+    def _contents(graph):
+        """What is in the graph regardless of the order it was put together in"""
+        nodes = set()
+        edges = set()
+        for node in graph.iter_nodes():
+            nodes.add((node.token, node.speech_type, frozenset(sentence.id for sentence in node.sentences)))
+            for child, weight in node.children.items():
+                edges.add((node.token, node.speech_type, child.token, child.speech_type, weight))
+        return nodes, edges
+
+    def _assert_matches_rebuild(self):
+        document = Document.objects.get(pk=self.document.id)
+        with mock.patch.object(Document, 'build_triple_graph', side_effect=AssertionError('rebuilt the graph')), \
+                mock.patch.object(TripleGraphSnapshot, 'content_hash_for', side_effect=AssertionError('hashed')):
+            document.load_triple_graph(useAllSentences=True)
+        maintained = document.graph
+        # the saved hash was kept up to date by the saves and deletes
+        self.assertEqual(GraphContent.objects.get(document=self.document, all_sentences=True).content_hash,
+                         TripleGraphSnapshot.content_hash_for(document._graph_sentences(useAllSentences=True)))
+
+        rebuilt = Document.objects.get(pk=self.document.id)
+        rebuilt.calculate_tf_idf_scores(useAllSentences=True)
+        rebuilt.build_triple_graph(useAllSentences=True)
+        self.assertEqual(self._contents(maintained), self._contents(rebuilt.graph))
+
+    def test_edit_one_sentence(self):
+        sentence = Sentence.objects.get(pk=self.sentences[10].id)
+        sentence.text = 'Mary had lamb10 and goat10 at farm3.'
+        with mock.patch.object(graph_maintenance, 'stemmed_text', wraps=graph_maintenance.stemmed_text) as stem, \
+                mock.patch.object(TripleGraph, 'insert_triple', autospec=True,
+                                  side_effect=TripleGraph.insert_triple) as insert, \
+                self.captureOnCommitCallbacks(execute=True):
+            sentence.save()
+            triple = Triple.objects.get(sentence=sentence, relation='lived at')
+            triple.object = 'farm3'
+            triple.save()
+        # one sentence worth of work, not fifty
+        self.assertEqual(stem.call_count, 1)
+        self.assertEqual(insert.call_count, 3)
+        self._assert_matches_rebuild()
+
+    def test_scores_match_refit(self):
+        sentence = Sentence.objects.get(pk=self.sentences[10].id)
+        sentence.text = 'Mary had lamb10 and goat10 at farm3 with Phil.'
+        with self.captureOnCommitCallbacks(execute=True):
+            sentence.save()
+            Sentence.objects.get(pk=self.sentences[20].id).delete()
+        tracked = graph_maintenance.get(graph_maintenance.document_scope(self.document.id, all_sentences=True))
+        texts = [stemmed_text(s.text) for s in tracked.sentences.values()]
+        expected = tf_idf_scores(texts)
+        self.assertEqual(set(tracked.graph.tfidf_scores), set(expected))
+        for token, score in expected.items():
+            self.assertAlmostEqual(tracked.graph.tfidf_scores[token], score)
+
+        # change_word_text and the builds get them from the graph instead of fitting them again
+        document = Document.objects.get(pk=self.document.id)
+        with mock.patch.object(tf_idf_service, 'tf_idf_scores', side_effect=AssertionError('refitted')):
+            document.calculate_tf_idf_scores(useAllSentences=True)
+        self.assertEqual(document.tf_idf_scores.keys(), expected.keys())
+
+    def test_add_and_delete_sentences(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            new_sentence = Sentence.objects.create(text='Phil had a big lamb3 at farm1.', document=self.document,
+                                                   position=50)
+            Triple.objects.create(sentence=new_sentence, subject='Phil', relation='had', object='big lamb3')
+            Sentence.objects.get(pk=self.sentences[3].id).delete()
+            Sentence.objects.get(pk=self.sentences[20].id).delete()
+            Triple.objects.filter(sentence=self.sentences[30], subject='Mary').get().delete()
+        self._assert_matches_rebuild()
+
+    def _save_on_another_thread(self):
+        # what the post_save receiver does, the test database can't be used from another thread
+        triple = Triple.objects.filter(sentence=self.sentences[5]).first()
+        thread = threading.Thread(target=graph_maintenance.triple_saved, args=(triple,), daemon=True)
+        thread.start()
+        return thread
+
+    def test_changes_wait_for_commit(self):
+        tracked = graph_maintenance.get(graph_maintenance.document_scope(self.document.id, all_sentences=True))
+        with self.captureOnCommitCallbacks() as callbacks:
+            Sentence.objects.get(pk=self.sentences[3].id).delete()
+            self.assertIn(self.sentences[3].id, tracked.sentences)
+        for callback in callbacks:
+            callback()
+        self.assertNotIn(self.sentences[3].id, tracked.sentences)
+
+    def test_settle_holds_no_lock(self):
+        scope = graph_maintenance.document_scope(self.document.id, all_sentences=True)
+        with mock.patch.object(graph_maintenance, '_settle_later') as settle_later, \
+                self.captureOnCommitCallbacks(execute=True):
+            Sentence.objects.create(text='Phil had a big lamb3 at farm1.', document=self.document, position=50)
+        # reading the graph doesn't go to the nlp server, the settle thread does
+        with mock.patch.object(Sentence, 'build_triples_bulk', side_effect=AssertionError('settled on read')):
+            tracked = graph_maintenance.get(scope)
+        settle_later.assert_called_once_with(tracked)
+        saves = []
+
+        def build_triples_bulk(sentences):
+            # stands in for the nlp server, other saves go on meanwhile
+            thread = self._save_on_another_thread()
+            thread.join(timeout=5)
+            saves.append(thread.is_alive())
+            return 0
+
+        with mock.patch.object(Sentence, 'build_triples_bulk', side_effect=build_triples_bulk):
+            tracked.settle()
+        self.assertEqual(saves, [False])
+
+    def test_graph_read_under_lock(self):
+        tracked = graph_maintenance.get(graph_maintenance.document_scope(self.document.id, all_sentences=True))
+        with graph_maintenance.locked(tracked.graph):
+            thread = self._save_on_another_thread()
+            thread.join(timeout=0.2)
+            self.assertTrue(thread.is_alive())
+            tracked.graph.tree_data()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+
+    def test_section_sentences(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            section = Section.objects.create(heading='Farms', document=self.document)
+            sentence = Sentence.objects.create(text='Mary had goat7 at farm2.', section=section, position=0)
+            Triple.objects.create(sentence=sentence, subject='Mary', relation='had', object='goat7')
+        self._assert_matches_rebuild()
+
+
 class DocumentSerializerTest(TestCase):
     def setUp(self):
         self.user = User.objects.create_user('test_user')
@@ -852,6 +1103,946 @@ class ArticleExtractorTest(TestCase):
         self.assertEquals(len(extractor.articles), 1)
 
 
+class StandInPageHandler(BaseHTTPRequestHandler):
+    """Serves a small html article at every path, keeping the connections alive. It keeps track of the connections
+    it saw and of the most requests it was answering at once."""
+    protocol_version = 'HTTP/1.1'
+    REQUEST_TIME = 0.01
+    lock = threading.Lock()
+    connections = set()
+    answering = 0
+    most_answering = 0
+    # paths that were asked for, and the ones that got a 304 back
+    requested = []
+    not_modified = []
+    # paths with busy in them get a 503 the first time they're asked for
+    turned_away = []
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.connections.add(self.client_address)
+            cls.answering += 1
+            cls.most_answering = max(cls.most_answering, cls.answering)
+            cls.requested.append(self.path)
+            busy = 'busy' in self.path and self.path not in cls.turned_away
+            if busy:
+                cls.answering -= 1
+                cls.turned_away.append(self.path)
+        if busy:
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = f'"{self.path}"'
+        if self.headers.get('If-None-Match') == etag:
+            with cls.lock:
+                cls.answering -= 1
+                cls.not_modified.append(self.path)
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        time.sleep(self.REQUEST_TIME)
+        with cls.lock:
+            cls.answering -= 1
+        # words of its own, so the pages aren't near copies of each other
+        rng = random.Random(self.path)
+        words = ' '.join(f'word{rng.randrange(2000)}' for _ in range(60))
+        # paths with utf8 in them only say what they're encoded with in a meta tag, ones with latin in the header
+        content_type, charset, meta = 'text/html', 'utf-8', ''
+        if 'utf8' in self.path:
+            meta = '<meta charset="utf-8">'
+        elif 'latin' in self.path:
+            content_type, charset = 'text/html; charset=ISO-8859-1', 'latin-1'
+        body = (f'<html><head>{meta}<title>Page {self.path}</title></head><body><article>'
+                + f'<p>This is the page at {self.path}, it has a few sentences about crowdsourcing. ' * 5
+                + f'<p>{words}, café.</p></article></body></html>').encode(charset)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInPagesTestCase(TestCase):
+    def setUp(self):
+        _empty_corpus_idf(self)
+        StandInPageHandler.connections = set()
+        StandInPageHandler.most_answering = 0
+        StandInPageHandler.requested = []
+        StandInPageHandler.not_modified = []
+        StandInPageHandler.turned_away = []
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache = HTTPCache(cache_dir.name)
+        # no rate limits unless the test sets them
+        self.scheduler = PolitenessScheduler(host_rate=10000, host_burst=10000, global_rate=10000, backoff=0.01)
+        for patcher in [mock.patch.object(http_cache, '_cache', self.cache),
+                        mock.patch.object(politeness, '_scheduler', self.scheduler)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StandInPageHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f'http://127.0.0.1:{server.server_port}'
+
+
+class FetchPoolTest(StandInPagesTestCase):
+    def test_extractors_share_threads(self):
+        urls = [f'{self.url}/{i}' for i in range(30)]
+
+        ArticleExtractor().extract_articles(urls[:5])
+        threads = threading.active_count()
+        for _ in range(3):
+            # nothing comes from the cache, so every round downloads the pages
+            self.cache.clear()
+            extractor = ArticleExtractor()
+            extractor.extract_articles(urls)
+            self.assertEqual(len(extractor.articles), 30)
+        self.assertLessEqual(threading.active_count(), threads + 20)
+        self.assertEqual(fetch_pool.get_pool().stats()['in_flight'], 0)
+
+    def test_download_pipeline(self):
+        pool = FetchPool(max_workers=20, per_host=4)
+        self.addCleanup(pool.shutdown)
+        urls = [f'{self.url}/page/{i}' for i in range(200)]
+        extractor = ArticleExtractor()
+        start = time.perf_counter()
+        with mock.patch.object(fetch_pool, 'get_pool', return_value=pool):
+            extractor.extract_articles(urls + [f'{self.url}/page/0'])
+        elapsed = time.perf_counter() - start
+        print(f'\n200 pages extracted in {elapsed:.2f}s over {len(StandInPageHandler.connections)} connections')
+
+        self.assertEqual(sorted(article.url for article in extractor.articles), sorted(urls))
+        self.assertIn('/page/7, it has a few sentences', [a for a in extractor.articles if a.url == urls[7]][0].text)
+        # the connections were kept alive, one for each download that can go to the host at once
+        self.assertLessEqual(len(StandInPageHandler.connections), 4)
+        self.assertLessEqual(StandInPageHandler.most_answering, 4)
+
+    def test_bounded_and_failures(self):
+        pool = FetchPool(max_workers=3)
+        self.addCleanup(pool.shutdown)
+        most_in_flight = []
+
+        def fetch(url):
+            most_in_flight.append(pool.stats()['in_flight'])
+            time.sleep(0.01)
+            if url == 'bad':
+                raise ValueError(url)
+            return url.upper()
+
+        self.assertEqual(pool.map(fetch, ['a', 'bad', 'c', 'd', 'e']), ['A', None, 'C', 'D', 'E'])
+        self.assertLessEqual(max(most_in_flight), 3)
+        stats = pool.stats()
+        self.assertEqual((stats['completed'], stats['failed'], stats['queued'], stats['in_flight']), (5, 1, 0, 0))
+
+
+class HTTPCacheTest(StandInPagesTestCase):
+    def test_normalize_url(self):
+        self.assertEqual(normalize_url('HTTP://Example.com:80/a?b=2&a=1#top'), 'http://example.com/a?a=1&b=2')
+        self.assertEqual(normalize_url('https://example.com'), 'https://example.com/')
+        self.assertEqual(normalize_url('https://example.com:8443/a'), 'https://example.com:8443/a')
+
+    def test_cached_within_ttl(self):
+        first = self.cache.get(f'{self.url}/page?b=2&a=1')
+        second = self.cache.get(f'{self.url}/page?a=1&b=2#section')
+        self.assertEqual(second.content, first.content)
+        self.assertFalse(first.from_cache)
+        self.assertTrue(second.from_cache)
+        self.assertEqual(StandInPageHandler.requested, ['/page?b=2&a=1'])
+
+    def test_revalidates_after_ttl(self):
+        self.cache.ttl = 0
+        first = self.cache.get(f'{self.url}/page')
+        second = self.cache.get(f'{self.url}/page')
+        self.assertEqual(second.text, first.text)
+        self.assertEqual(StandInPageHandler.not_modified, ['/page'])
+        self.assertEqual(self.cache.revalidated, 1)
+
+    def test_offline(self):
+        self.cache.get(f'{self.url}/cached')
+        self.cache.offline = True
+        self.cache.ttl = 0
+        self.assertIn('/cached', self.cache.get(f'{self.url}/cached').text)
+        self.assertIsNone(self.cache.get(f'{self.url}/not-cached'))
+        self.assertEqual(StandInPageHandler.requested, ['/cached'])
+        # the extractors run from the cache too
+        extractor = ArticleExtractor()
+        extractor.extract_articles([f'{self.url}/cached', f'{self.url}/not-cached'])
+        self.assertEqual([article.url for article in extractor.articles], [f'{self.url}/cached'])
+
+    def test_max_size(self):
+        self.assertIsNone(self.cache.get(f'{self.url}/big', max_size=100))
+        self.assertIn('/big', self.cache.get(f'{self.url}/big', max_size=2 ** 20).text)
+        # the pool only caps pdfs
+        pool = FetchPool(max_workers=2)
+        self.addCleanup(pool.shutdown)
+        with mock.patch.object(fetch_pool.settings, 'ARTICLE_PDF_MAX_MB', 100 / 2 ** 20):
+            self.assertEqual([download and download.url for download in pool.download_all(
+                [f'{self.url}/huge.pdf', f'{self.url}/huge.html'])], [None, f'{self.url}/huge.html'])
+
+    def test_encoding(self):
+        for path in ['/utf8', '/latin']:
+            # downloaded, then from the cache
+            self.assertIn('café', self.cache.get(f'{self.url}{path}').text)
+            self.assertIn('café', self.cache.get(f'{self.url}{path}').text)
+        self.assertEqual(self.cache.get(f'{self.url}/utf8').encoding, 'utf-8')
+        self.assertEqual(self.cache.get(f'{self.url}/latin').encoding, 'iso8859-1')
+        self.assertEqual(body_encoding({'Content-Type': 'text/html'}, b'<html>caf\xc3\xa9</html>'), 'utf-8')
+        self.assertEqual(body_encoding({}, b'<?xml version="1.0" encoding="windows-1252"?><rss/>'), 'cp1252')
+        pool = FetchPool(max_workers=2)
+        self.addCleanup(pool.shutdown)
+        self.cache.clear()
+        download = pool.download(f'{self.url}/utf8')
+        self.assertIn('café', fetch_pool.download_text(download))
+
+    def test_eviction(self):
+        size = len(self.cache.get(f'{self.url}/0').content)
+        self.cache.max_bytes = size * 3 + 500
+        for i in range(1, 4):
+            time.sleep(0.01)
+            self.cache.get(f'{self.url}/{i}')
+        StandInPageHandler.requested = []
+        self.cache.get(f'{self.url}/0')
+        self.cache.get(f'{self.url}/3')
+        self.assertEqual(StandInPageHandler.requested, ['/0'])
+
+    def test_eviction_counts_other_processes(self):
+        size = len(self.cache.get(f'{self.url}/0').content)
+        # another process' cache in the same directory
+        other = HTTPCache(self.cache.directory)
+        for i in range(1, 4):
+            time.sleep(0.01)
+            other.get(f'{self.url}/{i}')
+        self.cache.max_bytes = size * 3 + 500
+        time.sleep(0.01)
+        self.cache.get(f'{self.url}/4')
+        StandInPageHandler.requested = []
+        self.cache.get(f'{self.url}/1')
+        self.cache.get(f'{self.url}/4')
+        self.assertEqual(StandInPageHandler.requested, ['/1'])
+
+
+
+class PolitenessTest(StandInPagesTestCase):
+    def test_host_rate(self):
+        self.scheduler = PolitenessScheduler(host_rate=20, host_burst=2, global_rate=10000)
+        pool = FetchPool(max_workers=10)
+        self.addCleanup(pool.shutdown)
+        other_host = self.url.replace('127.0.0.1', 'localhost')
+        start = time.perf_counter()
+        with mock.patch.object(politeness, '_scheduler', self.scheduler):
+            downloads = pool.download_all([f'{self.url}/{i}' for i in range(8)] + [f'{other_host}/{i}' for i in range(8)])
+        elapsed = time.perf_counter() - start
+        self.assertTrue(all(downloads))
+        # two go right away, the other six to each host wait their turn
+        self.assertGreaterEqual(elapsed, 0.29)
+        # every download had its host token before it got a thread, none waited for one on the thread
+        self.assertEqual((self.scheduler.stats()['sent'], self.scheduler.stats()['prepaid']), (16, 16))
+
+    def test_slow_host_holds_no_threads(self):
+        slow_host = self.url.replace('127.0.0.1', 'localhost')
+        self.scheduler = PolitenessScheduler(host_rates={slow_host[len('http://'):]: 5}, global_rate=10000)
+        pool = FetchPool(max_workers=2)
+        self.addCleanup(pool.shutdown)
+        with mock.patch.object(politeness, '_scheduler', self.scheduler):
+            downloads = pool.download_all([f'{slow_host}/slow/0', f'{slow_host}/slow/1'] +
+                                          [f'{self.url}/fast/{i}' for i in range(3)])
+        self.assertTrue(all(downloads))
+        # the second one to the slow host waits 0.2s for its token, without a thread, so the others go first
+        self.assertEqual(StandInPageHandler.requested[-1], '/slow/1')
+        self.assertEqual(self.scheduler.stats()['prepaid'], 5)
+
+    def test_retry_when_busy(self):
+        response = self.cache.get(f'{self.url}/busy')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StandInPageHandler.requested, ['/busy', '/busy'])
+        self.assertEqual(self.scheduler.stats()['retried'], 1)
+        # it gives up eventually
+        self.scheduler.retries = 0
+        self.assertEqual(self.cache.get(f'{self.url}/busy/again').status_code, 503)
+
+    def test_interactive_first(self):
+        scheduler = PolitenessScheduler(global_rate=5)
+        for i in range(5):
+            scheduler.acquire(f'host{i}')
+        order = []
+
+        def acquire(level):
+            with politeness.priority(level):
+                scheduler.acquire(f'host{level}')
+            order.append(level)
+
+        background = threading.Thread(target=acquire, args=(politeness.BACKGROUND,))
+        background.start()
+        time.sleep(0.05)
+        interactive = threading.Thread(target=acquire, args=(politeness.INTERACTIVE,))
+        interactive.start()
+        background.join()
+        interactive.join()
+        self.assertEqual(order, [politeness.INTERACTIVE, politeness.BACKGROUND])
+
+    def test_fetch_pool_priority(self):
+        pool = FetchPool(max_workers=1)
+        self.addCleanup(pool.shutdown)
+        started, release = threading.Event(), threading.Event()
+        order = []
+
+        def block(_):
+            started.set()
+            release.wait(5)
+
+        def fetch(level, items):
+            with politeness.priority(level):
+                pool.map(order.append, items)
+
+        threads = [threading.Thread(target=pool.map, args=(block, [None]))]
+        threads[0].start()
+        started.wait(5)
+        # queued while the only thread is busy, the background fetches first
+        for level, items, queued in [(politeness.BACKGROUND, ['background 1', 'background 2'], 2),
+                                     (politeness.INTERACTIVE, ['interactive'], 3)]:
+            threads.append(threading.Thread(target=fetch, args=(level, items)))
+            threads[-1].start()
+            while pool.stats()['queued'] < queued:
+                time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive', 'background 1', 'background 2'])
+
+    def test_priority_reaches_fetch_pool(self):
+        pool = FetchPool(max_workers=2)
+        self.addCleanup(pool.shutdown)
+        with politeness.priority(politeness.BACKGROUND):
+            self.assertEqual(pool.map(lambda _: politeness._priority.get(), [1, 2]), [politeness.BACKGROUND] * 2)
+        self.assertEqual(pool.map(lambda _: politeness._priority.get(), [1]), [politeness.INTERACTIVE])
+
+
+class RetrievalContextTest(StandInPagesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.urls = [f'{self.url}/story/{i}' for i in range(5)]
+        patcher = mock.patch.object(GoogleExtractor, '_scrape_google_query', autospec=True,
+                                    side_effect=lambda extractor, query: list(self.urls))
+        self.scrape = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_steps_share_retrieval(self):
+        with RetrievalContext() as context:
+            # the document's articles, then its suggested links and keywords
+            articles, terms = GoogleExtractor().get_articles(['Mary'], [])
+            links, more_terms = GoogleExtractor().get_articles(['Mary'], [])
+            # a url another query shares
+            extractor = ArticleExtractor()
+            extractor.extract_articles([self.urls[0], f'{self.url}/story/other'])
+        self.assertEqual(self.scrape.call_count, 1)
+        self.assertEqual([article.url for article in links], [article.url for article in articles])
+        self.assertEqual(more_terms, terms)
+        self.assertEqual(len(extractor.articles), 2)
+        self.assertEqual(sorted(StandInPageHandler.requested), sorted(['/story/other'] + [f'/story/{i}' for i in range(5)]))
+        self.assertEqual(context.stats(), {'searches_run': 1, 'searches_reused': 1, 'fetches': 6, 'fetches_avoided': 6,
+                                           'expansions_run': 1, 'expansions_reused': 1})
+        self.assertIsNone(retrieval_context.current())
+
+    def test_outside_a_context(self):
+        GoogleExtractor().execute_google_query(['Mary'], [])
+        GoogleExtractor().execute_google_query(['Mary'], [])
+        self.assertEqual(self.scrape.call_count, 2)
+
+    def test_scoped(self):
+        contexts = []
+
+        @retrieval_context.scoped
+        def step():
+            contexts.append(retrieval_context.current())
+
+        @retrieval_context.scoped
+        def request():
+            step()
+            step()
+
+        request()
+        self.assertIsNotNone(contexts[0])
+        self.assertIs(contexts[0], contexts[1])
+        step()
+        self.assertIsNot(contexts[2], contexts[0])
+
+
+class QueryExpansionTest(TestCase):
+    def test_top_terms(self):
+        vectorizer = TfidfVectorizer()
+        matrix = vectorizer.fit_transform(['lamb lamb snow', 'lamb wool', 'lamb wool school', 'school rules'])
+        names = vectorizer.get_feature_names_out()
+        scores = dict(zip(names, np.asarray(matrix.sum(axis=0)).ravel()))
+        self.assertEqual(top_terms(matrix, names, 3), sorted(scores, key=lambda term: -scores[term])[:3])
+        # the search terms are left out before picking, so there are still k terms
+        self.assertEqual(top_terms(matrix, names, 3, exclude=['Lamb']),
+                         sorted(set(scores) - {'lamb'}, key=lambda term: -scores[term])[:3])
+        self.assertEqual(top_terms(matrix, names, 1, aggregate='max'), [names[np.argmax(matrix.max(axis=0).todense())]])
+        self.assertEqual(len(top_terms(matrix, names, 100)), len(names))
+        # a search of more than one word leaves out each of them
+        self.assertEqual(top_terms(matrix, names, 100, exclude=['Lamb Wool!'], analyzer=vectorizer.build_analyzer()),
+                         sorted(set(scores) - {'lamb', 'wool'}, key=lambda term: (-scores[term], term)))
+        self.assertIn('lamb', top_terms(matrix, names, 100, exclude=['Lamb Wool!']))
+
+    @skipUnless(os.environ.get('RUN_BENCHMARKS'), 'timing benchmark, set RUN_BENCHMARKS to run it')
+    def test_benchmark(self):
+        rng = random.Random(0)
+        vocabulary = [f'word{i}' for i in range(20000)]
+        corpus = [' '.join(rng.choice(vocabulary) for _ in range(200)) for _ in range(3000)]
+        vectorizer = TfidfVectorizer()
+        matrix = vectorizer.fit_transform(corpus)
+        names = vectorizer.get_feature_names_out()
+
+        start = time.perf_counter()
+        # how it was done before: every score through a dict, then the whole vocabulary sorted
+        index_word_dict = {i[1]: i[0] for i in vectorizer.vocabulary_.items()}
+        tfidf_scores = dict()
+        for row in matrix:
+            for i in range(len(row.indices)):
+                tfidf_scores[index_word_dict[row.indices[i]]] = row.data[i]
+        sorted(tfidf_scores.items(), key=lambda item: item[1], reverse=True)[:10]
+        before = time.perf_counter() - start
+
+        start = time.perf_counter()
+        terms = top_terms(matrix, names, 10, exclude=['word1'])
+        after = time.perf_counter() - start
+        print(f'\nQuery expansion over {len(corpus)} articles ({len(names)} terms): {after * 1000:.1f}ms instead of '
+              f'{before * 1000:.0f}ms')
+        self.assertEqual(len(terms), 10)
+        self.assertLess(after, before)
+
+
+def _pdf_with_pages(texts):
+    """A pdf with one line of text on each page"""
+    objects = ['<</Type/Catalog/Pages 2 0 R>>',
+               '<</Type/Pages/Kids[{}]/Count {}>>'.format(' '.join(f'{4 + 2 * i} 0 R' for i in range(len(texts))),
+                                                          len(texts)),
+               '<</Type/Font/Subtype/Type1/BaseFont/Helvetica>>']
+    for i, text in enumerate(texts):
+        stream = f'BT /F1 12 Tf 10 100 Td ({text}) Tj ET'
+        objects.append(f'<</Type/Page/Parent 2 0 R/MediaBox[0 0 200 200]/Resources<</Font<</F1 3 0 R>>>>'
+                       f'/Contents {5 + 2 * i} 0 R>>')
+        objects.append(f'<</Length {len(stream)}>>stream\n{stream}\nendstream')
+    pdf = '%PDF-1.4\n'
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f'{number} 0 obj{obj}endobj\n'
+    xref = len(pdf)
+    pdf += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n' + ''.join(f'{o:010} 00000 n \n' for o in offsets)
+    pdf += f'trailer<</Size {len(objects) + 1}/Root 1 0 R>>\nstartxref\n{xref}\n%%EOF'
+    return pdf.encode()
+
+
+class ParsePoolTest(TestCase):
+    def setUp(self):
+        self.pool = ParsePool(processes=2, cpu_seconds=10, max_pdf_pages=3)
+        self.addCleanup(self.pool.shutdown)
+
+    def test_parse_html_and_pdf(self):
+        html = '<html><head><title>Lambs</title></head><body><article>' + \
+               '<p>Mary had a little lamb, its fleece was white as snow. ' * 20 + '</article></body></html>'
+        parsed = self.pool.parse_all([
+            Download('http://example.com/lamb', html.encode(), 'text/html', 'utf-8'),
+            None,
+            Download('http://example.com/paper.pdf', _pdf_with_pages(['First page', 'Second page']),
+                     'application/pdf', None),
+            Download('http://example.com/broken.pdf', b'not a pdf', 'application/pdf', None),
+        ])
+        self.assertEqual(parsed[0].title, 'Lambs')
+        self.assertIn('Mary had a little lamb', parsed[0].text)
+        self.assertIsNone(parsed[1])
+        self.assertEqual(parsed[2], ParsedArticle('http://example.com/paper.pdf', '', 'First pageSecond page'))
+        self.assertIsNone(parsed[3])
+
+    def test_pdf_page_cap(self):
+        pdf = _pdf_with_pages([f'Page {i}' for i in range(10)])
+        parsed, = self.pool.parse_all([Download('http://example.com/long.pdf', pdf, 'application/pdf', None)])
+        self.assertEqual(parsed.text, 'Page 0Page 1Page 2')
+
+    def test_pdf_enough_text(self):
+        self.pool.max_pdf_pages = 10
+        self.pool.max_pdf_chars = 10
+        pdf = _pdf_with_pages([f'Page {i}' for i in range(10)])
+        parsed, = self.pool.parse_all([Download('http://example.com/long.pdf', pdf, 'application/pdf', None)])
+        self.assertEqual(parsed.text, 'Page 0Page 1')
+
+    def test_cpu_budget(self):
+        # one process, so the pages after the huge one are parsed by the one that went over the budget
+        self.pool = ParsePool(processes=1, cpu_seconds=0.5)
+        self.addCleanup(self.pool.shutdown)
+        html = '<html><body>' + '<div><p>Mary had a little lamb.</p></div>' * 50000 + '</body></html>'
+        small = '<html><body><p>' + 'Mary had a little lamb. ' * 20 + '</p></body></html>'
+        parsed = self.pool.parse_all([Download('http://example.com/small', small.encode(), 'text/html', 'utf-8'),
+                                      Download('http://example.com/huge', html.encode(), 'text/html', 'utf-8'),
+                                      Download('http://example.com/after', small.encode(), 'text/html', 'utf-8')])
+        self.assertEqual(parsed[0].url, 'http://example.com/small')
+        self.assertIsNone(parsed[1])
+        # the budget is for all of the pages, the huge one used it up
+        self.assertIsNone(parsed[2])
+        # the next document gets a budget of its own, and the process is fine after going over it
+        parsed, = self.pool.parse_all([Download('http://example.com/after', small.encode(), 'text/html', 'utf-8')])
+        self.assertEqual(parsed.url, 'http://example.com/after')
+
+    def test_process_dies(self):
+        class CrashingExecutor:
+            """Parses in the calling thread, a page with crash in its url kills the "process" and every page that
+            was being parsed with it"""
+
+            def __init__(self, **kwargs):
+                self.running = []
+                self.broken = False
+
+            def submit(self, fn, url, *args):
+                if self.broken:
+                    raise BrokenProcessPool()
+                future = Future()
+                self.running.append(future)
+                if 'crash' in url:
+                    self.broken = True
+                    for running in self.running:
+                        if not running.done():
+                            running.set_exception(BrokenProcessPool())
+                else:
+                    threading.Timer(0.05, lambda: future.done() or future.set_result(fn(url, *args))).start()
+                return future
+
+            def shutdown(self, wait=True):
+                pass
+
+        self.pool = ParsePool(processes=3, cpu_seconds=0)
+        pages = [Download(f'http://example.com/{name}', f'<html><body><p>{name}</p></body></html>'.encode(),
+                          'text/html', 'utf-8') for name in ['first', 'second', 'crash', 'fourth']]
+        with mock.patch.object(parse_pool, 'ProcessPoolExecutor', CrashingExecutor):
+            parsed = self.pool.parse_all(pages)
+        # only the page that killed the process is lost
+        self.assertEqual([article and article.url for article in parsed],
+                         ['http://example.com/first', 'http://example.com/second', None, 'http://example.com/fourth'])
+
+    def test_extractor_articles(self):
+        pdf = Download('http://example.com/paper.pdf', _pdf_with_pages(['Some text']), 'application/pdf', None)
+        with mock.patch.object(parse_pool, 'get_pool', return_value=self.pool):
+            article = ArticleExtractor()._parse_article(pdf)
+        self.assertEqual((article.url, article.text), ('http://example.com/paper.pdf', 'Some text'))
+
+
+class DedupTest(TestCase):
+    BOILERPLATE = ['Subscribe to our newsletter for more stories like this one.',
+                   'Share this story on Facebook and Twitter. Copyright 2019 The Daily News, all rights reserved.']
+
+    def setUp(self):
+        rng = random.Random(0)
+        vocabulary = [f'word{i}' for i in range(2000)]
+        self.stories = [' '.join(rng.choice(vocabulary) for _ in range(300)) + '.' for _ in range(10)]
+
+    def _corpus(self):
+        """Every story as it was, copied exactly (with other whitespace and case) and syndicated with a site's own
+        boilerplate around it"""
+        corpus = []
+        for i, story in enumerate(self.stories):
+            corpus.append(SimpleNamespace(url=f'www.{i}.com', text=story))
+            corpus.append(SimpleNamespace(url=f'www.{i}.com/amp', text='  ' + story.upper().replace(' ', '\n')))
+            corpus.append(SimpleNamespace(url=f'www.news.com/{i}',
+                                          text=f'{self.BOILERPLATE[0]} {story} {self.BOILERPLATE[1]}'))
+            corpus.append(SimpleNamespace(url=f'www.wire.com/{i}', text=f'Reuters - {story} Read more at wire.com'))
+        return corpus
+
+    def test_unique(self):
+        deduplicator = Deduplicator()
+        corpus = self._corpus()
+        unique = [article for article in corpus if not deduplicator.is_duplicate(article.text)]
+        self.assertEqual([article.url for article in unique], [f'www.{i}.com' for i in range(10)])
+        self.assertEqual((deduplicator.exact, deduplicator.near), (10, 20))
+        # only exact copies at a similarity of 1
+        self.assertEqual(len(dedup.unique(corpus, similarity=1)), 30)
+
+    def test_threshold_calibration(self):
+        def distance(a, b):
+            return bin(dedup.simhash(a) ^ dedup.simhash(b)).count('1')
+
+        limit = dedup.max_distance(settings.ARTICLE_DEDUP_SIMILARITY)
+        corpus = self._corpus()
+        # the syndicated copies of each story against the story
+        copies = [distance(corpus[i].text, corpus[j].text) for i in range(0, len(corpus), 4) for j in (i + 2, i + 3)]
+        stories = [distance(a, b) for a, b in itertools.combinations(self.stories, 2)]
+        # copies are well inside the bits that can differ, different stories well outside
+        self.assertLessEqual(max(copies), limit)
+        self.assertGreater(min(stories), 2 * limit)
+
+    def test_summarizer_work_saved(self):
+        corpus = self._corpus()
+        summarized = []
+
+        def summarize(articles):
+            # stands in for a summarizer, which costs about the same for every article
+            for article in articles:
+                summarized.append(article)
+
+        summarize(dedup.unique(corpus))
+        print(f'\nSummarized {len(summarized)} of {len(corpus)} articles, {1 - len(summarized) / len(corpus):.0%} saved')
+        # one article for each story, the copies of it aren't summarized again
+        self.assertEqual(len(summarized), len(self.stories))
+        self.assertLess(len(summarized), len(corpus))
+
+
+class TfIdfServiceTest(TestCase):
+    def setUp(self):
+        _empty_corpus_idf(self)
+        tf_idf_service.clear()
+        self.document = Document.objects.create(title='Mary')
+        for position, text in enumerate(['Mary had a little lamb.', 'Its fleece was white as snow.',
+                                         'Everywhere that Mary went, the lamb was sure to go.']):
+            Sentence.objects.create(text=text, document=self.document, position=position)
+
+    def test_scores_match_row_by_row(self):
+        rng = random.Random(0)
+        texts = [' '.join(f'word{rng.randrange(300)}' for _ in range(20)) for _ in range(200)]
+        vectorizer = TfidfVectorizer()
+        transformed = vectorizer.fit_transform(texts)
+        index_value = {i[1]: i[0] for i in vectorizer.vocabulary_.items()}
+        expected = {}
+        for row in transformed:
+            for (column, value) in zip(row.indices, row.data):
+                expected[index_value[column]] = value
+        scores = tf_idf_scores(texts)
+        self.assertEqual(scores.keys(), expected.keys())
+        for token, score in expected.items():
+            self.assertAlmostEqual(scores[token], score)
+
+    def test_recalculated_only_on_change(self):
+        self.document.calculate_tf_idf_scores()
+        sentences = list(self.document.sentences.all())
+        self.assertEqual(self.document.tf_idf_scores, tf_idf_scores([stemmed_text(s.text) for s in sentences]))
+        self.assertEqual(self.document.stemmed_texts, {s.id: stemmed_text(s.text) for s in sentences})
+        self.assertEqual(tf_idf_service.stats()['misses'], 1)
+
+        # another request, or another process
+        self.document.calculate_tf_idf_scores()
+        tf_idf_service.clear()
+        other = Document.objects.get(id=self.document.id)
+        other.calculate_tf_idf_scores()
+        self.assertEqual(other.tf_idf_scores, self.document.tf_idf_scores)
+        self.assertEqual((tf_idf_service.stats()['db_hits'], tf_idf_service.stats()['misses']), (1, 0))
+
+        sentences[0].text = 'Mary had a little goat.'
+        sentences[0].save()
+        other.calculate_tf_idf_scores()
+        self.assertIn('goat', other.tf_idf_scores)
+        self.assertEqual(tf_idf_service.stats()['misses'], 1)
+
+        # other text processing stems the texts differently
+        with mock.patch.object(tf_idf_service, 'TOKENS_VERSION', 'other'):
+            other.calculate_tf_idf_scores()
+        self.assertEqual(tf_idf_service.stats()['misses'], 2)
+
+    def test_section(self):
+        self.document.calculate_tf_idf_scores()
+        # a section with the same sentences gets the same scores, without calculating them again
+        section = Section.objects.create(heading='Lamb', document=self.document)
+        section_sentences = [Sentence.objects.create(text=sentence.text, section=section, position=sentence.position)
+                             for sentence in self.document.sentences.all()]
+        section.calculate_tf_idf_scores()
+        self.assertEqual(section.tf_idf_scores, self.document.tf_idf_scores)
+        self.assertEqual(section.stemmed_texts, {s.id: stemmed_text(s.text) for s in section_sentences})
+        self.assertEqual((tf_idf_service.stats()['memory_hits'], tf_idf_service.stats()['misses']), (1, 1))
+
+    def test_eviction(self):
+        a, b, c, d = [[Sentence(text=f'{name} had a little lamb.')] for name in ['Mary', 'John', 'Anne', 'Paul']]
+        with mock.patch.object(tf_idf_service, 'TF_IDF_CACHE_SIZE', 3), \
+                mock.patch.object(tf_idf_service, 'TF_IDF_CACHE_PRUNE_EVERY', 2), \
+                mock.patch.object(tf_idf_service, 'TF_IDF_CACHE_TOUCH_SECONDS', 0):
+            tf_idf_service.scores_for(a)
+            tf_idf_service.scores_for(b)
+            # used from memory, so it's more recently used than b in the table too
+            tf_idf_service.scores_for(a)
+            # the table only gets counted every 2 saves
+            tf_idf_service.scores_for(c)
+            self.assertEqual(TfIdfScores.objects.count(), 3)
+            tf_idf_service.scores_for(d)
+            self.assertEqual(TfIdfScores.objects.count(), 3)
+            self.assertEqual(tf_idf_service.stats()['evictions'], 1)
+            tf_idf_service.clear()
+            tf_idf_service.scores_for(a)
+            tf_idf_service.scores_for(b)
+            self.assertEqual((tf_idf_service.stats()['db_hits'], tf_idf_service.stats()['misses']), (1, 1))
+
+
+class TermStatsTest(TestCase):
+    def _assert_matches_refit(self, stats: TermStats):
+        expected = tf_idf_scores(list(stats.texts.values()))
+        scores = stats.scores()
+        self.assertEqual(scores.keys(), expected.keys())
+        for token, score in expected.items():
+            self.assertAlmostEqual(scores[token], score)
+            self.assertAlmostEqual(stats.view()[token], score)
+
+    def test_edits_match_refit(self):
+        rng = random.Random(0)
+
+        def text():
+            return ' '.join(f'word{rng.randrange(60)}' for _ in range(rng.randrange(1, 12)))
+
+        stats = TermStats()
+        for sentence_id in range(100):
+            stats.set(sentence_id, text())
+        self._assert_matches_refit(stats)
+        next_id = 100
+        for _ in range(200):
+            action = rng.random()
+            if action < 0.5:
+                stats.set(rng.choice(list(stats.texts)), text())
+            elif action < 0.75:
+                stats.remove(rng.choice(list(stats.texts)))
+            else:
+                stats.set(next_id, text())
+                next_id += 1
+        self._assert_matches_refit(stats)
+
+    def test_edit_and_remove(self):
+        stats = TermStats()
+        stats.set(1, 'mari lamb')
+        stats.set(2, 'lamb fleec white snow')
+        stats.set(3, 'mari went lamb sure go')
+        stats.set(2, 'lamb fleec black')
+        stats.remove(3)
+        self.assertNotIn('snow', stats.view())
+        self.assertEqual(stats.view().get('snow'), None)
+        self._assert_matches_refit(stats)
+
+        # a token's score comes from the last sentence it's in, an edit doesn't move a sentence
+        stats.set(4, 'lamb')
+        stats.set(1, 'mari lamb lamb')
+        self.assertAlmostEqual(stats.score('lamb'), 1.0)
+        self._assert_matches_refit(stats)
+
+    def test_empty(self):
+        stats = TermStats()
+        stats.set(1, '')
+        self.assertEqual(stats.scores(), {})
+        stats.remove(1)
+        stats.remove(1)
+        self.assertEqual(len(stats), 0)
+
+
+class CorpusIdfTest(StandInPagesTestCase):
+    def _store(self, kind=corpus_idf.WORDS):
+        return CorpusIdf(os.path.join(settings.CORPUS_IDF_DIR, kind), corpus_idf._ANALYZERS[kind]())
+
+    def _texts(self, count, seed=0):
+        rng = random.Random(seed)
+        return [' '.join(f'word{rng.randrange(500)}' for _ in range(50)) for _ in range(count)]
+
+    def test_same_idf_as_fitting_the_articles(self):
+        texts = self._texts(200)
+        store = self._store()
+        self.assertEqual(store.add(texts[:120]), 120)
+        # another process with the same directory sees what was added, and adds the rest
+        other = self._store()
+        self.assertEqual(other.documents, 120)
+        self.assertEqual(other.add(texts[100:] + [texts[0].upper()]), 80)
+        self.assertEqual(store.documents, 200)
+        self.assertIsInstance(store._document_frequencies, np.memmap)
+
+        vectorizer = TfidfVectorizer(stop_words='english').fit(texts)
+        names = vectorizer.get_feature_names_out()
+        np.testing.assert_allclose(store.idf(names), vectorizer.idf_)
+        np.testing.assert_allclose(store.idf(['nowhere']), [np.log(201) + 1])
+
+        counts = CountVectorizer(stop_words='english').fit(texts[:10])
+        matrix = store.tfidf(counts.transform(texts[:10]), counts.get_feature_names_out())
+        np.testing.assert_allclose(matrix.toarray(), TfidfVectorizer(stop_words='english').fit(texts).transform(
+            texts[:10])[:, np.searchsorted(names, counts.get_feature_names_out())].toarray() /
+            np.linalg.norm(TfidfVectorizer(stop_words='english').fit(texts).transform(texts[:10])[
+                :, np.searchsorted(names, counts.get_feature_names_out())].toarray(), axis=1, keepdims=True))
+
+    def test_scores_use_it_once_there_are_enough_articles(self):
+        document = Document.objects.create(title='Mary')
+        for position, text in enumerate(['Mary had a little lamb.', 'Its fleece was white as snow.']):
+            Sentence.objects.create(text=text, document=document, position=position)
+        stemmed = [stemmed_text(sentence.text) for sentence in document.sentences.all()]
+        with mock.patch.object(settings, 'CORPUS_IDF_MIN_DOCUMENTS', 50), \
+                mock.patch.object(settings, 'CORPUS_IDF_ENABLED', True):
+            corpus_idf.ingest(self._texts(48) + ['Mary had lambs'])
+            corpus_idf.flush()
+            document.calculate_tf_idf_scores()
+            self.assertEqual(document.tf_idf_scores, tf_idf_scores(stemmed))
+
+            corpus_idf.ingest(['Lambs and more lambs'])
+            corpus_idf.flush()
+            store = corpus_idf.get_store(corpus_idf.STEMMED)
+            self.assertEqual(store.documents, 50)
+            document.calculate_tf_idf_scores()
+            self.assertEqual(document.tf_idf_scores, tf_idf_scores(stemmed, store))
+            # the corpus knows lambs come up more than little does, the two sentences alone don't
+            self.assertEqual(tf_idf_scores(stemmed)['littl'], tf_idf_scores(stemmed)['lamb'])
+            self.assertGreater(document.tf_idf_scores['littl'], document.tf_idf_scores['lamb'])
+
+            stats = TermStats(store)
+            for sentence_id, text in enumerate(stemmed):
+                stats.set(sentence_id, text)
+            for token, score in tf_idf_scores(stemmed, store).items():
+                self.assertAlmostEqual(stats.score(token), score)
+
+    def test_extracted_articles_go_in(self):
+        extractor = ArticleExtractor()
+        with mock.patch.object(settings, 'CORPUS_IDF_MIN_DOCUMENTS', 3), \
+                mock.patch.object(settings, 'CORPUS_IDF_ENABLED', True):
+            extractor.extract_articles([f'{self.url}/story/{i}' for i in range(3)])
+            corpus_idf.flush()
+            self.assertEqual(corpus_idf.get_store(corpus_idf.WORDS).documents, 3)
+            self.assertEqual(corpus_idf.get_store(corpus_idf.STEMMED).documents, 3)
+            with mock.patch.object(TfidfVectorizer, 'fit_transform', side_effect=AssertionError('fitted the idf')):
+                terms = extractor._query_expansion(['story'])
+        self.assertEqual(len(terms), settings.ARTICLE_EXTRACTOR_QUERY_EXPANSION_SIZE)
+
+    def test_compact_vocabulary(self):
+        store = self._store()
+        store.add(['naïve café ' + 'x' * 40, 'café au lait'])
+        self.assertEqual(store._vocabulary.tolist(), [b'au', b'caf\xc3\xa9', b'lait', b'na\xc3\xafve'])
+        self.assertEqual(store._vocabulary.dtype, np.dtype('S6'))
+        self.assertEqual(store.idf(['café', 'x' * 40]).tolist(), [1.0, np.log(3) + 1])
+
+    def test_deltas_merged(self):
+        texts = self._texts(80)
+        store = self._store()
+        other = self._store()
+        with mock.patch.object(settings, 'CORPUS_IDF_MERGE_EVERY', 3):
+            for start in range(0, 80, 10):
+                (store if start % 20 else other).add(texts[start:start + 10])
+                vectorizer = TfidfVectorizer(stop_words='english').fit(texts[:start + 10])
+                np.testing.assert_allclose(store.idf(vectorizer.get_feature_names_out()), vectorizer.idf_)
+                self.assertEqual(len(store), len(vectorizer.idf_))
+        # the first batch made the arrays, the ones after went in as deltas and every third got them merged
+        with open(os.path.join(store.directory, 'CURRENT')) as current_file:
+            self.assertEqual(current_file.read(), 'generation-3 1')
+        # only the newest generations are kept
+        self.assertEqual(sorted(name for name in os.listdir(store.directory) if name.startswith('generation-')),
+                         ['generation-2', 'generation-3'])
+        self.assertIsInstance(store._document_frequencies, np.memmap)
+
+    def test_version(self):
+        store = self._store()
+        store.add(self._texts(200))
+        version = store.version
+        # a few more articles hardly change the idf, 10% more do
+        store.add(self._texts(5, seed=1))
+        self.assertEqual(store.version, version)
+        store.add(self._texts(20, seed=2))
+        self.assertEqual(store.version, version + 1)
+
+
+class TextProcessingTest(TestCase):
+    @staticmethod
+    def _process_text(text, filter_stopwords=True):
+        """How process_text was done before, one dict per word and every word stemmed"""
+        processed_text = []
+        for word in text.lower().split():
+            processed_text_object = {"stemmed_word": "", "processed_word": "", "actual_word": ""}
+            processed_word = ''.join(e for e in word if e.isalpha())
+            if processed_word not in utilities.stopwords or not filter_stopwords:
+                processed_text_object["stemmed_word"] = utilities.stemmer.stem(processed_word)
+                processed_text_object["processed_word"] = processed_word
+                processed_text_object["actual_word"] = word
+            processed_text.append(processed_text_object)
+        return processed_text
+
+    def _texts(self, count):
+        rng = random.Random(0)
+        words = ['Mary', 'had', 'a', 'little', 'lamb,', "lamb's", 'fleece', 'was', 'white', 'as', 'snow.', 'The',
+                 'running', 'runners', 'ran', 'café', 'naïve', 'x²', '(1984)', '—', 'well-known', 'U.S.']
+        return [' '.join(rng.choice(words) for _ in range(rng.randrange(1, 30))) for _ in range(count)]
+
+    def test_same_as_before(self):
+        texts = self._texts(500)
+        for filter_stopwords in (True, False):
+            processed = utilities.process_texts(texts, filter_stopwords)
+            for text, tokens in zip(texts, processed):
+                expected = self._process_text(text, filter_stopwords)
+                self.assertEqual(tokens, utilities.process_text(text, filter_stopwords))
+                self.assertEqual([{key: token[key] for key in expected_token} for token, expected_token
+                                  in zip(tokens, expected)], expected)
+        self.assertEqual(utilities.stemmed_texts(texts), [' '.join(token['stemmed_word'] for token in
+                                                                    self._process_text(text)) for text in texts])
+        self.assertEqual(utilities.process_text_list(['Lamb,', 'the']), [('lamb', 'Lamb', 'Lamb,'), ('', '', '')])
+
+    @skipUnless(os.environ.get('RUN_BENCHMARKS'), 'timing benchmark, set RUN_BENCHMARKS to run it')
+    def test_benchmark(self):
+        texts = self._texts(5000)
+        utilities.process_word.cache_clear()
+        utilities.stem.cache_clear()
+
+        start = time.perf_counter()
+        for text in texts:
+            self._process_text(text)
+        before = time.perf_counter() - start
+
+        start = time.perf_counter()
+        utilities.process_texts(texts)
+        after = time.perf_counter() - start
+        print(f'\nprocess_text over {len(texts)} sentences: {after * 1000:.1f}ms instead of {before * 1000:.0f}ms')
+        self.assertLess(after, before)
+
+
+class TripleTokensTest(TestCase):
+    def setUp(self):
+        _empty_corpus_idf(self)
+        self.document = Document.objects.create(title='Mary')
+        self.sentences = []
+        for position, animal in enumerate(['lamb', 'goat', 'horse', 'sheep', 'cow']):
+            sentence = Sentence.objects.create(text=f'Mary had a little {animal}.', document=self.document,
+                                               position=position)
+            Triple.objects.create(sentence=sentence, subject='Mary', relation='had a',
+                                  object=f'little {animal}, 1984')
+            self.sentences.append(sentence)
+        self.scores = tf_idf_scores([stemmed_text(sentence.text) for sentence in self.sentences])
+
+    def test_made_on_save(self):
+        triple = Triple.objects.get(sentence=self.sentences[0])
+        graph = TripleGraph([], self.scores)
+        self.assertEqual(triple.tokens_version, utilities.TOKENS_VERSION)
+        self.assertEqual(graph._triple_tokens(triple), (graph._filter_tfidf(utilities.process_text(triple.subject)),
+                                                        utilities.process_text(triple.relation, False),
+                                                        graph._filter_tfidf(utilities.process_text(triple.object))))
+        self.assertEqual(triple.element_tokens()[2][1]['stemmed_word'], 'lamb')
+
+        # update() doesn't go through save, the tokens notice the text changed anyway
+        Triple.objects.filter(id=triple.id).update(object='big goat')
+        triple = Triple.objects.get(id=triple.id)
+        self.assertFalse(triple.tokens_current())
+        self.assertEqual([token.stemmed_word for token in triple.element_tokens()[2]], ['big', 'goat'])
+
+    def test_build_does_no_text_processing(self):
+        with mock.patch.object(utilities, 'process_word', side_effect=AssertionError('processed text')):
+            graph = TripleGraph(list(self.document.sentences.all()), self.scores)
+        self.assertIsNotNone(graph.get_node('sheep'))
+
+    def test_stale_tokens_made_again(self):
+        Triple.objects.filter(sentence=self.sentences[1]).update(tokens=None, tokens_version='')
+        Triple.objects.filter(sentence=self.sentences[2]).update(tokens_version='old')
+        TripleGraph(list(self.document.sentences.all()), self.scores)
+        self.assertFalse(Triple.objects.exclude(tokens_version=utilities.TOKENS_VERSION).exists())
+
+    def test_made_by_migration(self):
+        migration = importlib.import_module('text_generation.migrations.0005_triple_tokens')
+        Triple.objects.update(tokens=None, tokens_version='')
+        with mock.patch.object(migration, 'BATCH_SIZE', 2):
+            migration.make_triple_tokens(apps, None)
+        for triple in Triple.objects.all():
+            self.assertTrue(triple.tokens_current())
+            # its own copy of the text processing makes the same tokens as the app's
+            self.assertEqual(triple.tokens, make_tokens(triple.subject, triple.relation, triple.object))
+
+
 class GoogleExtractorTest(TestCase):
     def setUp(self):
         self.extractor = GoogleExtractor()
@@ -913,3 +2104,356 @@ class DocumentHistoryTest(TestCase):
         self.assertTrue(self.document.documentHistories.all().count() > 0)
         print(self.document.documentHistories.all().count() > 0)
         print(self.document.documentHistories.all())
+
+
+class StandInNLPHandler(BaseHTTPRequestHandler):
+    """Answers like a CoreNLP server running openie with one sentence per line: a triple made from the first, second
+    and rest of the words of each line. Every request takes REQUEST_TIME, about what a round trip to the server costs
+    before it does any work."""
+    REQUEST_TIME = 0.02
+    lock = threading.Lock()
+    # texts that were sent to be annotated
+    posted = []
+    # the most requests it was answering at once
+    answering = 0
+    most_answering = 0
+
+    def do_GET(self):
+        # pycorenlp checks that the server is up before each annotate
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        cls = type(self)
+        text = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        self.posted.append(text)
+        with cls.lock:
+            cls.answering += 1
+            cls.most_answering = max(cls.most_answering, cls.answering)
+        time.sleep(self.REQUEST_TIME)
+        with cls.lock:
+            cls.answering -= 1
+        sentences = []
+        for line in text.split('\n'):
+            words = line.rstrip('.').split()
+            if not line.strip():
+                continue
+            openie = [{'subject': words[0], 'relation': words[1], 'object': ' '.join(words[2:])}] if len(words) > 2 else []
+            sentences.append({'openie': openie})
+        body = json.dumps({'sentences': sentences}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInNLPTestCase(TestCase):
+    def setUp(self):
+        _empty_corpus_idf(self)
+        StandInNLPHandler.posted = []
+        StandInNLPHandler.most_answering = 0
+        annotation_cache.clear()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInNLPHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.client = NLPClient(self.url)
+        self.addCleanup(self.client.close)
+        patcher = mock.patch('text_generation.models.sentence.nlp_server', self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.document = Document.objects.create(title='Mary')
+
+    def _sentences(self, count):
+        return [Sentence.objects.create(text=f'Mary{i} had lamb{i} today.', document=self.document, position=i)
+                for i in range(count)]
+
+    @staticmethod
+    def _triples(sentences):
+        return sorted((triple.sentence.position, triple.subject, triple.relation, triple.object)
+                      for triple in Triple.objects.filter(sentence__in=sentences).select_related('sentence'))
+
+
+class ReplayTest(StandInNLPTestCase):
+    def setUp(self):
+        super().setUp()
+        fixture_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(fixture_dir.cleanup)
+        self.store = FixtureStore(fixture_dir.name, mode=RECORD, latency={'nlp': 0.05})
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        for patcher in [mock.patch.object(replay, '_store', self.store),
+                        mock.patch.object(http_cache, '_cache', HTTPCache(cache_dir.name)),
+                        mock.patch.object(politeness, '_scheduler', PolitenessScheduler(
+                            host_rate=10000, host_burst=10000, global_rate=10000))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        StandInPageHandler.requested = []
+        self.pages = ThreadingHTTPServer(('127.0.0.1', 0), StandInPageHandler)
+        self.pages.daemon_threads = True
+        threading.Thread(target=self.pages.serve_forever, daemon=True).start()
+        self.addCleanup(self.pages.server_close)
+        self.page_urls = [f'http://127.0.0.1:{self.pages.server_port}/article/{i}' for i in range(3)]
+
+    def _run_pipeline(self):
+        """Extracts the articles and builds the triples of their first sentences"""
+        extractor = ArticleExtractor()
+        extractor.extract_articles(self.page_urls)
+        Sentence.objects.all().delete()
+        annotation_cache.clear(persistent=True)
+        sentences = [Sentence.objects.create(text=article.text.split(', ')[0] + '.', document=self.document,
+                                             position=i) for i, article in enumerate(extractor.articles)]
+        Sentence.build_triples_bulk(sentences)
+        return [(article.url, article.text) for article in extractor.articles], self._triples(sentences)
+
+    def test_record_then_replay(self):
+        recorded = self._run_pipeline()
+        self.assertEqual(len(recorded[0]), 3)
+        self.assertTrue(recorded[1])
+        self.assertEqual(self.store.stats()['recorded'], 3 + 1)
+
+        # nothing to talk to anymore
+        self.pages.shutdown()
+        self.server.shutdown()
+        self.store.mode = REPLAY
+        StandInPageHandler.requested = []
+        StandInNLPHandler.posted = []
+        http_cache.get_cache().clear()
+        start = time.perf_counter()
+        self.assertEqual(self._run_pipeline(), recorded)
+        # the replayed annotation stood in for a server that takes 0.05s
+        self.assertGreaterEqual(time.perf_counter() - start, 0.05)
+        self.assertEqual((StandInPageHandler.requested, StandInNLPHandler.posted), ([], []))
+        self.assertEqual(self.store.stats()['replayed'], 3 + 1)
+
+    def test_replay_missing(self):
+        self.store.mode = REPLAY
+        with self.assertRaises(FixtureMissing):
+            self.client.annotate('Never recorded.', {'annotators': 'openie', 'outputFormat': 'json'})
+
+    def test_completion(self):
+        calls = []
+
+        def complete():
+            calls.append(1)
+            return {'choices': [{'text': 'Mary had a lamb.'}]}
+
+        kwargs = {'model': 'text-davinci-003', 'prompt': 'Mary had a little lamb.\n\nTl;dr', 'temperature': 0}
+        self.assertEqual(self.store.call('completion', kwargs, complete), complete())
+        self.store.mode = REPLAY
+        self.assertEqual(self.store.call('completion', dict(kwargs), complete)['choices'][0]['text'], 'Mary had a lamb.')
+        self.assertEqual(len(calls), 2)
+        self.store.mode = OFF
+        self.store.call('completion', {'prompt': 'not recorded'}, complete)
+        self.assertEqual(len(calls), 3)
+
+class BuildTriplesBulkTest(StandInNLPTestCase):
+    def test_same_triples(self):
+        sentences = self._sentences(7)
+        sentences.append(Sentence.objects.create(text='Mary had.', document=self.document, position=7))
+        self.assertEqual(Sentence.build_triples_bulk(sentences, batch_size=3), 7)
+        self.assertEqual(self._triples(sentences),
+                         [(i, f'Mary{i}', 'had', f'lamb{i} today') for i in range(7)])
+
+    def test_one_request_per_batch(self):
+        sentences = self._sentences(100)
+        start = time.perf_counter()
+        for sentence in sentences:
+            sentence.build_triples()
+        single_time = time.perf_counter() - start
+        single_requests = len(StandInNLPHandler.posted)
+
+        Triple.objects.all().delete()
+        StandInNLPHandler.posted = []
+        start = time.perf_counter()
+        Sentence.build_triples_bulk(sentences)
+        bulk_time = time.perf_counter() - start
+
+        print(f'\nbuild_triples for 100 sentences: {single_time:.3f}s, build_triples_bulk: {bulk_time:.3f}s')
+        self.assertEqual(len(self._triples(sentences)), 100)
+        # a round trip to the server for every NLP_ANNOTATE_BATCH_SIZE sentences instead of every sentence
+        self.assertEqual(single_requests, 100)
+        self.assertEqual(len(StandInNLPHandler.posted), math.ceil(100 / settings.NLP_ANNOTATE_BATCH_SIZE))
+
+
+class AnnotationCacheTest(StandInNLPTestCase):
+    def test_build_triples(self):
+        first, second = self._sentences(2)
+        same_text = Sentence.objects.create(text=first.text, document=self.document, position=2)
+        first.build_triples()
+        second.build_triples()
+        same_text.build_triples()
+        self.assertEqual(StandInNLPHandler.posted, [first.text, second.text])
+        self.assertEqual(same_text.triple_set.get().subject, 'Mary0')
+        self.assertEqual(annotation_cache.stats()['hits'], 1)
+        self.assertEqual(annotation_cache.stats()['misses'], 2)
+
+    def test_bulk_only_sends_misses(self):
+        sentences = self._sentences(6)
+        Sentence.build_triples_bulk(sentences[:4])
+        # the cache in memory is gone, the table is still there
+        annotation_cache.clear()
+        StandInNLPHandler.posted = []
+        copies = [Sentence.objects.create(text=sentence.text, document=self.document, position=sentence.position + 6)
+                  for sentence in sentences]
+        Sentence.build_triples_bulk(copies)
+        self.assertEqual(StandInNLPHandler.posted, ['Mary4 had lamb4 today.\nMary5 had lamb5 today.'])
+        self.assertEqual(annotation_cache.stats()['db_hits'], 4)
+        self.assertEqual([(i - 6, f'Mary{i - 6}') for i, _, _, _ in self._triples(copies)],
+                         [(i, f'Mary{i}') for i in range(6)])
+
+    def test_properties_key(self):
+        properties = {'annotators': 'tokenize, ssplit, pos', 'outputFormat': 'json'}
+        self.assertEqual(annotation_cache.cache_key('text', properties),
+                         annotation_cache.cache_key('text', {'outputFormat': 'json', 'annotators': 'tokenize,ssplit,pos'}))
+        self.assertNotEqual(annotation_cache.cache_key('text', properties),
+                            annotation_cache.cache_key('text', dict(properties, annotators='tokenize, ssplit')))
+        self.assertNotEqual(annotation_cache.cache_key('text', properties),
+                            annotation_cache.cache_key('other text', properties))
+
+    def test_eviction(self):
+        sentences = self._sentences(4)
+        with mock.patch.object(annotation_cache, 'ANNOTATION_CACHE_SIZE', 3), \
+                mock.patch.object(annotation_cache, 'ANNOTATION_CACHE_MEMORY_SIZE', 2), \
+                mock.patch.object(annotation_cache, 'ANNOTATION_CACHE_PRUNE_EVERY', 5):
+            for sentence in sentences[:3]:
+                sentence.build_triples()
+            # the table only gets counted every 5 puts
+            with self.assertNumQueries(1):
+                annotation_cache.put_many({'extra': {}})
+            self.assertEqual(CachedAnnotation.objects.count(), 4)
+            sentences[3].build_triples()
+            self.assertEqual(CachedAnnotation.objects.count(), 3)
+            self.assertEqual(annotation_cache.stats()['evictions'], 2)
+            self.assertEqual(annotation_cache.stats()['in_memory'], 2)
+            # the first two were the least recently used
+            StandInNLPHandler.posted = []
+            for sentence in sentences[2:] + sentences[:2]:
+                sentence.build_triples()
+            self.assertEqual(StandInNLPHandler.posted, [sentences[0].text, sentences[1].text])
+
+
+class NLPClientTest(StandInNLPTestCase):
+    properties = {'annotators': 'openie', 'outputFormat': 'json'}
+
+    def test_annotate(self):
+        annotation = self.client.annotate('Mary had a lamb.', self.properties)
+        self.assertEqual(annotation['sentences'][0]['openie'][0]['object'], 'a lamb')
+        self.assertEqual(self.client.stats()['requests'], 1)
+
+    def test_annotate_many_concurrently(self):
+        texts = [f'Mary{i} had lamb{i}.' for i in range(16)]
+        annotations = self.client.annotate_many(texts, self.properties)
+        self.assertEqual([annotation['sentences'][0]['openie'][0]['subject'] for annotation in annotations],
+                         [f'Mary{i}' for i in range(16)])
+        # several at a time, up to max_concurrency
+        self.assertGreater(StandInNLPHandler.most_answering, 1)
+        self.assertLessEqual(StandInNLPHandler.most_answering, settings.NLP_CLIENT_MAX_CONCURRENCY)
+        stats = self.client.stats()
+        self.assertEqual((stats['requests'], stats['queued'], stats['in_flight']), (16, 0, 0))
+        self.assertGreaterEqual(stats['p50_latency'], StandInNLPHandler.REQUEST_TIME)
+
+    def test_timeout(self):
+        client = NLPClient(self.url, read_timeout=0.05)
+        self.addCleanup(client.close)
+        with mock.patch.object(StandInNLPHandler, 'REQUEST_TIME', 0.5):
+            with self.assertRaises(NLPServerError):
+                client.annotate('Mary had a lamb.', self.properties)
+        self.assertEqual(client.stats()['timeouts'], 1)
+
+    def test_backpressure(self):
+        client = NLPClient(self.url, max_concurrency=1, max_queue=1)
+        self.addCleanup(client.close)
+        futures = [client.submit('Mary had a lamb.', self.properties) for _ in range(2)]
+        third = threading.Thread(target=lambda: futures.append(client.submit('Mary had a lamb.', self.properties)))
+        third.start()
+        third.join(StandInNLPHandler.REQUEST_TIME / 2)
+        # one running and one waiting, the third waits for a slot
+        self.assertTrue(third.is_alive())
+        third.join()
+        self.assertEqual(len([future.result() for future in futures]), 3)
+
+
+class StandInTensor:
+    def __init__(self, megabytes):
+        self.megabytes = megabytes
+
+    def numel(self):
+        return self.megabytes * 2 ** 20
+
+    def element_size(self):
+        return 1
+
+
+class ModelRegistryTest(TestCase):
+    def setUp(self):
+        self.loads = []
+
+    def _name(self, name):
+        # loaders stay registered for the whole run, so every test gets its own names
+        name = f'{self.id()}-{name}'
+        self.addCleanup(model_registry.evict, name)
+        return name
+
+    def _loader(self, name, megabytes):
+        def load():
+            self.loads.append(name)
+            return {'weights': StandInTensor(megabytes), 'tokenizer': name}
+        return load
+
+    def test_loads_once(self):
+        small = self._name('small')
+        model_registry.register(small, self._loader('small', 1))
+        first = model_registry.get(small)
+        with model_registry.inference(small):
+            pass
+        self.assertIs(model_registry.get(small), first)
+        self.assertEqual(self.loads, ['small'])
+        stats = model_registry.stats()[small]
+        self.assertTrue(stats['loaded'])
+        self.assertEqual((stats['loads'], stats['inferences'], stats['size_mb']), (1, 1, 1))
+
+    def test_get_registers(self):
+        other = self._name('other')
+        model_registry.get(other, self._loader('other', 1))
+        model_registry.warm_up([other, self._name('not-registered')])
+        self.assertEqual(self.loads, ['other'])
+
+    def test_memory_eviction(self):
+        small, other, large = self._name('small'), self._name('other'), self._name('large')
+        with mock.patch.object(model_registry, 'SUMMARIZER_MODEL_MEMORY_MB', 10):
+            model_registry.get(small, self._loader('small', 2))
+            model_registry.get(other, self._loader('other', 3))
+            model_registry.get(small)
+            # the least recently used goes, not the one that was loaded first
+            model_registry.get(large, self._loader('large', 6))
+            self.assertFalse(model_registry.stats()[other]['loaded'])
+            self.assertTrue(model_registry.stats()[small]['loaded'])
+            model_registry.get(other)
+        self.assertEqual(self.loads, ['small', 'other', 'large', 'other'])
+
+
+class BatchedSummarizationTest(TestCase):
+    def test_token_budget_batches(self):
+        lengths = [500, 100, 1024, 120, 480, 2000, 90]
+        batches = token_budget_batches(lengths, 1024)
+        self.assertEqual(batches, [[6, 1, 3], [4, 0], [2], [5]])
+        self.assertEqual(sorted(i for batch in batches for i in batch), list(range(len(lengths))))
+        for batch in batches[:-1]:
+            self.assertLessEqual(len(batch) * max(lengths[i] for i in batch), 1024)
+
+    def test_articles_summarized_together(self):
+        document = Document.objects.create(title='Mary')
+        long_text = 'Mary had a little lamb. ' * 6
+        articles = [Article.objects.create(document=document, text=long_text, url=f'www.{i}.com') for i in range(3)]
+        short = Article.objects.create(document=document, text='Too short.', url='www.short.com')
+        with mock.patch('text_generation.models.document.BartSummarizer') as summarizer:
+            document._summarize_articles(articles=articles + [short], summarizer_text='bart')
+        summarizer.return_value.summarize_many.assert_called_once_with(document=document, articles=articles,
+                                                                       section=None)
+        summarizer.return_value.summarize.assert_not_called()
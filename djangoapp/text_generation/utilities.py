@@ -1,7 +1,14 @@
-from typing import List, Dict, Any
+import functools
+import hashlib
+import json
+from typing import Dict, Iterable, List, NamedTuple
 
 import nltk
-from pycorenlp import StanfordCoreNLP
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+
+from living_documents_server.settings import TEXT_STEM_CACHE_SIZE, TEXT_TOKEN_CACHE_SIZE
+from text_generation.annotators import annotation_cache
+from text_generation.annotators.nlp_client import NLPClient
 
 nltk.download('stopwords')
 stopwords = set(nltk.corpus.stopwords.words('english'))
@@ -9,46 +16,127 @@ my_stops = {'displaystyle', 'mathbf', 'function', 'mathcal', 'alpha', 'boldsymbo
 stopwords |= my_stops
 
 stemmer = nltk.stem.porter.PorterStemmer()
+# the same stems over and over (every sentence, triple element and tf-idf pass), so each word only gets stemmed once
+stem = functools.lru_cache(maxsize=TEXT_STEM_CACHE_SIZE)(stemmer.stem)
+# deletes everything but the letters from an ascii word, other words go through isalpha a character at a time
+_ASCII_NON_LETTERS = str.maketrans('', '', ''.join(chr(c) for c in range(128) if not chr(c).isalpha()))
+
+
+class Token(NamedTuple):
+    """One word of a processed text, all empty strings if it was a stop word that got filtered out. The tokens are
+    shared between texts, so they can't be changed. token["stemmed_word"] works as well as token.stemmed_word."""
+    stemmed_word: str
+    processed_word: str
+    actual_word: str
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
 
+_FILTERED = Token('', '', '')
+# bump it when what process_word makes from a word changes, so the tokens saved with the triples get made again
+TOKEN_FORMAT = 1
+# the text processing the saved tokens were made with, tokens made with anything else are stale
+TOKENS_VERSION = hashlib.sha256(json.dumps(
+    [TOKEN_FORMAT, type(stemmer).__name__, stemmer.mode, sorted(stopwords)]).encode()).hexdigest()[:16]
+
+
+def letters(word: str) -> str:
+    """The word with everything that isn't a letter taken out
+
+    :param str word: the word
+    :return str:
+    """
+    if word.isalpha():
+        return word
+    if word.isascii():
+        return word.translate(_ASCII_NON_LETTERS)
+    return ''.join(e for e in word if e.isalpha())
 
-def process_text(text: str, filter_stopwords: bool = True) -> List[Dict[str, Any]]:
+
+@functools.lru_cache(maxsize=TEXT_TOKEN_CACHE_SIZE)
+def process_word(word: str, filter_stopwords: bool = True) -> Token:
+    """The token for one word
+
+    :param str word: the word as it is in the text
+    :param bool filter_stopwords: whether a stop word comes back empty
+    :return Token:
+    """
+    processed_word = letters(word)
+    if filter_stopwords and processed_word in stopwords:
+        return _FILTERED
+    return Token(stem(processed_word), processed_word, word)
+
+
+def process_text(text: str, filter_stopwords: bool = True) -> List[Token]:
     """Returns a list of stemmed text, filtered of stopwords if flag is true
 
     :param bool filter_stopwords: Default to false
     :param str text: text to process
-    :return List[str:, changed to List[{}]
+    :return List[Token]: one per word, see Token
+    """
+    return [process_word(word, filter_stopwords) for word in text.lower().split()]
+
+
+def process_texts(texts: Iterable[str], filter_stopwords: bool = True) -> List[List[Token]]:
+    """process_text for each of the texts
+
+    :param Iterable[str] texts: texts to process
+    :param bool filter_stopwords: whether stop words come back empty
+    :return List[List[Token]]:
+    """
+    return [[process_word(word, filter_stopwords) for word in text.lower().split()] for text in texts]
+
+
+def process_text_list(words: List[str]) -> List[Token]:
+    return [process_word(word) for word in words]
+
+
+def stemmed_text(text: str) -> str:
+    """The text as the space separated stemmed words (stop words dropped) that the tf-idf scores get calculated on
+
+    :param str text: text to process
+    :return str:
+    """
+    return ' '.join([process_word(word).stemmed_word for word in text.lower().split()])
+
+
+def stemmed_texts(texts: Iterable[str]) -> List[str]:
+    """stemmed_text for each of the texts
+
+    :param Iterable[str] texts: texts to process
+    :return List[str]:
+    """
+    return [stemmed_text(text) for text in texts]
+
+
+def tf_idf_scores(texts: List[str], corpus=None) -> Dict[str, float]:
+    """Vectorizes the texts and gets one tf-idf score per token, if a token is in more than one text the score from
+    the last one wins
+
+    :param List[str] texts: the stemmed texts, see stemmed_text
+    :param CorpusIdf corpus: the idf comes from it instead of from the texts, see corpus_idf
+    :return Dict[str, float]: token -> score
     """
-    processed_text = []
-    for word in text.lower().split():
-        processed_text_object = {"stemmed_word": "", "processed_word": "", "actual_word": ""}
-        processed_word = ''.join(e for e in word if e.isalpha())
-        if processed_word not in stopwords or not filter_stopwords:
-            processed_text_object["stemmed_word"] = stemmer.stem(processed_word)
-            # processed_text.append(stemmer.stem(processed_word))
-            processed_text_object["processed_word"] = processed_word
-            processed_text_object["actual_word"] = word
-
-        processed_text.append(processed_text_object)
-    return processed_text
-
-
-def process_text_list(words: List[str]) -> List[Dict[str, Any]]:
-    processed_text = []
-    for word in words:
-        processed_text_object = {"stemmed_word": "", "processed_word": "", "actual_word": ""}
-        processed_word = ''.join(e for e in word if e.isalpha())
-        if processed_word not in stopwords:
-            processed_text_object["stemmed_word"] = stemmer.stem(processed_word)
-            # processed_text.append(stemmer.stem(processed_word))
-            processed_text_object["processed_word"] = processed_word
-            processed_text_object["actual_word"] = word
-
-        processed_text.append(processed_text_object)
-    return processed_text
+    if corpus is None:
+        tfidf_vec = TfidfVectorizer()
+        transformed = tfidf_vec.fit_transform(texts)
+    else:
+        tfidf_vec = CountVectorizer()
+        counts = tfidf_vec.fit_transform(texts)
+        transformed = corpus.tfidf(counts, tfidf_vec.get_feature_names_out())
+    # by column, with each column's rows in order, so a column's last value is from the last text it's in
+    transformed = transformed.tocsc()
+    transformed.sort_indices()
+    # every token is in at least one text, so no column is empty
+    last_values = transformed.data[transformed.indptr[1:] - 1]
+    return dict(zip(tfidf_vec.get_feature_names_out().tolist(), last_values.tolist()))
 
 
 def tf_idf_reduce_noun_adjectives(text,
-                                  nlp_server: StanfordCoreNLP,
+                                  nlp_server: NLPClient,
                                   min_cut: float = 0.1,
                                   max_cut: float = 0.9):
     """Takes a document and gets rid of stopwords and counts the frequency
@@ -73,9 +161,10 @@ def tf_idf_reduce_noun_adjectives(text,
 
     freq = {}
 
-    annotated_text = nlp_server.annotate(
+    annotated_text = annotation_cache.annotate(
+        nlp_server,
         text[:50000],
-        properties={
+        {
             'annotators': 'tokenize, ssplit, pos',
             'outputFormat': 'json'
         })
@@ -108,7 +197,7 @@ def tf_idf_reduce_noun_adjectives(text,
 
 
 def tf_idf_reduce(text,
-                  nlp_server: StanfordCoreNLP,
+                  nlp_server: NLPClient,
                   min_cut: float = 0.1,
                   max_cut: float = 0.9):
     """Takes a document and gets rid of stopwords and counts the frequency
@@ -132,9 +221,10 @@ def tf_idf_reduce(text,
 
     freq = {}
 
-    annotated_text = nlp_server.annotate(
+    annotated_text = annotation_cache.annotate(
+        nlp_server,
         text[:50000],
-        properties=dict(annotators='tokenize, ssplit, pos', outputFormat='json'))
+        dict(annotators='tokenize, ssplit, pos', outputFormat='json'))
 
     for sentence in annotated_text['sentences']:
         for token in sentence['tokens']:
@@ -3,10 +3,6 @@ from __future__ import unicode_literals
 
 import datetime
 import logging
-import sys
-import threading
-sys.setrecursionlimit(10**7)  # max depth of recursion
-threading.stack_size(2**27)
 
 from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
@@ -16,6 +12,7 @@ from rest_framework.decorators import api_view
 from rest_framework.parsers import JSONParser
 from rest_framework.permissions import AllowAny
 
+from text_generation.annotators import graph_maintenance
 from text_generation.models import Document, Section, Sentence, Article, Keyword
 from text_generation.serializers import DocumentSerializer
 
@@ -33,39 +30,14 @@ class TripleGraphViewSet(viewsets.ModelViewSet):
         except Document.DoesNotExist:
             return HttpResponse(status=404)
         if request.method == 'GET':
-            logger.warn("before tfidf scores")
-            document.calculate_tf_idf_scores(useAllSentences=True)
-            logger.warn("before trying build graph")
-            document.build_triple_graph(useAllSentences=True)
+            logger.warn("before trying load graph")
+            document.load_triple_graph(useAllSentences=True)
             # if document.graph is None:
             #     document.build_triple_graph()
-            logger.warn("after trying build graph")
-            graph_arr = []
-            visited = []
-
-            def get_tree_help(node, level):
-                # node.children
-                if node not in visited:
-                    ch_obj = {"name": str(node), "children": []}
-                    visited.append(node)
-                    for n in node.children:
-                        ch_obj["children"].append(get_tree_help(n, level+1))
-                    return ch_obj
-                else:
-                    return {"name": str(node), "children": []}
-
-            i = 0
-            for root in document.graph.roots:
-                # if root.speech_type != "RELATION":
-                graph_arr.append({"name": str(root), "children": []})
-                visited.append(root)
-
-                # parent = str(root)
-                for child in root.children:
-                    # graph_arr[i]["parent"] = parent
-                    graph_arr[i]["children"].append(get_tree_help(child, 1))
-
-                i = i + 1
+            logger.warn("after trying load graph")
+            # the graph can be one that other requests' saves keep changing
+            with graph_maintenance.locked(document.graph):
+                graph_arr = document.graph.tree_data()
 
             logger.warning("Graph Array: " + str(graph_arr))
             logger.warning("Confirmation: I'm in my string era. Not anymore o")
@@ -178,7 +150,8 @@ class DocumentViewSet(viewsets.ModelViewSet):
 
         if request.method == 'POST':
             document.calculate_tf_idf_scores()
-            document.build_triple_graph()
+            # the graph gets sentences taken out of it below that stay in the document
+            document.build_triple_graph(track_changes=False)
             data = JSONParser().parse(request)
             old_word = data['old_word'].lower()
             new_word = data['new_word'].lower()
@@ -187,33 +160,22 @@ class DocumentViewSet(viewsets.ModelViewSet):
         new_word_model = document.change_word_text(old_word, new_word)  # change this 100
         logger.warn(new_word_model)
         logger.warn("Received new text")
-        new_text_triples = []
-        # sents = []
-        for id_sent in new_word_model:
-            logger.warn("Building Triples...")
-            sentence_obj = Sentence.objects.get(pk=id_sent)
-            sentence_obj.build_triples()
-            logger.warn("Built Triples...")
-            triples = sentence_obj.triple_set.all()
-            # logger.warn(triples)
-            new_text_triples.append(triples)
-            # sents.append(sent)
+        logger.warn("Building Triples...")
+        new_sentences = [Sentence.objects.get(pk=id_sent) for id_sent in new_word_model]
+        Sentence.build_triples_bulk(new_sentences)
+        logger.warn("Built Triples...")
+        new_text_triples = [sentence_obj.triple_set.all() for sentence_obj in new_sentences]
 
         stemmer = PorterStemmer()
 
         tokenized_old_word = stemmer.stem(old_word)
         # logger.warn("tokenize-d word: " + tokenized_old_word)
-        # logger.warn(document.graph._token_lookup)
-        for node in document.graph._token_lookup:
-            if tokenized_old_word == str(node):
-                logger.warn("found in token lookup")
-                # for sent in node.sentences:
-                #     document.graph.delete_sentence(sent)
-                # should be empty
-                rem_sent = [document.graph.delete_sentence(sent) for sent in list(node.sentences)]
-                # sent.delete()  # from django
-                logger.warn("Old Node sentences deleted")
-                break
+        node = document.graph.get_node(tokenized_old_word)
+        if node is not None:
+            logger.warn("found in token lookup")
+            # should be empty
+            rem_sent = [document.graph.delete_sentence(sent) for sent in list(node.sentences)]
+            logger.warn("Old Node sentences deleted")
 
         i = 0  # loop variable
         for one_sent_triples in new_text_triples: